@@ -4,8 +4,13 @@
 """
 
 import sys, os
+import json
 import shutil
+import sqlite3
 import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
 
 # Use XDG for the config and cache directories if it's available
 try:
@@ -13,24 +18,150 @@ try:
 except:
     pass
 
+# Advisory locking, so several feedme processes can share a cache.
+# Without it (e.g. on Windows), don't run more than one at once.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import msglog
 import utils
 
 
+def lock_file(path, block=True):
+    """Take an exclusive advisory lock on path, creating it if need be.
+       Returns the open file, which holds the lock until it's closed;
+       or None if block is False and another process has the lock.
+    """
+    fp = open(path, 'a')
+    if fcntl:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX
+                        | (0 if block else fcntl.LOCK_NB))
+        except BlockingIOError:
+            fp.close()
+            return None
+    return fp
+
+
+class SeenIDs(object):
+    """The ids (story URLs) seen in one feed, each with the first and
+       last times (secs since epoch) it was in the feed.
+       To keep a big cache small and quick to search, the ids are kept
+       only as 64-bit hashes, in a sorted array searched by bisection,
+       with the times in parallel arrays. The full strings are only
+       in the cache file. The hashes are never saved, so Python's own
+       string hash, which changes from run to run, is fine.
+    """
+    __slots__ = ('hashes', 'first', 'last')
+
+    def __init__(self, entries=()):
+        """entries is an iterable of (id, first_seen, last_seen)."""
+        self.set_times({ SeenIDs.id_hash(itemid): (first, last)
+                         for itemid, first, last in entries })
+
+    @staticmethod
+    def id_hash(itemid):
+        return hash(itemid)
+
+    def set_times(self, times):
+        """Replace the contents with times, { hash: (first, last) }."""
+        hashes = sorted(times)
+        self.hashes = array('q', hashes)
+        self.first = array('q', (times[h][0] for h in hashes))
+        self.last = array('q', (times[h][1] for h in hashes))
+
+    def index(self, itemid):
+        """Where itemid's hash is in self.hashes, or -1 if it isn't."""
+        h = SeenIDs.id_hash(itemid)
+        i = bisect_left(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return i
+        return -1
+
+    def times(self, itemid):
+        """(first_seen, last_seen) for itemid, or None if it isn't here."""
+        i = self.index(itemid)
+        if i < 0:
+            return None
+        return (self.first[i], self.last[i])
+
+    def update(self, items, now, cutoff=None):
+        """Mark the ids in items as seen at time now, adding new ones,
+           then drop any that were last seen before cutoff.
+        """
+        times = dict(zip(self.hashes, zip(self.first, self.last)))
+        for item in items:
+            h = SeenIDs.id_hash(item)
+            if h in times:
+                times[h] = (min(times[h][0], now), max(times[h][1], now))
+            else:
+                times[h] = (now, now)
+        if cutoff:
+            times = { h: t for h, t in times.items() if t[1] >= cutoff }
+        self.set_times(times)
+
+    def merge(self, other):
+        """Add the ids from other, a SeenIDs for the same feed,
+           keeping the earliest first_seen and latest last_seen times.
+        """
+        times = dict(zip(self.hashes, zip(self.first, self.last)))
+        for h, first, last in zip(other.hashes, other.first, other.last):
+            if h in times:
+                times[h] = (min(times[h][0], first), max(times[h][1], last))
+            else:
+                times[h] = (first, last)
+        self.set_times(times)
+
+    def __contains__(self, itemid):
+        return self.index(itemid) >= 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __repr__(self):
+        return "<SeenIDs: %d ids>" % len(self)
+
+
 class FeedmeCache(object):
     """The FeedmeCache is a dictionary where the keys are site RSS URLs,
-       and for each feed we have a list of URLs we've seen.
-       { siteurl: [ url, url, url, ...] }
+       and for each feed we have a SeenIDs of the URLs we've seen, each
+       with the first and last times it was in the feed.
+       { siteurl: SeenIDs, siteurl: SeenIDs, ... }
        It's best to create a new FeedmeCache using the static method
        FeedmeCache.newcache().
        filename is the cache file we're using;
        last_time is the last modified time of the cache file, or None.
+       URLs that haven't been in their feed for retention_days
+       (save_days from the config file) are forgotten.
+       Several feedme processes can use the cache at once: they lock it
+       while reading or writing it, and each one's changes are merged
+       with whatever the others have saved.
+       A cache can be loaded for just some feeds (its scope);
+       other feeds are read from the file if and when they're used.
     """
     def __init__(self, cachefile):
         self.filename = cachefile
+        self.lockfile = os.path.join(os.path.dirname(cachefile),
+                                     "feedme.lock")
         self.thedict = {}
         self.last_fed = {}
         self.last_time = None
+        # Ids seen in each feed since the last save, as full strings,
+        # in dicts so they stay in order: { siteurl: { url: None, ... } }
+        self.seen_ids = {}
+        # Feeds deleted since the last save
+        self.deleted = set()
+        # The cache file as we last read or wrote it, from file_stamp()
+        self.stamp = None
+        # Which feeds are loaded, or None for all of them
+        self.scope = None
+        if utils.g_config:
+            self.retention_days = utils.g_config.getint('DEFAULT',
+                                                        'save_days')
+        else:
+            self.retention_days = None
 
     @staticmethod
     def get_cache_dir():
@@ -43,12 +174,41 @@ class FeedmeCache(object):
 
         return os.path.join(cachehome, 'feedme')
 
+    @contextmanager
+    def locked(self):
+        """Hold the cache lock while reading or changing the cache,
+           so other feedme processes can't change it at the same time.
+        """
+        fp = lock_file(self.lockfile)
+        try:
+            yield
+        finally:
+            fp.close()
+
+    def file_stamp(self):
+        """Something that changes whenever the cache file is replaced."""
+        try:
+            st = os.stat(self.filename)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
     @staticmethod
-    def newcache():
+    def newcache(sitekeys=None):
         """Find the cache file and load it into a newly created Cache object,
            returning the cache object.
            If there's no cache file yet, create one.
+           Which kind of cache depends on the cache_format config option.
+           If sitekeys is a list of feed URLs, only load those feeds.
         """
+        cache_format = 'text'
+        if utils.g_config:
+            cache_format = utils.g_config.get('DEFAULT', 'cache_format')
+        if cache_format == 'sqlite':
+            return FeedmeSQLiteCache.newcache(sitekeys)
+        if cache_format == 'journal':
+            return FeedmeJournalCache.newcache(sitekeys)
+
         cachefile = os.path.join(FeedmeCache.get_cache_dir(), "feedme.dat")
 
         if not os.access(cachefile, os.W_OK):
@@ -56,137 +216,401 @@ class FeedmeCache(object):
             if not os.path.exists(dirname):
                 os.makedirs(dirname)
             cache = FeedmeCache(cachefile)
+            cache.set_scope(sitekeys)
             cache.last_time = None
 
         else:
             cache = FeedmeCache(cachefile)
+            cache.set_scope(sitekeys)
 
-            # Make a backup of the cache file, in case something goes wrong.
-            cache.back_up()
-            cache.last_time = os.stat(cachefile).st_mtime
-            cache.read_from_file()
+            with cache.locked():
+                # Make a backup of the cache file,
+                # in case something goes wrong.
+                cache.back_up()
+                cache.last_time = os.stat(cachefile).st_mtime
+                cache.read_from_file(cache.scope)
+                cache.stamp = cache.file_stamp()
 
         return cache
 
+    def set_scope(self, sitekeys):
+        """Only load the feeds in sitekeys, or all feeds if it's None."""
+        if sitekeys is None:
+            self.scope = None
+        else:
+            self.scope = set(map(FeedmeCache.id_encode, sitekeys))
+
+    def is_loaded(self, sitekey):
+        return self.scope is None \
+            or FeedmeCache.id_encode(sitekey) in self.scope
+
+    def load_feed(self, sitekey):
+        """Make sure sitekey's feed is loaded, reading it if need be."""
+        if self.is_loaded(sitekey):
+            return
+        self.scope.add(FeedmeCache.id_encode(sitekey))
+        with self.locked():
+            self.read_from_file([ sitekey ])
+
     #
     # New style cache files are human readable and look like this:
-    # FeedMe v. 1
-    # siteurl|time|url url, url ...
+    # FeedMe v. 1.2
+    # siteurl|time|url first last url first last ...
     # One line per site.
-    # urls are a list of URLs on the RSS feed the last time we looked.
+    # urls are a list of URLs on the RSS feed the last time we looked,
+    # each followed by the first and last times it was seen there.
     # Time is the last time we updated this site, seconds since epoch.
     # Urls must all be urlencoded,
     # and in particular must have no spaces or colons.
+    # Versions before 1.2 had no per-url times.
     #
-    def read_from_file(self):
-        """Read cache from a cache file, either old or new style."""
-        with open(self.filename) as fp:
-            contents = fp.read()
+    FILE_VERSION = "1.2"
+
+    def read_lines(self):
+        """Read the lines of the cache file.
+           Returns (version, [line, line, ...]), or (None, [])
+           if there's no file or it's not a new-style file.
+        """
+        try:
+            with open(self.filename) as fp:
+                contents = fp.read()
+        except FileNotFoundError:
+            return None, []
 
         if not contents.startswith("FeedMe v."):
+            return None, []
+
+        lines = contents.split('\n')
+        return lines[0][len("FeedMe v."):].strip(), \
+            [ line for line in lines[1:] if line.strip() ]
+
+    @staticmethod
+    def parse_line(line, version):
+        """Parse one line of a cache file.
+           Returns (siteurl, lastfed, [(url, first, last), ...]),
+           or None if the line doesn't make sense.
+        """
+        try:
+            # Format v. 1 has feedname|urllist
+            #        v. 1.1 has feedname|lastfed|urllist
+            #        v. 1.2 has times in urllist
+            parts = line.split('|')
+            if len(parts) == 2:
+                key, urllist = parts
+                lastfed = 0
+            elif len(parts) == 3:
+                key, lastfed, urllist = parts
+                lastfed = int(lastfed)
+            else:
+                print("Confused by", len(parts), "parts in cache",
+                      file=sys.stderr)
+                return None
+        except ValueError:
+            print("Problem splitting on |: '%s'" % line, file=sys.stderr)
+            return None
+        key = key.strip()
+        urls = urllist.strip().split()
+
+        if version in ('1', '1.1'):
+            # Older files don't say when urls were seen;
+            # the last time the feed was fetched is the best guess.
+            return key, lastfed, [ (url, lastfed, lastfed) for url in urls ]
+        try:
+            if len(urls) % 3:
+                raise ValueError
+            return key, lastfed, list(zip(urls[0::3], map(int, urls[1::3]),
+                                          map(int, urls[2::3])))
+        except ValueError:
+            print("Bad url times in cache for", key, file=sys.stderr)
+            return None
+
+    def read_from_file(self, sitekeys=None):
+        """Read cache from a cache file, either old or new style.
+           If sitekeys is a list of feed URLs, only read those feeds.
+        """
+        version, lines = self.read_lines()
+        if not version:
             print("Sorry, old-style pickle-based cache files are "
                   "no longer supported.\nStarting over without cache.")
             # It's an old style, pickle-based file.
             return
 
+        if sitekeys is not None:
+            wanted = set(map(FeedmeCache.id_encode, sitekeys))
+
         # Must be a new-style file.
-        for line in contents.split('\n')[1:]:
-            if not line.strip():
+        for line in lines:
+            if sitekeys is not None and \
+               line.split('|', 1)[0].strip() not in wanted:
                 continue
-            try:
-                # Format v. 1 has feedname|urllist
-                #        v. 1.1 has feedname|lastfed|urllist
-                parts = line.split('|')
-                if len(parts) == 2:
-                    key, urllist = parts
-                    lastfed = 0
-                elif len(parts) == 3:
-                    key, lastfed, urllist = parts
-                    lastfed = int(lastfed)
-                else:
-                    print("Confused by", len(parts), "parts in cache",
-                          file=sys.stderr)
-                    continue
-            except ValueError:
-                print("Problem splitting on |: '%s'" % line, file=sys.stderr)
+            parsed = FeedmeCache.parse_line(line, version)
+            if not parsed:
                 continue
-            key = key.strip()
-            urls = urllist.strip().split()
-
-            self.thedict[key] = urls
+            key, lastfed, entries = parsed
+            self.thedict[key] = SeenIDs(entries)
             self.last_fed[key] = lastfed
 
+    def backup_name(self, mtime):
+        """The name for a backup of a cache last modified at mtime,
+           e.g. feedme-23-05-15-Mon.dat, or feedme-23-05-15-Mon.dat-1
+           if that's already taken.
+        """
+        timeappend = time.strftime("%y-%m-%d-%a", time.localtime(mtime))
+
+        base, ext = os.path.splitext(self.filename)
+        backupfilebase = "%s-%s%s" % (base, timeappend, ext)
+        num = 0
+        for num in range(10):
+            if num:
+                backupfile = "%s-%d" % (backupfilebase, num)
+            else:
+                backupfile = backupfilebase
+            if not os.path.exists(backupfile):
+                break
+        return backupfile
+
     def back_up(self):
-        """Back up the cache file to a file named for when
-           the last cache, self.filename, was last modified.
+        """Back up the cache, once per run, recording the backup
+           in the manifest of backups, and remove old backups
+           if that hasn't been done in the last day.
         """
         try:
-            mtime = os.stat(self.filename).st_mtime
-            timeappend = time.strftime("%y-%m-%d-%a", time.localtime(mtime))
-
-            base, ext = os.path.splitext(self.filename)
-            backupfilebase = "%s-%s%s" % (base, timeappend, ext)
-            num = 0
-            for num in range(10):
-                if num:
-                    backupfile = "%s-%d" % (backupfilebase, num)
-                else:
-                    backupfile = backupfilebase
-                if not os.path.exists(backupfile):
-                    break
-            print("Backing up cache file to", backupfile)
-            shutil.copy2(self.filename, backupfile)
+            manifest = self.read_manifest()
+            backup = self.make_backup(manifest)
+            if backup:
+                backup['time'] = int(time.time())
+                manifest['backups'].append(backup)
+            now = time.time()
+            if now - manifest['pruned'] > 24 * 60 * 60:
+                self.prune_backups(manifest, now)
+            self.write_manifest(manifest)
         except Exception as e:
             msglog.warn("WARNING: Couldn't back up cache file!")
             print(str(e), file=sys.stderr)
             utils.ptraceback()
 
-    def save_to_file(self):
-        """Serialize the cache to a version-1.1 new style cache file.
-           The existing file should already have been backed up by newcache().
+    def make_backup(self, manifest):
+        """Back up the cache file to a file named for when
+           the last cache, self.filename, was last modified.
+           The cache file is always replaced, never rewritten in place
+           (see write_file()), so a hard link is as good as a copy.
+           Returns the backup's manifest entry, { "file": name },
+           or None if the last backup is already of this same file.
         """
-        # Write the new cache file.
-        with open(self.filename, "w") as fp:
-            print("FeedMe v. 1.1", file=fp)
-            for k in self.thedict:
-                try:
-                    last_fed = self.last_fed[k]
-                except:
-                    last_fed = 0
-                print("%s|%d|%s" % (FeedmeCache.id_encode(k),
-                                    last_fed,
-                                    ' '.join(map(FeedmeCache.id_encode,
-                                                 self.thedict[k]))), file=fp)
-
-        # Remove backups older than N days.
-        # XXX should pass in save_days from config file
+        if manifest['backups']:
+            last = os.path.join(os.path.dirname(self.filename),
+                                manifest['backups'][-1]['file'])
+            try:
+                if os.path.samefile(last, self.filename):
+                    return None
+            except FileNotFoundError:
+                pass
+
+        backupfile = self.backup_name(os.stat(self.filename).st_mtime)
+        print("Backing up cache file to", backupfile)
+        self.link_backup(backupfile)
+        return { 'file': os.path.basename(backupfile) }
+
+    def link_backup(self, backupfile):
+        """Hard-link the cache file to backupfile,
+           or copy it if it can't be linked.
+        """
+        try:
+            os.link(self.filename, backupfile)
+        except OSError:
+            shutil.copy2(self.filename, backupfile)
+
+    def manifest_file(self):
+        return os.path.join(os.path.dirname(self.filename), "backups.json")
+
+    def read_manifest(self):
+        """The list of cache backups, and when they were last pruned:
+           { "backups": [ { "file": name, "time": secs }, ... ],
+             "pruned": secs }
+           A journal cache's backups also have "journal": name,
+           and "stamps" (see FeedmeJournalCache.backup_stamps()).
+        """
+        try:
+            with open(self.manifest_file()) as fp:
+                manifest = json.load(fp)
+        except FileNotFoundError:
+            manifest = {}
+        except ValueError as e:
+            print("Bad backup manifest, starting a new one:", e,
+                  file=sys.stderr)
+            manifest = {}
+        manifest.setdefault('backups', [])
+        manifest.setdefault('pruned', 0)
+        return manifest
+
+    def write_manifest(self, manifest):
+        tmpfile = "%s.%d.tmp" % (self.manifest_file(), os.getpid())
+        with open(tmpfile, "w") as fp:
+            json.dump(manifest, fp, indent=1)
+        os.replace(tmpfile, self.manifest_file())
+
+    def prune_backups(self, manifest, now):
+        """Remove backups older than save_days, per the manifest."""
+        days = self.retention_days or 7
         cachedir = os.path.dirname(self.filename)
-        files = os.listdir(cachedir)
-        for f in files:
-            if not f.startswith("feedme."):
+        keep = []
+        for backup in manifest['backups']:
+            if now - backup['time'] < days * 24 * 60 * 60:
+                keep.append(backup)
                 continue
-            # does it have six numbers after the feedme?
-            try:
-                d = int(f[7:14])
-            except ValueError:
+            print("Removing old cache", backup['file'], file=sys.stderr)
+            for name in (backup['file'], backup.get('journal')):
+                if not name:
+                    continue
+                try:
+                    os.unlink(os.path.join(cachedir, name))
+                except FileNotFoundError:
+                    pass
+        manifest['backups'] = keep
+        manifest['pruned'] = int(now)
+
+    def save_to_file(self):
+        """Serialize the cache to a version-1.2 new style cache file.
+           The existing file should already have been backed up by newcache().
+           If another feedme has saved the cache since we read it,
+           merge with what it saved.
+        """
+        with self.locked():
+            if self.file_stamp() != self.stamp:
+                self.merge_from_file()
+            self.write_file(self.filename, self.seen_ids)
+            self.stamp = self.file_stamp()
+        self.seen_ids.clear()
+        self.deleted.clear()
+
+    def merge_from_file(self):
+        """Someone else has changed the cache file since we read it.
+           Start over from what's in it now, and make our own changes
+           since the last save on top of that.
+        """
+        print("Merging with cache changes from another feedme",
+              file=sys.stderr)
+        ours, our_last_fed = self.thedict, self.last_fed
+        self.thedict, self.last_fed = {}, {}
+        if os.path.exists(self.filename):
+            self.read_from_file(self.scope)
+
+        for sitekey in self.deleted:
+            self.thedict.pop(sitekey, None)
+            self.last_fed.pop(sitekey, None)
+        for sitekey in self.seen_ids:
+            self.last_fed[sitekey] = max(self.last_fed.get(sitekey, 0),
+                                         our_last_fed[sitekey])
+            if sitekey not in self.thedict:
+                self.thedict[sitekey] = ours[sitekey]
                 continue
-            # It matches feedme.nnnnnn. How old is it? st_mtime is secs.
-            mtime = os.stat(f).st_mtime
-            age_days = (time.time() - mtime) / 60 / 60 / 24
-            if age_days > 5:
-                print("Removing old cache", f, file=sys.stderr)
-                os.unlink(f)
+            self.thedict[sitekey].merge(ours[sitekey])
+            if self.retention_days:
+                # Don't bring back ids that we expired.
+                self.thedict[sitekey].update(
+                    (), 0, self.expiry_time(self.last_fed[sitekey]))
+
+    def write_file(self, outfile, new_ids):
+        """Write the whole cache as a version-1.2 cache file, outfile.
+           The full URL strings aren't kept in memory, so they come
+           from the existing cache file plus new_ids,
+           { siteurl: { url: None, ... } }, for feeds that have changed.
+           Lines for feeds that haven't changed, or haven't been loaded,
+           are copied as they are.
+           The file is written under a temporary name then renamed,
+           so there's never a half-written cache file.
+        """
+        version, lines = self.read_lines()
+        written = set()
+
+        tmpfile = "%s.%d.tmp" % (outfile, os.getpid())
+        with open(tmpfile, "w") as fp:
+            print("FeedMe v.", FeedmeCache.FILE_VERSION, file=fp)
+            for line in lines:
+                key = line.split('|', 1)[0].strip()
+                if key in written:
+                    continue
+                # Skip feeds that have been deleted from the cache.
+                if key in self.deleted or \
+                   (self.is_loaded(key) and key not in self.thedict):
+                    continue
+                if key in self.thedict and \
+                   (key in new_ids or version != FeedmeCache.FILE_VERSION):
+                    parsed = FeedmeCache.parse_line(line, version)
+                    urls = [ entry[0] for entry in parsed[2] ] \
+                        if parsed else []
+                    line = self.format_line(key, urls, new_ids.get(key, {}))
+                elif version != FeedmeCache.FILE_VERSION:
+                    # A feed that isn't loaded, in an older format file.
+                    parsed = FeedmeCache.parse_line(line, version)
+                    if not parsed:
+                        continue
+                    key, lastfed, entries = parsed
+                    line = "%s|%d|%s" % (key, lastfed, ' '.join(
+                        "%s %d %d" % entry for entry in entries))
+                print(line, file=fp)
+                written.add(key)
+
+            for key in self.thedict:
+                if key not in written:
+                    print(self.format_line(key, [], new_ids.get(key, {})),
+                          file=fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpfile, outfile)
+
+    def format_line(self, sitekey, urls, new_urls):
+        """A cache file line for sitekey, given the URLs it had in the
+           old file and new ones since; it gets those still cached.
+        """
+        seen = self.thedict[sitekey]
+        urls = dict.fromkeys(urls)
+        urls.update(new_urls)
+        entries = []
+        for url in urls:
+            times = seen.times(url)
+            if times:
+                entries.append("%s %d %d" % (FeedmeCache.id_encode(url),
+                                             times[0], times[1]))
+        return "%s|%d|%s" % (FeedmeCache.id_encode(sitekey),
+                             self.last_fed.get(sitekey, 0),
+                             ' '.join(entries))
 
     def add_items(self, sitekey, items):
+        """Note that items (a list of URLs) were all in sitekey's feed
+           just now, then forget any URLs that haven't been in the feed
+           for retention_days.
+        """
         if not items:
             return
-        self.last_fed[sitekey] = int(time.time())
+        self.load_feed(sitekey)
+        now = int(time.time())
+        self.last_fed[sitekey] = now
+        self.deleted.discard(sitekey)
+        self.seen_ids.setdefault(sitekey, {}).update(dict.fromkeys(items))
         if sitekey not in self.thedict:
-            self.thedict[sitekey] = items
-            return
-        for item in items:
-            if item not in self.thedict[sitekey]:
-                self.thedict[sitekey].append(item)
+            self.thedict[sitekey] = SeenIDs()
+        self.thedict[sitekey].update(items, now,
+                                     self.expiry_time(now)
+                                     if self.retention_days else None)
+
+    def expiry_time(self, now):
+        """URLs last seen before this time are forgotten."""
+        return now - self.retention_days * 60 * 60 * 24
+
+    def item_times(self, sitekey, item):
+        """When was item first and last seen in sitekey's feed?
+           Returns (first_seen, last_seen), or None if it's not cached.
+        """
+        self.load_feed(sitekey)
+        if sitekey not in self.thedict:
+            return None
+        return self.thedict[sitekey].times(item)
+
+    def close(self):
+        """Done with the cache: save any changes not yet saved."""
+        if self.seen_ids or self.deleted:
+            self.save_to_file()
 
     def last_fed_site(self, sitekey):
         try:
@@ -205,6 +629,7 @@ class FeedmeCache(object):
 
     # Methods to act like a dictionary:
     def __getitem__(self, key):
+        self.load_feed(key)
         return self.thedict.__getitem__(key)
 
     def __setitem__(self, key, val):
@@ -215,6 +640,8 @@ class FeedmeCache(object):
         return self.thedict.__setitem__(key, val)
 
     def __delitem__(self, name):
+        self.seen_ids.pop(name, None)
+        self.deleted.add(name)
         return self.thedict.__delitem__(name)
 
     def __len__(self):
@@ -232,3 +659,393 @@ class FeedmeCache(object):
     def keys(self):
         return list(self.thedict.keys())
 
+
+
+class FeedmeSQLiteCache(FeedmeCache):
+    """A FeedmeCache kept in a SQLite database, feedme.sqlite,
+       so that saving after each feed writes only that feed's new rows,
+       in one transaction, rather than rewriting the whole cache.
+       The database uses write-ahead logging, so a save is cheap
+       and a crash partway through a run loses at most the current feed.
+       The first time, it imports any existing feedme.dat.
+       SQLite does its own locking, and each save only adds to
+       what's there, so other feedme processes' changes are kept.
+    """
+    # Stored in PRAGMA user_version; 0 means a brand new database.
+    # Version 2 added first_seen and last_seen to items.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, cachefile):
+        super().__init__(cachefile)
+        self.db = None
+
+    @staticmethod
+    def newcache(sitekeys=None):
+        """Open (creating if need be) the cache database,
+           back it up, and load it (or just the feeds in sitekeys)
+           into a new FeedmeSQLiteCache.
+        """
+        cachedir = FeedmeCache.get_cache_dir()
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        cache = FeedmeSQLiteCache(os.path.join(cachedir, "feedme.sqlite"))
+        cache.set_scope(sitekeys)
+        # Only one process should create or upgrade the database,
+        # or write the backup manifest.
+        with cache.locked():
+            cache.open_db()
+            cache.last_time = cache.get_meta('last_saved')
+            if cache.last_time:
+                cache.back_up()
+        cache.read_from_file(sitekeys)
+        return cache
+
+    def open_db(self):
+        """Connect to the database, creating the tables if needed."""
+        # Wait a while for other feedme processes to finish writing.
+        self.db = sqlite3.connect(self.filename, timeout=60)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        # With WAL, NORMAL is safe against corruption;
+        # a power failure might lose the last feed or so.
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == self.SCHEMA_VERSION:
+            return
+        if version > self.SCHEMA_VERSION:
+            raise RuntimeError("%s has unknown cache version %d"
+                               % (self.filename, version))
+
+        if version == 1:
+            # Before version 2, the feed's last_fed was the only time.
+            self.db.executescript("""
+                BEGIN;
+                ALTER TABLE items ADD COLUMN first_seen INTEGER;
+                ALTER TABLE items ADD COLUMN last_seen INTEGER;
+                UPDATE items SET (first_seen, last_seen) =
+                    (SELECT last_fed, last_fed FROM feeds
+                     WHERE feeds.url = items.feed);
+                PRAGMA user_version = 2;
+                COMMIT;
+            """)
+            return
+
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS feeds (
+                url TEXT PRIMARY KEY,
+                last_fed INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS items (
+                feed TEXT NOT NULL,
+                id TEXT NOT NULL,
+                first_seen INTEGER,
+                last_seen INTEGER,
+                PRIMARY KEY (feed, id));
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value);
+        """)
+        with self.db:
+            self.import_text_cache(os.path.join(os.path.dirname(self.filename),
+                                                "feedme.dat"))
+            self.db.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def import_text_cache(self, textfile):
+        """One-time migration from a text cache file.
+           The text file is left in place, untouched.
+        """
+        if not os.path.exists(textfile):
+            return
+        version, lines = FeedmeCache(textfile).read_lines()
+        nfeeds = 0
+        for line in lines:
+            parsed = FeedmeCache.parse_line(line, version)
+            if not parsed:
+                continue
+            sitekey, lastfed, entries = parsed
+            self.db.execute("INSERT OR REPLACE INTO feeds VALUES (?, ?)",
+                            (sitekey, lastfed))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO items VALUES (?, ?, ?, ?)",
+                ((sitekey, itemid, first, last)
+                 for itemid, first, last in entries))
+            nfeeds += 1
+        self.set_meta('last_saved', int(os.stat(textfile).st_mtime))
+        print("Imported %d feeds from %s into %s"
+              % (nfeeds, textfile, self.filename), file=sys.stderr)
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (key, value))
+
+    def read_from_file(self, sitekeys=None):
+        """Load the database into memory: all of it,
+           or if sitekeys is a list of feed URLs, just those feeds.
+        """
+        if sitekeys is None:
+            where, args = "", ()
+        else:
+            sitekeys = list(sitekeys)
+            where = " IN (%s)" % ','.join('?' * len(sitekeys))
+            where, args = " WHERE url" + where, sitekeys
+        entries = {}
+        for sitekey, lastfed in self.db.execute(
+                "SELECT url, last_fed FROM feeds" + where, args):
+            entries[sitekey] = []
+            self.last_fed[sitekey] = lastfed
+        for row in self.db.execute(
+                "SELECT feed, id, first_seen, last_seen FROM items"
+                + where.replace("url", "feed"), args):
+            entries[row[0]].append(row[1:])
+        for sitekey in entries:
+            self.thedict[sitekey] = SeenIDs(entries[sitekey])
+
+    def make_backup(self, manifest):
+        """Back up the database, using SQLite's online backup
+           so the copy is consistent even with a write-ahead log.
+        """
+        backupfile = self.backup_name(self.last_time)
+        print("Backing up cache file to", backupfile)
+        backup = sqlite3.connect(backupfile)
+        with backup:
+            self.db.backup(backup)
+        backup.close()
+        return { 'file': os.path.basename(backupfile) }
+
+    def save_to_file(self):
+        """Write whatever has changed since the last save,
+           one transaction per feed: the times of the ids that were
+           in the feed, and removing any that have expired.
+        """
+        now = int(time.time())
+        for sitekey in self.deleted:
+            with self.db:
+                self.db.execute("DELETE FROM items WHERE feed = ?", (sitekey,))
+                self.db.execute("DELETE FROM feeds WHERE url = ?", (sitekey,))
+        self.deleted.clear()
+
+        for sitekey in self.seen_ids:
+            seen = self.thedict[sitekey]
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO feeds VALUES (?, ?) ON CONFLICT (url) "
+                    "DO UPDATE SET last_fed = max(last_fed, excluded.last_fed)",
+                    (sitekey, self.last_fed.get(sitekey, 0)))
+                self.db.executemany(
+                    "INSERT INTO items VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (feed, id) DO UPDATE SET "
+                    "first_seen = min(first_seen, excluded.first_seen), "
+                    "last_seen = max(last_seen, excluded.last_seen)",
+                    ((sitekey, itemid) + seen.times(itemid)
+                     for itemid in self.seen_ids[sitekey]
+                     if itemid in seen))
+                if self.retention_days:
+                    self.db.execute(
+                        "DELETE FROM items WHERE feed = ? AND last_seen < ?",
+                        (sitekey,
+                         self.expiry_time(self.last_fed[sitekey])))
+                self.set_meta('last_saved', now)
+        self.seen_ids.clear()
+
+    def close(self):
+        if self.db:
+            self.save_to_file()
+            self.db.close()
+            self.db = None
+
+
+class FeedmeJournalCache(FeedmeCache):
+    """A FeedmeCache that, rather than rewriting feedme.dat after
+       every feed, appends a record for the feed to a journal,
+       feedme.journal, so each save only writes that feed's URLs.
+       Each record is a line like a v. 1 cache line,
+           siteurl|time|url url url ...
+       listing the URLs that were in the feed at that time,
+       or siteurl|-| if the feed was removed from the cache.
+       Loading reads feedme.dat then replays the journal over it;
+       once the journal is bigger than cache_journal_bytes,
+       it's compacted into a new feedme.dat.
+       Other feedme processes' records are never overwritten,
+       since each save only appends.
+    """
+    def __init__(self, cachefile):
+        super().__init__(cachefile)
+        self.journal = os.path.splitext(cachefile)[0] + ".journal"
+        if utils.g_config:
+            self.max_journal = utils.g_config.getint('DEFAULT',
+                                                     'cache_journal_bytes')
+        else:
+            self.max_journal = 1000000
+
+    @staticmethod
+    def newcache(sitekeys=None):
+        """Load feedme.dat and the journal, if any, (or just the feeds
+           in sitekeys) into a new FeedmeJournalCache, and back it up.
+        """
+        cachefile = os.path.join(FeedmeCache.get_cache_dir(), "feedme.dat")
+        dirname = os.path.dirname(cachefile)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        cache = FeedmeJournalCache(cachefile)
+        cache.set_scope(sitekeys)
+
+        mtimes = [ os.stat(f).st_mtime for f in (cachefile, cache.journal)
+                   if os.path.exists(f) ]
+        if mtimes:
+            cache.last_time = max(mtimes)
+            with cache.locked():
+                cache.read_from_file(sitekeys)
+                cache.back_up()
+                if cache.journal_size() > cache.max_journal:
+                    cache.compact()
+        return cache
+
+    def journal_size(self):
+        try:
+            return os.path.getsize(self.journal)
+        except FileNotFoundError:
+            return 0
+
+    def read_from_file(self, sitekeys=None):
+        """Read feedme.dat, then replay the journal.
+           If sitekeys is a list of feed URLs, only read those feeds.
+        """
+        if os.path.exists(self.filename):
+            super().read_from_file(sitekeys)
+
+        if sitekeys is not None:
+            wanted = set(map(FeedmeCache.id_encode, sitekeys))
+        for sitekey, when, urls in self.read_journal():
+            if sitekeys is not None and sitekey not in wanted:
+                continue
+            if when is None:
+                self.thedict.pop(sitekey, None)
+                self.last_fed.pop(sitekey, None)
+                continue
+            self.last_fed[sitekey] = when
+            if sitekey not in self.thedict:
+                self.thedict[sitekey] = SeenIDs()
+            self.thedict[sitekey].update(urls, when,
+                                         self.expiry_time(when)
+                                         if self.retention_days else None)
+
+    def read_journal(self):
+        """Generate (siteurl, time, [url, url, ...]) for each record
+           in the journal; time is None if the feed was removed.
+        """
+        try:
+            fp = open(self.journal, 'rb')
+        except FileNotFoundError:
+            return
+        with fp:
+            offset = 0
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # The last record was cut off, so ignore it
+                    # and get rid of it before appending any more.
+                    print("Ignoring incomplete journal record",
+                          file=sys.stderr)
+                    os.truncate(self.journal, offset)
+                    return
+                offset += len(line)
+                line = line.decode('utf-8', 'replace')
+                try:
+                    sitekey, when, urls = line.split('|')
+                    when = None if when == '-' else int(when)
+                except ValueError:
+                    print("Bad journal record: '%s'" % line.strip(),
+                          file=sys.stderr)
+                    continue
+                yield sitekey, when, urls.split()
+
+    def journal_ids(self):
+        """The URLs in the journal, in the form write_file() wants."""
+        new_ids = {}
+        for sitekey, when, urls in self.read_journal():
+            if when is None:
+                new_ids.pop(sitekey, None)
+            else:
+                new_ids.setdefault(sitekey, {}).update(dict.fromkeys(urls))
+        return new_ids
+
+    def make_backup(self, manifest):
+        """Back up feedme.dat by hard link, like the text cache,
+           and copy the journal next to it (it's appended to in place,
+           so it can't be linked), without parsing either of them.
+           Without a journal, that's just feedme.dat.
+           Returns the backup's manifest entry, or None if neither file
+           has changed since the last backup.
+        """
+        stamps = self.backup_stamps()
+        if manifest['backups'] and \
+           manifest['backups'][-1].get('stamps') == stamps:
+            return None
+        if not self.journal_size():
+            backup = super().make_backup(manifest)
+            if backup:
+                backup['stamps'] = stamps
+            return backup
+        backupfile = self.backup_name(self.last_time)
+        print("Backing up cache file to", backupfile)
+        if os.path.exists(self.filename):
+            self.link_backup(backupfile)
+        else:
+            with open(backupfile, "w") as fp:
+                print("FeedMe v.", FeedmeCache.FILE_VERSION, file=fp)
+        journalfile = backupfile + ".journal"
+        shutil.copy2(self.journal, journalfile)
+        return { 'file': os.path.basename(backupfile),
+                 'journal': os.path.basename(journalfile),
+                 'stamps': stamps }
+
+    def backup_stamps(self):
+        """[ mtime_ns, size ] of feedme.dat and of the journal,
+           None for either that doesn't exist, to tell whether
+           they've changed since they were last backed up.
+        """
+        stamps = []
+        for path in (self.filename, self.journal):
+            try:
+                st = os.stat(path)
+                stamps.append([ st.st_mtime_ns, st.st_size ])
+            except FileNotFoundError:
+                stamps.append(None)
+        return stamps
+
+    def compact(self):
+        """Fold the journal into a new feedme.dat, and remove it.
+           Other feedmes may have added to the journal since we read it,
+           so compact what's on disk, not what's in memory.
+        """
+        print("Compacting cache journal", file=sys.stderr)
+        ondisk = FeedmeJournalCache(self.filename)
+        ondisk.read_from_file()
+        ondisk.write_file(self.filename, ondisk.journal_ids())
+        os.unlink(self.journal)
+
+    def save_to_file(self):
+        """Append a record to the journal for each feed that's changed
+           since the last save, and compact the journal if it's too big.
+        """
+        if not self.seen_ids and not self.deleted:
+            return
+        with self.locked():
+            with open(self.journal, "a", encoding='utf-8') as fp:
+                for sitekey in self.deleted:
+                    fp.write("%s|-|\n" % FeedmeCache.id_encode(sitekey))
+                for sitekey in self.seen_ids:
+                    fp.write("%s|%d|%s\n"
+                             % (FeedmeCache.id_encode(sitekey),
+                                self.last_fed[sitekey],
+                                ' '.join(map(FeedmeCache.id_encode,
+                                             self.seen_ids[sitekey]))))
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            if self.journal_size() > self.max_journal:
+                self.compact()
+        self.deleted.clear()
+        self.seen_ids.clear()
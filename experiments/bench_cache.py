@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""Compare ways of holding the seen-ID cache in memory, on load time,
+   memory and lookup time, with a made-up cache of 100 feeds
+   with 1000 IDs each:
+     list:    the old list of URL strings per feed
+     dict:    a dict of URL strings -> [first, last] per feed
+     SeenIDs: 64-bit hashes in sorted arrays, what FeedmeCache uses now
+
+   Run from the top feedme directory:
+       python3 experiments/bench_cache.py [nfeeds [ids_per_feed]]
+"""
+
+import sys, os
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import FeedmeCache
+
+
+def write_cache(filename, nfeeds, nids):
+    """Write a made-up version 1.2 cache file."""
+    now = int(time.time())
+    with open(filename, 'w') as fp:
+        print("FeedMe v. 1.2", file=fp)
+        for f in range(nfeeds):
+            print("https://site%d.example.com/rss|%d|%s" % (
+                f, now, ' '.join(
+                    "https://site%d.example.com/2024/05/story-number-%d.html"
+                    " %d %d" % (f, i, now - i, now) for i in range(nids))),
+                  file=fp)
+
+
+def load_list(filename):
+    cache = {}
+    version, lines = FeedmeCache(filename).read_lines()
+    for line in lines:
+        key, lastfed, urls = line.split('|')
+        cache[key] = urls.split()[::3]
+    return cache
+
+
+def load_dict(filename):
+    cache = {}
+    version, lines = FeedmeCache(filename).read_lines()
+    for line in lines:
+        key, lastfed, entries = FeedmeCache.parse_line(line, version)
+        cache[key] = { url: [ first, last ] for url, first, last in entries }
+    return cache
+
+
+def load_seenids(filename):
+    cache = FeedmeCache(filename)
+    cache.read_from_file()
+    return cache.thedict
+
+
+def bench(name, loader, filename, lookups):
+    t0 = time.perf_counter()
+    cache = loader(filename)
+    load_time = time.perf_counter() - t0
+
+    # tracemalloc slows things down, so measure memory separately.
+    del cache
+    tracemalloc.start()
+    cache = loader(filename)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    t0 = time.perf_counter()
+    found = 0
+    for key, url in lookups:
+        if url in cache[key]:
+            found += 1
+    lookup_time = time.perf_counter() - t0
+
+    print("%-8s load %6.3f sec  %7.1f MB  %8.2f usec/lookup  (%d found)"
+          % (name, load_time, memory / 1e6,
+             lookup_time / len(lookups) * 1e6, found))
+
+
+if __name__ == '__main__':
+    nfeeds = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    nids = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'feedme.dat')
+        write_cache(filename, nfeeds, nids)
+        print("%d feeds, %d IDs each, cache file %d bytes"
+              % (nfeeds, nids, os.path.getsize(filename)))
+
+        # What get_feed() does: look up every story in a feed,
+        # most of them already seen, some new.
+        lookups = []
+        for f in range(nfeeds):
+            key = "https://site%d.example.com/rss" % f
+            for i in range(0, nids + nids // 10, 10):
+                lookups.append((key, "https://site%d.example.com/2024/05/"
+                                "story-number-%d.html" % (f, i)))
+
+        # The list lookup is so slow it would take all day
+        # with a big cache, so give it fewer.
+        bench("list", load_list, filename, lookups[::10])
+        bench("dict", load_dict, filename, lookups)
+        bench("SeenIDs", load_seenids, filename, lookups)
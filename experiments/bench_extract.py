@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Compare the page_start/page_end regexp path with automatic content
+   extraction, on time and output size, by running fetch_url() on a
+   saved page with a siteconf file.
+
+   Run from the top feedme directory:
+       python3 experiments/bench_extract.py [siteconf htmlfile [repeats]]
+   e.g.
+       python3 experiments/bench_extract.py siteconf/wired.conf \
+           test/samples/wired-orig.html 5
+"""
+
+import sys, os
+import shutil
+import tempfile
+import time
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+import pageparser
+
+
+def fetch(confdir, outdir, feedname, htmlfile, settings):
+    """Fetch htmlfile with the given settings.
+       Return (seconds, output size in bytes).
+    """
+    utils.read_config_file(confdir=confdir)
+    for key in settings:
+        utils.g_config.set(feedname, key, settings[key])
+
+    parser = pageparser.FeedmeHTMLParser(feedname)
+    t0 = time.perf_counter()
+    # Images can't be fetched from a saved page, so there's a lot of noise.
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stderr(devnull):
+            parser.fetch_url('file://' + htmlfile, outdir, '0.html')
+    elapsed = time.perf_counter() - t0
+    return elapsed, os.path.getsize(os.path.join(outdir, '0.html'))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        siteconf, htmlfile = sys.argv[1:3]
+    else:
+        siteconf, htmlfile = 'siteconf/wired.conf', \
+            'test/samples/wired-orig.html'
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    tmpdir = tempfile.mkdtemp()
+    confdir = os.path.join(tmpdir, 'config')
+    outdir = os.path.join(tmpdir, 'out')
+    os.mkdir(confdir)
+    os.mkdir(outdir)
+    shutil.copy('test/config/feedme.conf', confdir)
+    shutil.copy(siteconf, confdir)
+
+    utils.read_config_file(confdir=confdir)
+    feedname = [ s for s in utils.g_config.sections() ][0]
+
+    whole_page = { 'page_start': '', 'page_end': '' }
+    tests = [
+        ("page_start/page_end", {}),
+        ("whole page", whole_page),
+        ("extract_content", dict(whole_page, extract_content='true')),
+    ]
+
+    print("%s, %s: best of %d" % (feedname, htmlfile, repeats))
+    try:
+        for name, settings in tests:
+            best = None
+            for i in range(repeats):
+                elapsed, size = fetch(confdir, outdir, feedname, htmlfile,
+                                      settings)
+                if best is None or elapsed < best:
+                    best = elapsed
+            print("%-20s %8.4f sec  %8d bytes" % (name, best, size))
+    finally:
+        shutil.rmtree(tmpdir)
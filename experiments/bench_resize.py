@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""Compare ways of shrinking a big image to max_image_size,
+   on time and peak memory: a full decode and resize, as feedme
+   used to do, and imagecache.downscale(), which uses JPEG draft mode
+   and Image.reduce().
+
+   Each run is in a separate process so its peak memory can be measured.
+
+   Run from the top feedme directory:
+       python3 experiments/bench_resize.py [imagefile [maxsize [repeats]]]
+   With no image file, it makes 5328x3996 JPEG and PNG test images.
+"""
+
+import sys, os
+import subprocess
+import resource
+import tempfile
+import shutil
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+
+def new_size(size, maxsize):
+    width, height = size
+    if width >= height:
+        return maxsize, height * maxsize // width
+    return width * maxsize // height, maxsize
+
+
+def peak_memory():
+    """Peak resident memory of this process in KB.
+       Linux's VmHWM starts fresh in each new program; ru_maxrss may
+       include the parent's peak from before the fork.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def shrink(method, imgfile, maxsize):
+    """Shrink imgfile and save it as a JPEG, in this process.
+       Return (seconds, extra peak memory in KB).
+    """
+    import imagecache
+
+    outfile = os.path.join(os.path.dirname(imgfile), 'out.jpg')
+    startmem = peak_memory()
+    t0 = time.perf_counter()
+
+    im = Image.open(imgfile)
+    newsize = new_size(im.size, maxsize)
+    if method == 'resize':
+        im = im.resize(newsize)
+    else:
+        im = imagecache.downscale(im, newsize)
+    im.convert('RGB').save(outfile)
+
+    elapsed = time.perf_counter() - t0
+    return elapsed, peak_memory() - startmem
+
+
+def run(method, imgfile, maxsize):
+    """Run shrink() in a new process."""
+    out = subprocess.check_output([ sys.executable, __file__, '--one',
+                                    method, imgfile, str(maxsize) ])
+    elapsed, mem = out.split()
+    return float(elapsed), int(mem)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--one':
+        elapsed, mem = shrink(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        print(elapsed, mem)
+        sys.exit(0)
+
+    maxsize = int(sys.argv[2]) if len(sys.argv) > 2 else 1200
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if len(sys.argv) > 1:
+            imgfiles = [ sys.argv[1] ]
+        else:
+            # Something with detail, so the encoders have work to do.
+            im = Image.radial_gradient('L').resize((5328, 3996))
+            im = Image.merge('RGB',
+                             (im, im.transpose(Image.Transpose.ROTATE_180),
+                              im))
+            imgfiles = []
+            for ext in ('jpg', 'png'):
+                imgfile = os.path.join(tmpdir, 'big.' + ext)
+                im.save(imgfile)
+                imgfiles.append(imgfile)
+
+        for imgfile in imgfiles:
+            with Image.open(imgfile) as im:
+                print("%s: %s %dx%d to %d, best of %d"
+                      % (os.path.basename(imgfile), im.format,
+                         im.size[0], im.size[1], maxsize, repeats))
+            for method in ('resize', 'downscale'):
+                results = [ run(method, imgfile, maxsize)
+                            for i in range(repeats) ]
+                print("  %-10s %8.3f sec  %8d KB peak"
+                      % (method, min(r[0] for r in results),
+                         min(r[1] for r in results)))
+    finally:
+        shutil.rmtree(tmpdir)
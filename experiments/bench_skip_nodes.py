@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Time skip_nodes the old way (re-parse the HTML, one find_all per
+   nodespec, re-serialize) against the compiled single pass
+   over the already-parsed tree.
+
+   Run from the top feedme directory:
+       python3 experiments/bench_skip_nodes.py [htmlfile] [repeats]
+"""
+
+import sys, os
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from siteprofile import SkipNodes, SKIP_NODE_PAT
+import pageparser
+
+
+# A plausible set for a busy news site, mostly old-style.
+NODESPECS = [
+    'div class="sticky-box"',
+    'div class="newsletter"',
+    'div class="ad-"',
+    'aside class="related"',
+    'section class="comments"',
+    'div class="social-share"',
+    'span class="byline-share"',
+    'svg class="icon"',
+    'nav class="^nav"',
+    'div class="paywall"',
+    'figure class="video"',
+    'div class="recirc"',
+    'div class="outbrain"',
+    'div class="taboola"',
+    'button class="."',
+    'div id="cookie"',
+    'aside[data-ad]',
+    'div.consent-banner',
+    'figure > .newsletter',
+    'footer nav',
+]
+
+
+def old_delete_skipped_nodes(html, nodespecs):
+    """What delete_skipped_nodes used to do, minus the printing."""
+    soup = BeautifulSoup(html, "lxml")
+    changed = False
+    for nodespec in nodespecs:
+        try:
+            nodename, attrname, attrval = \
+                re.match(SKIP_NODE_PAT, nodespec).groups()
+            attrval = re.compile(attrval)
+            for node in soup.find_all(nodename,
+                                      attrs={ attrname: attrval }):
+                node.decompose()
+                changed = True
+        except Exception:
+            continue
+    if changed:
+        html = str(soup)
+    return BeautifulSoup(html, "lxml")
+
+
+def new_skip_nodes(html, skip_nodes):
+    soup = BeautifulSoup(html, "lxml")
+    pageparser.remove_skipped_nodes(soup, skip_nodes)
+    return soup
+
+
+def best_time(fn, repeats):
+    best = None
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == '__main__':
+    htmlfile = sys.argv[1] if len(sys.argv) > 1 \
+        else 'test/samples/wired-orig.html'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with open(htmlfile, encoding='utf-8') as fp:
+        html = fp.read()
+
+    t0 = time.perf_counter()
+    skip_nodes = SkipNodes('bench', NODESPECS)
+    compiletime = time.perf_counter() - t0
+
+    parsetime = best_time(lambda: BeautifulSoup(html, "lxml"), repeats)
+    oldtime = best_time(lambda: old_delete_skipped_nodes(html, NODESPECS),
+                        repeats)
+    newtime = best_time(lambda: new_skip_nodes(html, skip_nodes), repeats)
+
+    print("%s: %d bytes, %d nodespecs, best of %d"
+          % (htmlfile, len(html), len(NODESPECS), repeats))
+    print("Compiling skip_nodes:          %8.4f sec" % compiletime)
+    print("Parse only:                    %8.4f sec" % parsetime)
+    print("Old (re-parse, find_all each): %8.4f sec" % oldtime)
+    print("New (single pass):             %8.4f sec" % newtime)
+    print("skip_nodes overhead: old %.4f, new %.4f"
+          % (oldtime - parsetime, newtime - parsetime))
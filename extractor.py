@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""Find the main content of a web page without any site-specific
+   patterns, in the spirit of Arc90's Readability:
+   score each block of text by its length and punctuation,
+   credit the scores to the containers the text is in,
+   and keep the container that scores best.
+
+   This works on an lxml tree, which is much faster to build than
+   a BeautifulSoup tree, so the rest of handle_html() only has to
+   deal with the article rather than the whole page.
+"""
+
+import sys
+import re
+
+import lxml.html
+
+
+# Class and id names that suggest content, or suggest junk.
+POSITIVE_RE = re.compile(
+    r'article|body|content|entry|hentry|main|page|post|story|text|blog',
+    flags=re.IGNORECASE)
+NEGATIVE_RE = re.compile(
+    r'banner|breadcrumb|combx|comment|community|disqus|extra|foot|header'
+    r'|masthead|menu|modal|nav|newsletter|outbrain|pagination|popup|promo'
+    r'|related|remark|rss|share|shoutbox|sidebar|skyscraper|social'
+    r'|sponsor|subscribe|taboola|tags|tool|widget',
+    flags=re.IGNORECASE)
+
+# Starting scores for containers, by tag.
+TAG_SCORES = {
+    "article": 10,
+    "div": 5,
+    "section": 3, "main": 3, "pre": 3, "td": 3, "blockquote": 3,
+    "address": -3, "ol": -3, "ul": -3, "dl": -3, "dd": -3, "dt": -3,
+    "li": -3, "form": -3,
+    "aside": -5, "nav": -5, "footer": -5, "header": -5,
+    "h1": -5, "h2": -5, "h3": -5, "h4": -5, "h5": -5, "h6": -5, "th": -5,
+}
+
+# Elements whose text counts towards their containers' scores.
+TEXT_TAGS = ("p", "pre", "td", "blockquote")
+
+# How far up the tree each block of text contributes to scores.
+ANCESTOR_LEVELS = 5
+
+# Text shorter than this isn't worth scoring.
+MIN_TEXT_LEN = 25
+
+# If the best candidate has less text than this, give up:
+# the page probably isn't an article.
+MIN_ARTICLE_LEN = 250
+
+# How many of the top-scoring candidates to check for link density.
+NUM_CANDIDATES = 10
+
+
+def class_weight(el):
+    """Score an element by whether its class and id look like content."""
+    weight = 0
+    for name in (el.get("class"), el.get("id")):
+        if not name:
+            continue
+        if NEGATIVE_RE.search(name):
+            weight -= 25
+        if POSITIVE_RE.search(name):
+            weight += 25
+    return weight
+
+
+def link_density(el, textlen=None):
+    """What fraction of an element's text is inside links?"""
+    if textlen is None:
+        textlen = len(el.text_content())
+    if not textlen:
+        return 0
+    linklen = sum(len(a.text_content()) for a in el.iter("a"))
+    return linklen / textlen
+
+
+def prose_length(el):
+    """How much of an element's text is in paragraphs long enough
+       to have been scored?
+    """
+    total = 0
+    for p in el.iter("p", "pre"):
+        textlen = len(p.text_content())
+        if textlen >= MIN_TEXT_LEN:
+            total += textlen
+    return total
+
+
+def find_main_content(doc):
+    """Given an lxml document, return a list of the elements that make up
+       its main content: the best-scoring container, plus any siblings
+       that look like they're part of the same article.
+       Returns None if nothing looks like an article.
+    """
+    scores = {}
+
+    def add_score(el, score):
+        if el not in scores:
+            if not isinstance(el.tag, str):
+                return
+            scores[el] = TAG_SCORES.get(el.tag, 0) + class_weight(el)
+        scores[el] += score
+
+    # One pass over the text blocks, crediting each one's score
+    # to its parent, half to its grandparent, and smaller shares
+    # further up, so an article split into several chunks can still
+    # win as a whole.
+    for el in doc.iter(*TEXT_TAGS):
+        text = el.text_content()
+        textlen = len(text.strip())
+        if textlen < MIN_TEXT_LEN:
+            continue
+        score = 1 + text.count(',') + min(textlen // 100, 3)
+
+        ancestor = el.getparent()
+        for level in range(ANCESTOR_LEVELS):
+            if ancestor is None:
+                break
+            if level == 0:
+                add_score(ancestor, score)
+            elif level == 1:
+                add_score(ancestor, score / 2)
+            else:
+                add_score(ancestor, score / (level * 3))
+            ancestor = ancestor.getparent()
+
+    if not scores:
+        return None
+
+    # Containers full of links are navigation, not content.
+    best = None
+    best_score = 0
+    candidates = sorted(scores, key=scores.get, reverse=True)
+    for el in candidates[:NUM_CANDIDATES]:
+        score = scores[el] * (1 - link_density(el))
+        if best is None or score > best_score:
+            best = el
+            best_score = score
+
+    # An article split into chunks (e.g. around ads) may have one chunk
+    # that scores better than the whole. Use the highest nearby ancestor
+    # where what's added is mostly more paragraphs, not links or widgets.
+    textlen = len(best.text_content())
+    prose = prose_length(best)
+    ancestor = best.getparent()
+    for level in range(ANCESTOR_LEVELS):
+        if ancestor is None or ancestor.tag in ("body", "html") \
+           or class_weight(ancestor) < 0:
+            break
+        ancestor_textlen = len(ancestor.text_content())
+        added = ancestor_textlen - textlen
+        if added <= 0 or \
+           ((prose_length(ancestor) - prose) / added >= .5
+            and link_density(ancestor, ancestor_textlen) <= .25):
+            best = ancestor
+        ancestor = ancestor.getparent()
+
+    if len(best.text_content().strip()) < MIN_ARTICLE_LEN:
+        return None
+
+    # Articles are sometimes split among several siblings,
+    # e.g. around an ad or a pull quote.
+    parent = best.getparent()
+    if parent is None:
+        return [ best ]
+
+    threshold = max(10, best_score * .2)
+    content = []
+    for sibling in parent:
+        if sibling is best:
+            content.append(sibling)
+        elif sibling in scores and scores[sibling] >= threshold:
+            content.append(sibling)
+        elif sibling.tag == "p":
+            text = sibling.text_content()
+            if len(text) > 80 and link_density(sibling, len(text)) < .25:
+                content.append(sibling)
+    return content
+
+
+def extract_content(html, verbose=False):
+    """Return just the main content of an HTML page, as HTML,
+       or None if it couldn't be found.
+    """
+    try:
+        doc = lxml.html.document_fromstring(html)
+    except Exception as e:
+        print("Couldn't parse page to extract content:", e, file=sys.stderr)
+        return None
+
+    content = find_main_content(doc)
+    if not content:
+        if verbose:
+            print("Couldn't find the main content", file=sys.stderr)
+        return None
+
+    # Keep any <base href>: handle_html needs it to make links absolute.
+    parts = []
+    base = doc.find(".//base")
+    if base is not None and base.get("href"):
+        parts.append(lxml.html.tostring(base, encoding="unicode",
+                                        with_tail=False))
+
+    for el in content:
+        if verbose:
+            print("Keeping <%s class='%s' id='%s'>"
+                  % (el.tag, el.get("class", ""), el.get("id", "")),
+                  file=sys.stderr)
+        parts.append(lxml.html.tostring(el, encoding="unicode",
+                                        with_tail=False))
+
+    return "<html><body>\n%s\n</body></html>" % '\n'.join(parts)
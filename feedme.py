@@ -116,8 +116,9 @@ import pageparser
 from tee import tee
 import msglog
 
-from cache import FeedmeCache
+from cache import FeedmeCache, lock_file
 from utils import falls_between, last_time_this_feed, expanduser
+from siteprofile import get_profile
 
 # Rewriting image URLs to local ones
 import imagecache
@@ -171,6 +172,9 @@ def clean_up():
         for f in os.listdir(dirname):
             # Files never to delete:
             if f in ['feedme.dat', 'feeds.css', 'darkfeeds.css',
+                     'feedme.sqlite', 'feedme.sqlite-wal',
+                     'feedme.sqlite-shm', 'feedme.journal',
+                     'feedme.lock', 'feedme.running', 'backups.json',
                      'LOG', 'urlrss.log' ]:
                 continue
 
@@ -198,6 +202,9 @@ def clean_up():
     clean_up_dir(feedsdir, True)
     clean_up_dir(cachedir, False)
 
+    # Now some images in the image store may not be used any more.
+    imagecache.clean_up_store(days)
+
 #
 # Ctrl-C Interrupt handler: prompt for what to do.
 #
@@ -270,6 +277,8 @@ def get_feed(feedname, cache, last_time, msglog):
 
     verbose = (utils.g_config.get("DEFAULT", 'verbose').lower() == 'true')
 
+    imagecache.clear()
+
     # Mandatory arguments:
     try:
         sitefeedurl = utils.g_config.get(feedname, 'url')
@@ -321,21 +330,24 @@ def get_feed(feedname, cache, last_time, msglog):
         msglog.err("Can't find a config for: " + feedname)
         return
 
-    verbose = (utils.g_config.get(feedname, 'verbose').lower() == 'true')
-    levels = float(utils.g_config.get(feedname, 'levels'))
+    # All the per-feed config values, looked up once.
+    profile = get_profile(feedname)
+
+    verbose = profile.verbose
+    levels = profile.levels
 
     feedsdir = expanduser(feedsdir)
     todaystr = time.strftime("%m-%d-%a")
     feedsdir = os.path.join(feedsdir, todaystr)
 
-    formats = utils.g_config.get(feedname, 'formats').split(',')
-    encoding = utils.g_config.get(feedname, 'encoding')
-    ascii = utils.g_config.getboolean(feedname, 'ascii')
-    skip_links = utils.g_config.getboolean(feedname, 'skip_links')
-    skip_link_pats = utils.g_config.get_multiline(feedname, 'skip_link_pats')
-    skip_title_pats = utils.g_config.get_multiline(feedname, 'skip_title_pats')
+    formats = profile.formats
+    encoding = profile.encoding
+    ascii = profile.ascii
+    skip_links = profile.skip_links
+    skip_link_pats = profile.skip_link_pats
+    skip_title_pats = profile.skip_title_pats
 
-    user_agent = utils.g_config.get(feedname, 'user_agent')
+    user_agent = profile.user_agent
 
     if verbose:
         print("\n=============\nGetting %s feed" % feedname, file=sys.stderr)
@@ -362,12 +374,12 @@ def get_feed(feedname, cache, last_time, msglog):
     # Make sure the link is at least some minimum width.
     # This is for viewers that have special areas defined on the
     # screen, e.g. areas for paging up/down or adjusting brightness.
-    minwidth = utils.g_config.getint(feedname, 'min_width')
+    minwidth = profile.min_width
 
     if cache is None:
         nocache = True
     else:
-        nocache = (utils.g_config.get(feedname, 'nocache') == 'true')
+        nocache = profile.nocache
     if verbose and nocache:
         msglog.msg(feedname + ": Ignoring cache")
 
@@ -598,7 +610,7 @@ def get_feed(feedname, cache, last_time, msglog):
     feedcachedict = []
     if cache and not nocache:
         try:
-            feedcachedict = cache.thedict[sitefeedurl]
+            feedcachedict = cache[sitefeedurl]
         except:
             feedcachedict = []
     newfeedcachedict = []
@@ -639,12 +651,9 @@ def get_feed(feedname, cache, last_time, msglog):
     next_item_string =  '<br>\n<center><i><a href=\"#%d\">&gt;-&gt;</a></i></center>\n<br>\n'
     next_item_pattern = '<br>\n<center><i><a href=\"#[0-9]+\">&gt;-&gt;</a></i></center>\n<br>\n'
 
-    try:
-        urlrewrite = utils.g_config.get_multiline(feedname, 'story_url_rewrite')
-        if urlrewrite:
-            print("**** urlrewrite:", urlrewrite, file=sys.stderr)
-    except:
-        urlrewrite = None
+    urlrewrite = profile.story_url_rewrite
+    if urlrewrite:
+        print("**** urlrewrite:", urlrewrite, file=sys.stderr)
 
     days = int(utils.g_config.get('DEFAULT', 'save_days'))
     too_old = time.time() - days * 60 * 60 * 24
@@ -704,11 +713,12 @@ def get_feed(feedname, cache, last_time, msglog):
             if skip_link_pats:
                 skipping = False
                 for spat in skip_link_pats:
-                    if re.search(spat, item_link):
+                    if spat.search(item_link):
                         skipping = True
                         if verbose:
                             print("Skipping", item_link, \
-                                "because it matches", spat, file=sys.stderr)
+                                "because it matches", spat.pattern,
+                                  file=sys.stderr)
                         break
                 if skipping:
                     continue
@@ -717,12 +727,13 @@ def get_feed(feedname, cache, last_time, msglog):
             item_title = str(item.title)
             if skip_title_pats:
                 skipping = False
+                # skip_title_pats are compiled with re.IGNORECASE.
                 for pat in skip_title_pats:
-                    if re.search(pat, item_title, flags=re.IGNORECASE):
+                    if pat.search(item_title):
                         skipping = True
                         if verbose:
                             print("Skipping", item_link, \
-                                  "because of skip_title_pats " + pat,
+                                  "because of skip_title_pats " + pat.pattern,
                                   file=sys.stderr)
                         break
                 if skipping:
@@ -781,8 +792,7 @@ def get_feed(feedname, cache, last_time, msglog):
             # But on other sites, like the Los Alamos Daily Post Legal Notices,
             # titles can be as simple as "LEGAL NOTICE" and are often dups,
             # but the actual stories/links are different.
-            if item.title in titles and not utils.g_config.getboolean(
-                    feedname, 'allow_dup_titles'):
+            if item.title in titles and not profile.allow_dup_titles:
                 print('Skipping repeated title with a new ID: "%s", ID "%s"' \
                       % (item.title, item_id), file=sys.stderr)
                 continue
@@ -819,26 +829,27 @@ def get_feed(feedname, cache, last_time, msglog):
                     # be new: a site might have a static URL for the
                     # monthly photo contest that gets updated once
                     # a month with all-new content.
-                    if not utils.g_config.getboolean(feedname, 'allow_repeats'):
+                    if not profile.allow_repeats:
                         if verbose:
                             print(item_id, "already cached -- skipping",
                                   file=sys.stderr)
                         continue
 
-                    # Repeats are allowed. So check the pub date.
-                    # XXX Unfortunately cache entries don't include
-                    # a date, so for now, allow repeat URLs if their
-                    # content was updated since the last feedme run.
-                    # This will unfortunately miss sites that
-                    # aren't checked every day.
+                    # Repeats are allowed. So check the pub date:
+                    # re-fetch only if the content was updated since
+                    # the last time this URL was in the feed.
+                    first_seen, last_seen = cache.item_times(sitefeedurl,
+                                                             item_id)
                     if verbose:
                         print("Seen this before, but repeats are allowed")
-                        print("Last time this feed", last_fed_this)
+                        print("Last seen in the feed", last_seen)
                         print("pub_date", pub_date)
-                        if pub_date <= last_fed_this:
+                    if not pub_date or pub_date <= last_seen:
+                        if verbose:
                             print("No new changes, skipping")
-                            continue
-                        print("Recent change, re-fetching", file=sys.stderr)
+                        continue
+                    print("Recent change, re-fetching", item_id,
+                          file=sys.stderr)
 
                 elif verbose:
                     print("'%s' is not in the cache -- fetching" % item_id,
@@ -1030,8 +1041,7 @@ def get_feed(feedname, cache, last_time, msglog):
                     indexstr += '<p>Socket timeout for <a href="%s">%s</a>\n' \
                                 % (item_link, item_title)
 
-                    if utils.g_config.get(feedname,
-                                          'continue_on_timeout') == 'true':
+                    if profile.continue_on_timeout:
                         continue
                     break
 
@@ -1042,8 +1052,7 @@ def get_feed(feedname, cache, last_time, msglog):
                         errmsg += item_title
                         errmsg += "\n"
                         indexstr += "<p>" + errmsg
-                        if utils.g_config.get(feedname,
-                                      'continue_on_timeout') == 'true':
+                        if profile.continue_on_timeout:
                             errmsg += "continue_on_timeout is true"
                             msglog.err(errmsg)
                             continue
@@ -1201,13 +1210,13 @@ Which (default = s): """)
                 content = "[No content]"
 
             # Sites that put too much formatting crap in the RSS:
-            if utils.g_config.getboolean(feedname, 'simplify_rss'):
+            if profile.simplify_rss:
                 content = pageparser.simplify_html(content) + " ... "
 
             # There's an increasing trend to load up RSS pages with images.
             # Try to remove them if skip_images is true,
             # as well as any links that contain only an image.
-            if utils.g_config.getboolean(feedname, 'skip_images'):
+            if profile.skip_images:
                 # XXX Rewrite to use parser rather than re
                 content = re.sub('<a [^>]*href=.*> *<img .*?></a>', '', content)
                 content = re.sub('<img .*?>', '', content)
@@ -1232,18 +1241,17 @@ Which (default = s): """)
             # Skip any text specified in index_skip_content_pats.
             # Some sites (*cough* Pro Publica *cough*) do weird things
             # like putting huge <style> sections in the RSS.
-            index_skip_pats = utils.g_config.get_multiline(feedname,
-                                                   'index_skip_content_pats')
-            for pat in index_skip_pats:
-                content = re.sub(pat, '', content)
-                author = re.sub(pat, '', author)
+            for pat in profile.index_skip_content_pats:
+                content = pat.sub('', content)
+                if author:
+                    author = pat.sub('', author)
 
             # Some sites put the entire story in the description,
             # sometimes with a lot of formatting crap that tends to
             # make the text unreadable (color or font size).
             # If entrysize is specified, strip all the crap and
             # limit total length.
-            entrysize = int(utils.g_config.get(feedname, 'rss_entry_size'))
+            entrysize = profile.rss_entry_size
             if entrysize:
                 content = content[:entrysize]
 
@@ -1453,6 +1461,11 @@ Which (default = n): """)
     elif verbose:
         print("No pages written", file=sys.stderr)
 
+    # Add any statistics, like bytes saved, to the run summary.
+    stats = utils.feed_stats_summary(feedname)
+    if stats:
+        msglog.msg("%s: %s" % (feedname, stats))
+
     if verbose:
         print("Done fetching feed", feedname, datetime.now(), file=sys.stderr)
 
@@ -1544,12 +1557,32 @@ share and enjoy under the GPL v2 or later."""
             print("%-25s %s" % (feedname, utils.g_config.get(feedname, 'url')))
         sys.exit(0)
 
+    # Only one run of all the feeds at a time (urlrss checks this too).
+    # Runs of particular feeds can go alongside, since the cache is locked
+    # while it's being read or written.
+    if not options.feeds:
+        cachedir = FeedmeCache.get_cache_dir()
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        full_run_lock = lock_file(os.path.join(cachedir, 'feedme.running'),
+                                  block=False)
+        if not full_run_lock:
+            print("Another feedme is already fetching all the feeds. Exiting.",
+                  file=sys.stderr)
+            sys.exit(1)
+
     if options.nocache:
         cache = None
         last_time = None
     else:
         try:
-            cache = FeedmeCache.newcache()
+            # For particular feeds, only load their part of the cache.
+            sitekeys = None
+            if options.feeds:
+                sitekeys = [ utils.g_config.get(feedname, 'url')
+                             for feedname in options.feeds
+                             if utils.g_config.has_section(feedname) ]
+            cache = FeedmeCache.newcache(sitekeys)
         except Exception as e:
             # I don't know what causes a pickle error,
             # but cPickle.BadPickleGet can happen
@@ -1581,23 +1614,22 @@ Use -N to re-load all previously cached stories and reinitialize the cache.
     outputlog = open(logfilename, "w", buffering=1, encoding='utf-8')
     sys.stderr = tee(stderrsav, outputlog)
 
-    # Remove any obsolete feeds, no longer in the cnnfig file, from the cache.
-    if cache and len(cache):
-        feeds_to_remove = []
-        for feedurl in cache:
-            found = False
-            for feedname in sections:
-                if feedurl == utils.g_config.get(feedname, 'url'):
-                    found = True
-                    break
-            if not found:
-                feeds_to_remove.append(feedurl)
-
-        for feedurl in feeds_to_remove:
+    # Remove any obsolete feeds, no longer in the config file, from the cache.
+    # Only on a full run: otherwise most of the cache isn't loaded.
+    if cache and len(cache) and not options.feeds:
+        feedurls = { utils.g_config.get(feedname, 'url')
+                     for feedname in sections }
+        for feedurl in sorted(set(cache.keys()) - feedurls):
             print(feedurl, "is obsolete, will delete from cache",
                   file=sys.stderr)
             del cache[feedurl]
 
+    # With defer_images, get the text of all the feeds first,
+    # then the images.
+    defer_images = utils.g_config.getboolean('DEFAULT', 'defer_images')
+    if defer_images:
+        imagecache.start_deferring()
+
     #
     # Actually get the feeds.
     #
@@ -1637,6 +1669,31 @@ Use -N to re-load all previously cached stories and reinitialize the cache.
         # print(e, file=sys.stderr)
         # sys.exit(e.errno)
 
+    if defer_images:
+        try:
+            deferred_feeds = imagecache.fetch_deferred_images(
+                time_budget=utils.g_config.getint('DEFAULT',
+                                                  'image_time_budget'),
+                byte_budget=utils.g_config.getint('DEFAULT',
+                                                  'image_byte_budget'),
+                nthreads=utils.g_config.getint('DEFAULT',
+                                               'image_fetch_threads'))
+            for feedname in deferred_feeds:
+                msglog.msg("%s, with images: %s"
+                           % (feedname, utils.feed_stats_summary(feedname)))
+        except KeyboardInterrupt:
+            print("Interrupted while fetching images", file=sys.stderr)
+        except Exception as e:
+            print("Error fetching deferred images:", e, file=sys.stderr)
+            utils.ptraceback()
+
+    # Save what we learned about images, even after an interrupt.
+    imagecache.save_index()
+    imagecache.shutdown_transform_pool()
+
+    if cache:
+        cache.close()
+
     try:
         # Close the log file before trying to rename it (needed on Windows)
         if platform.system() == 'Windows':
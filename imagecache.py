@@ -8,12 +8,26 @@
 """
 
 import utils
+from siteprofile import get_profile
+from cache import FeedmeCache
 
 import re
+from html import escape
 import urllib.request, urllib.parse, urllib.error
 from bs4 import BeautifulSoup
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageSequence, UnidentifiedImageError
 from datetime import datetime
+import concurrent.futures
+import multiprocessing
+import contextlib
+import signal
+import threading
+import hashlib
+import base64
+import json
+import io
+import shutil
+import time
 import sys, os
 
 
@@ -22,12 +36,78 @@ ImageCache = {}
 
 
 # Known image extensions:
-KNOWN_EXTENSIONS = [ '.jpeg', '.png', '.gif', '.svg' ]
+KNOWN_EXTENSIONS = [ '.jpg', '.jpeg', '.png', '.gif', '.svg', '.webp', '.avif' ]
+
+# Formats images can be converted to, in image_formats:
+# name: (PIL format, extension, options always used when saving)
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', '.jpg', { 'optimize': True, 'progressive': True }),
+    'jpg': ('JPEG', '.jpg', { 'optimize': True, 'progressive': True }),
+    # WebP's slowest method only saves a few percent more.
+    'webp': ('WEBP', '.webp', { 'method': 4 }),
+    'avif': ('AVIF', '.avif', {}),
+}
+
+# Feed settings that affect what an image ends up as:
+# a change in any of these means images have to be fetched again.
+IMAGE_SETTINGS = ( 'max_image_size', 'png_to_jpg',
+                   'max_image_bytes', 'min_image_size',
+                   'image_formats', 'image_quality', 'image_target_bytes',
+                   'strip_image_metadata',
+                   'animated_images', 'max_animation_bytes' )
+
+# Lowest quality to go down to when trying to meet image_target_bytes.
+MIN_TARGET_QUALITY = 25
+
+# Images whose perceptual hashes differ in no more than this many
+# of their 64 bits are taken to be the same picture.
+PHASH_DISTANCE = 4
+
+# With defer_images, image jobs waiting for the image phase at the end
+# of the run, in the order they should be fetched; None if images
+# are being fetched as pages are parsed.
+g_deferred = None
+g_deferred_lock = threading.Lock()
+
+# Deferred images are marked in the HTML with this attribute,
+# whose value is "token-index": a token made fresh for each run
+# (so tags left behind by an earlier, interrupted run aren't mistaken
+# for this run's), and the job's index in g_deferred.
+DEFERRED_ATTR = "data-feedme-img"
+g_deferred_token = None
+
+# Jobs being fetched right now, by imgpathname, so that two pages
+# (which may be fetched at the same time) never work on the same file
+# at once: a job for a file that's already being fetched waits for
+# that one and shares its results.
+g_inflight = {}
+g_inflight_lock = threading.Lock()
+
+# Perceptual hashes of the images fetched for the current feed, for
+# dedup_images: { newdir: [ (phash, (width, height), imgfilename), ... ] }
+g_phashes = {}
+g_phash_lock = threading.Lock()
+
+# When shrinking big images, first shrink them cheaply (JPEGs while
+# decoding, others with Image.reduce()) to no less than this many times
+# the final size, then resample the rest of the way. This is what
+# PIL's Image.thumbnail() does, and 2 is its default.
+REDUCING_GAP = 2.0
+
+# How much of an image to read before deciding whether to fetch the rest:
+# enough for the headers of most images, so PIL can tell the size.
+SNIFF_BYTES = 16 * 1024
+
+# Longest local image filename to use: most filesystems allow 255,
+# and this leaves room for temporary suffixes.
+MAX_FILENAME_LEN = 200
 
 
 def clear():
     """Clear the image cache, when starting a new site"""
-    ImageCache = {}
+    ImageCache.clear()
+    with g_phash_lock:
+        g_phashes.clear()
 
 
 def rewrite_images(html, baseurl, outdir, feedname, host=None):
@@ -38,29 +118,329 @@ def rewrite_images(html, baseurl, outdir, feedname, host=None):
 
     soup = BeautifulSoup(html, "lxml")
     print("Starting image rewriting at", datetime.now(), file=sys.stderr)
-    for img in soup.find_all("img"):
-        process_img_tag(img, feedname, baseurl, outdir, host=host)
+    process_img_tags(soup.find_all("img"), feedname, baseurl, outdir,
+                     host=host)
     print("Finished image rewriting at", datetime.now(), file=sys.stderr)
     return str(soup)
 
 
+class ImageJob(object):
+    """One image to fetch for a page, and what became of it.
+       Several tags with the same src share a single job.
+    """
+    def __init__(self, src, alt_src, request, imgpathname):
+        self.src = src
+        self.alt_src = alt_src
+        self.request = request
+        self.imgpathname = imgpathname
+        self.tags = []
+
+        # Results, set by fetch_image():
+        # the local filename to use as the new src (None if we don't have one)
+        self.imgfilename = None
+        # (width, height) if the image was resized
+        self.newsize = None
+        # Replace the image with a link to the original?
+        self.make_link = False
+        # Remove the image entirely (e.g. it's a tracking pixel)?
+        self.drop = False
+        # Perceptual hash of the final image, if PIL could read it
+        self.phash = None
+        # The feed, if the job has been deferred to the image phase
+        self.feedname = None
+        # Was the local file made for this job (not already there)?
+        self.created = False
+        # The image as a data: URI, if it's small enough to inline
+        self.data_uri = None
+        # The final (width, height) and transparency, if PIL could read it
+        self.size = None
+        self.transparent = None
+        # Another job, for the same file, whose results this one shares
+        self.shared = None
+        # An Event that's set if the page no longer wants the image
+        self.cancel = None
+        # Set once fetch_image() is done with the job
+        self.done = threading.Event()
+
+
+def process_img_tags(tags, feedname, base_href, newdir, host=None,
+                     cancel=None):
+    """Process a page's worth of img tags (BeautifulSoup) in three phases:
+       first work out which image each tag needs, then fetch and
+       transcode all of them concurrently (but only once per src),
+       then rewrite the tags to point to the local copies.
+       Tags are modified in place.
+       cancel is an optional Event: once it's set, no more images
+       are fetched for the page (even if they were deferred).
+    """
+    profile = get_profile(feedname)
+
+    jobs = {}
+    numtags = 0
+    for tag in tags:
+        try:
+            plan = prepare_img_tag(tag, feedname, base_href, newdir, host)
+        except Exception as e:
+            print("Error handling image tag", tag, ":", e, file=sys.stderr)
+            utils.ptraceback()
+            continue
+        if not plan:
+            continue
+        src, alt_src, request, imgpathname = plan
+        if src not in jobs:
+            jobs[src] = ImageJob(src, alt_src, request, imgpathname)
+            jobs[src].cancel = cancel
+        jobs[src].tags.append(tag)
+        numtags += 1
+
+    if not jobs:
+        return
+
+    if numtags > len(jobs):
+        utils.add_stat(feedname, "repeated images coalesced",
+                       numtags - len(jobs))
+
+    if deferring(profile):
+        defer_image_jobs(jobs.values(), feedname)
+        return
+
+    nthreads = min(profile.image_fetch_threads, len(jobs))
+    if nthreads > 1:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=nthreads) as executor:
+            # list() to wait for them all
+            list(executor.map(lambda job: fetch_image(job, feedname),
+                              jobs.values()))
+    else:
+        for job in jobs.values():
+            fetch_image(job, feedname)
+
+    inlined = set()
+    for job in jobs.values():
+        apply_image_job(job, profile, inlined)
+    remove_files(inlined)
+
+
+def deferring(profile):
+    """Should this feed's images wait for the image phase?
+       Not if other formats will be made from the HTML right away.
+    """
+    return g_deferred is not None \
+        and not any(fmt in profile.formats
+                    for fmt in ('plucker', 'fb2', 'epub'))
+
+
+def start_deferring():
+    """From now on, have process_img_tags() leave images for
+       fetch_deferred_images(), at the end of the run.
+    """
+    global g_deferred, g_deferred_token
+    with g_deferred_lock:
+        g_deferred = []
+        g_deferred_token = os.urandom(4).hex()
+
+
+def defer_image_jobs(jobs, feedname):
+    """Mark the jobs' tags so they can be found in the written HTML,
+       and queue them for fetch_deferred_images().
+       Until then, the tags point to alt_src, as if the fetch had failed.
+    """
+    with g_deferred_lock:
+        for job in jobs:
+            job.feedname = feedname
+            for tag in job.tags:
+                tag.attrs[DEFERRED_ATTR] = "%s-%d" % (g_deferred_token,
+                                                      len(g_deferred))
+                tag.attrs['src'] = job.alt_src
+            # The tags will be written out and thrown away.
+            job.tags = []
+            g_deferred.append(job)
+            utils.add_stat(feedname, "images deferred", 1)
+
+
+def fetch_deferred_images(time_budget=0, byte_budget=0, nthreads=4):
+    """The image phase: fetch images that were deferred while fetching
+       text, in the order they were found (so in feed order),
+       until time_budget seconds or byte_budget bytes of images
+       have been used (0 means no limit). Then patch the HTML files
+       to use them, or to link to any that didn't make it.
+       Returns the names of the feeds that had deferred images.
+    """
+    global g_deferred
+
+    with g_deferred_lock:
+        jobs = g_deferred
+        token = g_deferred_token
+        g_deferred = None
+    if not jobs:
+        return []
+
+    print("Fetching %d deferred images" % len(jobs), file=sys.stderr)
+    start = time.time()
+    deadline = start + time_budget if time_budget else None
+    spent = [ 0 ]
+    spent_lock = threading.Lock()
+
+    def fetch(job):
+        if (deadline and time.time() > deadline) \
+           or (byte_budget and spent[0] >= byte_budget):
+            job.make_link = True
+            utils.add_stat(job.feedname, "deferred images over budget", 1)
+            return
+        fetch_image(job, job.feedname)
+        if job.imgfilename and not job.make_link:
+            try:
+                size = os.path.getsize(os.path.join(
+                    os.path.dirname(job.imgpathname), job.imgfilename))
+            except OSError:
+                return
+            with spent_lock:
+                spent[0] += size
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(nthreads, 1)) as executor:
+        list(executor.map(fetch, jobs))
+
+    newdirs = set(os.path.dirname(job.imgpathname) for job in jobs)
+    for newdir in newdirs:
+        try:
+            filenames = os.listdir(newdir)
+        except OSError as e:
+            print("Couldn't patch images in", newdir, ":", e,
+                  file=sys.stderr)
+            continue
+        for filename in filenames:
+            if not filename.endswith('.html'):
+                continue
+            # One bad file shouldn't leave all the rest unpatched.
+            try:
+                patch_deferred_images(os.path.join(newdir, filename),
+                                      jobs, token)
+            except Exception as e:
+                print("Error patching images in", filename, ":", e,
+                      file=sys.stderr)
+                utils.ptraceback()
+    print("Image phase used %d bytes in %.1f seconds"
+          % (spent[0], time.time() - start), file=sys.stderr)
+
+    feednames = []
+    for job in jobs:
+        if job.feedname not in feednames:
+            feednames.append(job.feedname)
+    return feednames
+
+
+def patch_deferred_images(filename, jobs, token):
+    """Rewrite the deferred img tags in an HTML file
+       according to their jobs. Nothing else in the file changes,
+       not even the parts of the tags that don't need to:
+       only the attributes that change are rewritten.
+       Tags marked with some other run's token are left alone.
+    """
+    # Pages are written in their site's encoding. Latin-1 gives back
+    # exactly the same bytes, whatever that was.
+    with open(filename, encoding='latin-1') as fp:
+        html = fp.read()
+    if DEFERRED_ATTR not in html:
+        return
+
+    inlined = set()
+
+    def patch_tag(match):
+        tagtoken, _, index = match.group(1).partition('-')
+        if tagtoken != token or not index.isdigit() \
+           or int(index) >= len(jobs):
+            return match.group(0)
+        job = jobs[int(index)]
+        tagtext = match.group(0)
+        # Let apply_image_job() work out what the tag should be,
+        # then make just those changes to the original text.
+        tag = BeautifulSoup(tagtext, "html.parser").find("img")
+        if not tag:
+            return tagtext
+        oldattrs = dict(tag.attrs)
+        job.tags = [ tag ]
+        apply_image_job(job, get_profile(job.feedname), inlined)
+        if job.drop:
+            return ''
+
+        tagtext = set_tag_attr(tagtext, DEFERRED_ATTR, None)
+        for attr in ('src', 'width', 'height'):
+            if tag.attrs.get(attr) != oldattrs.get(attr):
+                tagtext = set_tag_attr(tagtext, attr, tag.attrs.get(attr))
+        if job.make_link:
+            tagtext += '<a href="%s"> [nonlocal image]</a>' \
+                % attr_text(job.src)
+        return tagtext
+
+    html = re.sub(r'<img\b[^>]*\b%s="([^"]*)"[^>]*>' % DEFERRED_ATTR,
+                  patch_tag, html)
+    tmpfile = filename + '.part'
+    with open(tmpfile, 'w', encoding='latin-1') as fp:
+        fp.write(html)
+    os.replace(tmpfile, filename)
+    remove_files(inlined)
+
+
+def attr_text(value):
+    """Quote an attribute value for HTML in any encoding:
+       anything that isn't ASCII becomes a character reference.
+    """
+    return escape(value, quote=True).encode(
+        'ascii', 'xmlcharrefreplace').decode('ascii')
+
+
+# One attribute in an HTML start tag, with any value,
+# so that nothing inside a quoted value is mistaken for an attribute.
+TAG_ATTR_RE = re.compile(r"""\s+([^\s"'=/>]+)(\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?""")
+
+
+def set_tag_attr(tagtext, attr, value):
+    """Set attr to value in the text of an HTML start tag,
+       or remove it if value is None, leaving the rest as it was.
+    """
+    newattr = '' if value is None else ' %s="%s"' % (attr, attr_text(value))
+    found = []
+
+    def replace_attr(match):
+        if found or match.group(1).lower() != attr:
+            return match.group(0)
+        found.append(match.group(1))
+        return newattr
+
+    namelen = re.match(r'<[^\s/>]*', tagtext).end()
+    tagtext = tagtext[:namelen] + TAG_ATTR_RE.sub(replace_attr,
+                                                  tagtext[namelen:])
+    if found or not newattr:
+        return tagtext
+    end = len(tagtext) - (2 if tagtext.endswith('/>') else 1)
+    return tagtext[:end].rstrip() + newattr + tagtext[end:]
+
+
 def process_img_tag(tag, feedname, base_href, newdir, host=None):
-    """Process an img tag (BeautifulSoup) and its attributes.
+    """Process a single img tag: see process_img_tags()."""
+    process_img_tags([ tag ], feedname, base_href, newdir, host=host)
+
+
+def prepare_img_tag(tag, feedname, base_href, newdir, host=None):
+    """Look at an img tag (BeautifulSoup) and its attributes to decide
+       what image to fetch for it.
        Try to detect stand-ins for src, like srcset and various
        weirdo wordpress plugin attributes.
 
-       Download a local copy of the image (if not already downloaded),
-       and set the tag to point to it.
-
        Arguments:
-         tag: the img tag, which will be modified in place
+         tag: the img tag, which may be modified in place
          feedname: the name of the current feed
          base_href: the href from which we'll get the host
          host: if there's a need to override the host in base_href
          newdir: the local directory in which this site is being written
+
+       Returns (src, alt_src, request, imgpathname) if the image should
+       be fetched, otherwise None (after making any changes to the tag).
     """
     print("\nProcessing image", tag, "at", datetime.now(), file=sys.stderr)
 
+    profile = get_profile(feedname)
     attrs = tag.attrs
     keys = list(attrs.keys())
 
@@ -77,74 +457,44 @@ def process_img_tag(tag, feedname, base_href, newdir, host=None):
     else:
         src = None
 
-    if 'srcset' in keys or 'data-lazy-srcset' in keys:
-        # The intent here:
-        # If there's a srcset, pick the largest one that's still
-        # under max_srcset_size, and set src to that.
-        # That's what we'll try to download.
-        # Then remove the srcset attribute.
-        try:
-            maximgwidth = int(utils.g_config.get(feedname, 'max_srcset_size'))
-        except:
-            maximgwidth = 800
-
-        # ladailypost (which I think is wordpress) has a crazy setup
-        # where they set the src to something that isn't an image,
-        # then have data-lazy-src and/or data-lazy-srcset
-        # which presumably get loaded later with JavaScript.
-        if 'data-lazy-srcset' in attrs:
-            srcset = parse_srcset(attrs['data-lazy-srcset'])
-        elif 'srcset' in attrs:
-            srcset = parse_srcset(attrs['srcset'])
-        else:
-            srcset = None
-
-        if srcset:
-            try:
-                curimg = None
-                curwidth = 0
-                for pair in srcset:
-                    w = pair[1].strip().lower()
-                    if not w.endswith('w'):
-                        # It probably ends in x and is a resolution-based
-                        # descriptor. We don't handle those yet,
-                        # but just in case we don't see any width-based
-                        # ones, let's save the image.
-                        if not curimg:
-                            curimg = pair[0].strip()
-                        continue
-                    w = int(w[:-1])
-                    if w > curwidth and w <= maximgwidth:
-                        curwidth = w
-                        curimg = pair[0].strip()
-                if curimg:
-                    src = curimg
-            except:
-                # Wired sometimes has srcset with just a single url
-                # that's the same as the src=. In that case it
-                # wouldn't do us any good anyway.
-                # They also have srcSet="".
-                # And there are all sorts of nutty and random things
-                # sites do with srcset.
-                print("Error parsing srcset: '%s'" % str(srcset),
-                      file=sys.stderr)
-                pass
+    # If there's a srcset (or a <picture> with sources), pick the
+    # smallest image that will still look sharp on our device,
+    # and set src to that. That's what we'll try to download.
+    srcset_src = choose_srcset_src(tag, profile)
+    if srcset_src:
+        src = srcset_src
 
     if not src:
         # Don't do anything to this image, it has no src or srcset.
-        return
-
-    if 'srcset' in keys:
-        del tag.attrs['srcset']
+        return None
+
+    # Spacers and tracking pixels often say how small they are:
+    # don't bother fetching them.
+    if is_tiny(tag, profile.min_image_size):
+        print("Dropping tiny image", src, file=sys.stderr)
+        utils.add_stat(feedname, "tiny images dropped", 1)
+        tag.decompose()
+        return None
+
+    # Then remove the srcset, and any <picture> sources, so the reader
+    # won't fetch them from the web instead of using our local copy.
+    for attr in ('srcset', 'sizes'):
+        if attr in keys:
+            del tag.attrs[attr]
+    picture = tag.find_parent('picture')
+    if picture:
+        # lxml doesn't know <source> is empty, so it may contain the img.
+        for source in picture.find_all('source'):
+            source.unwrap()
 
     # Make relative URLs absolute
     if src.startswith("data:"):
         # With a data: url we already have all we need
-        return
+        return None
     src = make_absolute(src, base_href)
     if not src:
         print("make_absolute returned null", file=sys.stderr)
-        return
+        return None
 
     # urllib2 can't parse out the host part without first
     # creating a Request object.
@@ -157,23 +507,14 @@ def process_img_tag(tag, feedname, base_href, newdir, host=None):
     # lareporter has a new Wordpress plugin that puts images on i0.wp.com
     # with a bunch more characters that now need not to be quoted:
     req = urllib.request.Request(urllib.parse.quote(src, safe=':/?=&%'))
-    user_agent = utils.g_config.get(feedname, 'user_agent')
-    req.add_header('User-Agent', user_agent)
+    req.add_header('User-Agent', profile.user_agent)
 
     # Should we only fetch images that come from the HTML's host?
-    try:
-        nonlocal_images = utils.g_config.getboolean(feedname, 'nonlocal_images')
-    except:
-        nonlocal_images = False
+    nonlocal_images = profile.nonlocal_images
 
     # Should we rewrite images that come from elsewhere,
     # to avoid unwanted data use?
-    try:
-        block_nonlocal = utils.g_config.getboolean(feedname,
-                                                   'block_nonlocal_images')
-    except Exception as e:
-        block_nonlocal = False
-        print("Not blocking nonlocal images because of", e, file=sys.stderr)
+    block_nonlocal = profile.block_nonlocal_images
 
     # If we can't or won't download an image, what should
     # we replace it with?
@@ -189,251 +530,1119 @@ def process_img_tag(tag, feedname, base_href, newdir, host=None):
         # print("Allowing nonlocal (external) image sources", file=sys.stderr)
         alt_src = src
 
-    alt_domains = utils.g_config.get_multiline(feedname, 'alt_domains')
-    if nonlocal_images or similar_host(req.host, host, alt_domains):
-        # imgfilename = os.path.basename(src)
-        # For now, don't take the basename; we want to know
-        # if images are unique, and the basename alone
-        # can't tell us that.
-        imgfilename = src.replace('/', '_')
-        # Clean up the filename, since it might have illegal chars.
-        # Only allow alphanumerics or others in a short whitelist.
-        # Don't allow % in the whitelist -- it causes problems
-        # with recursively copying the files over http later.
-        imgfilename = ''.join([x for x in imgfilename
-                               if x.isalpha() or x.isdigit()
-                               or x in '-_.'])
-        if not imgfilename : imgfilename = '_unknown.img'
-        imgpathname = os.path.join(newdir, imgfilename)
-
-        # Some sites, like High Country News, use the same image
-        # name for everything (e.g. they'll have
-        # storyname-0418-jpg/image, storyname-0418-jpg/image etc.)
-        # so we can't assume that just because the basename is unique,
-        # the image must be.
-        # if os.path.exists(imgpathname) and \
-        #    src not in ImageCache:
-        #     howmany = 2
-        #     while True:
-        #         newimgfile = "%d-%s" % (howmany, imgpathname)
-        #         if not os.path.exists(newimgfile):
-        #             imgpathname = newimgfile
-        #             break
-        #         howmany += 1
-        # But we don't need this clause if we use the whole image path,
-        # not just the basename.
-
-        # Check again for a data: URL, in case it came in
-        # from one of the src substitutions.
-        # If so, output it and return.
-        if src.startswith("data:"):
-            return
+    if not nonlocal_images and \
+       not similar_host(req.host, host, profile.alt_domains):
+        # Looks like it's probably a nonlocal image, don't download
+        print(req.host, "and", host,
+              "are too different -- not fetching image", src,
+              file=sys.stderr)
 
-        try:
-            if not os.path.exists(imgpathname):
-                print("Fetching image", src, "to", imgpathname,
-                      file=sys.stderr)
-                # urllib.request.urlopen is supposed to have
-                # a default timeout, but if so, it must be
-                # many minutes. Try this instead.
-                # Timeout is in seconds, but it doesn't work at all.
-                f = urllib.request.urlopen(req, timeout=8)
-                # Lots of things can go wrong with downloading
-                # the image, such as exceptions.IOError from
-                # [Errno 36] File name too long
-                try:
-                    local_file = open(imgpathname, "wb")
-                except OSError as e:
-                    if e.errno != 36:
-                        raise e
-                    print("Filename too long:", imgpathname, file=sys.stderr)
-                    pathmax = os.pathconf('/', 'PC_PATH_MAX')
-                    while imgpathname >= pathmax:
-                        # chop stuff off the front
-                        imgfilename = imgfilename[int(len(imgfilename)/3):]
-                        imgpathname = os.path.join(newdir, imgfilename)
-                    local_file = open(imgpathname, "wb")
-                    print("Trying", imgpathname, "instead", file=sys.stderr)
-
-                # Write to our local file
-                local_file.write(f.read())
-                local_file.close()
-            #else:
-            #    print("Not downloading, already have", imgpathname)
-
-        # handle download errors
-        except urllib.error.HTTPError as e:
-            print("HTTP Error on image:", e.code,
-                  "on", src, ": setting img src to", alt_src,
+        replace_img_with_link(tag, src, alt_src)
+        return None
+
+    # imgfilename = os.path.basename(src)
+    # For now, don't take the basename; we want to know
+    # if images are unique, and the basename alone
+    # can't tell us that.
+    imgfilename = src.replace('/', '_')
+    # Clean up the filename, since it might have illegal chars.
+    # Only allow alphanumerics or others in a short whitelist.
+    # Don't allow % in the whitelist -- it causes problems
+    # with recursively copying the files over http later.
+    imgfilename = ''.join([x for x in imgfilename
+                           if x.isalpha() or x.isdigit()
+                           or x in '-_.'])
+    if not imgfilename : imgfilename = '_unknown.img'
+    # Very long URLs make filenames too long for the filesystem
+    # ([Errno 36] File name too long): chop stuff off the front.
+    if len(imgfilename) > MAX_FILENAME_LEN:
+        imgfilename = imgfilename[-MAX_FILENAME_LEN:]
+
+    # Some sites, like High Country News, use the same image
+    # name for everything (e.g. they'll have
+    # storyname-0418-jpg/image, storyname-0418-jpg/image etc.)
+    # so we can't assume that just because the basename is unique,
+    # the image must be. That's why we use the whole image path,
+    # not just the basename.
+    return src, alt_src, req, os.path.join(newdir, imgfilename)
+
+
+def fetch_image(job, feedname):
+    """Download and, if needed, resize or convert the image for an
+       ImageJob, setting the job's results.
+       If another job is already fetching the same file,
+       wait for it and share its results instead.
+       Runs in a worker thread, so it mustn't touch any tags.
+    """
+    if job.cancel and job.cancel.is_set():
+        # Nobody wants it now: don't leave files behind.
+        return
+
+    with g_inflight_lock:
+        leader = g_inflight.get(job.imgpathname)
+        if not leader:
+            g_inflight[job.imgpathname] = job
+
+    if leader:
+        leader.done.wait()
+        job.shared = leader
+        for attr in ('imgfilename', 'newsize', 'make_link', 'drop',
+                     'phash', 'size', 'transparent'):
+            setattr(job, attr, getattr(leader, attr))
+        utils.add_stat(feedname, "repeated images coalesced", 1)
+        job.done.set()
+        return
+
+    try:
+        fetch_one_image(job, feedname)
+    finally:
+        with g_inflight_lock:
+            del g_inflight[job.imgpathname]
+        job.done.set()
+
+
+def fetch_one_image(job, feedname):
+    """Do the work of fetch_image() for a job."""
+    profile = get_profile(feedname)
+    src = job.src
+    imgpathname = job.imgpathname
+    newdir, imgfilename = os.path.split(imgpathname)
+
+    # Has this image already been fetched, by an earlier story
+    # or on an earlier day or for another feed?
+    key = store_url_key(src, profile)
+    if use_index_entry(job, key, profile, newdir):
+        utils.add_stat(feedname, "images from index", 1)
+        return
+
+    downloaded = False
+    try:
+        if not os.path.exists(imgpathname):
+            downloaded = True
+            print("Fetching image", src, "to", imgpathname,
                   file=sys.stderr)
-            # Since we couldn't download, point instead to the
-            # absolute URL, so it will at least work with a
-            # live net connection.
-            tag.attrs['src'] = alt_src
-        except urllib.error.URLError as e:
-            print("URL Error on image:", e.reason,
-                  "on", src, file=sys.stderr)
-            tag.attrs['src'] = alt_src
-        except Exception as e:
-            print("Error downloading image:", str(e), \
-                "on", src, file=sys.stderr)
-            utils.ptraceback()
-            tag.attrs['src'] = alt_src
+            # urllib.request.urlopen is supposed to have
+            # a default timeout, but if so, it must be
+            # many minutes. Try this instead.
+            # Timeout is in seconds, but it doesn't work at all.
+            f = urllib.request.urlopen(job.request, timeout=8)
+            try:
+                data = read_image(f, job, profile, feedname)
+            finally:
+                f.close()
+            if data is None:
+                # It's too big or too small to keep.
+                index_set(key, index_entry(job, newdir, None))
+                return
+            if job.cancel and job.cancel.is_set():
+                return
+
+            # Write to our local file. Another page of the same story
+            # may be fetching the same image at the same time,
+            # so write it under a temporary name first.
+            tmppathname = "%s.%d.part" % (imgpathname,
+                                          threading.get_ident())
+            with open(tmppathname, "wb") as local_file:
+                local_file.write(data)
+            os.replace(tmppathname, imgpathname)
+        #else:
+        #    print("Not downloading, already have", imgpathname)
+
+    # handle download errors.
+    # Since we couldn't download, the tags will point to alt_src instead.
+    except urllib.error.HTTPError as e:
+        print("HTTP Error on image:", e.code,
+              "on", src, ": setting img src to", job.alt_src,
+              file=sys.stderr)
+        return
+    except urllib.error.URLError as e:
+        print("URL Error on image:", e.reason,
+              "on", src, file=sys.stderr)
+        return
+    except Exception as e:
+        print("Error downloading image:", str(e), \
+            "on", src, file=sys.stderr)
+        utils.ptraceback()
+        return
 
-        # If we got this far, then we have a local image.
+    # If we got this far, then we have a local image.
+    job.imgfilename = imgfilename
+    job.created = downloaded
+    try:
+        bytes_before = os.path.getsize(imgpathname)
+        utils.add_stat(feedname, "image bytes before", bytes_before)
+    except OSError:
+        bytes_before = 0
 
-        # Are we resizing large images? Some sites have crazy-big
-        # images, like 5328 x 3996, which make no sense whatsoever
-        # to view on a phone.
+    try:
+        settings = { name: getattr(profile, name) for name in IMAGE_SETTINGS }
+        result, cputime, output = run_transform(src, newdir, imgfilename,
+                                                settings)
+        sys.stderr.write(output)
+        utils.add_stat(feedname, "image transform CPU seconds", cputime)
+        job.imgfilename = result.imgfilename
+        job.newsize = result.newsize
+        job.make_link = result.make_link
+        job.size = result.size
+        job.transparent = result.transparent
+        job.phash = result.phash
+        if result.frames > 1:
+            utils.add_stat(feedname, "animations", 1)
+            utils.add_stat(feedname, "animation frames", result.frames)
+            if not job.make_link:
+                utils.add_stat(feedname, "animation bytes saved",
+                               bytes_before - os.path.getsize(
+                                   os.path.join(newdir, job.imgfilename)))
+    except Exception as e:
+        # Use the image as it is.
+        print("Error processing image", imgpathname, ":", e,
+              file=sys.stderr)
+        utils.ptraceback()
+
+    # The same picture may already be here under a different URL.
+    # Only remove a file fetched just now: pages from an earlier run
+    # may use a file that was already here.
+    dup = None
+    # Images that will be inlined don't take part: their files go away.
+    if profile.dedup_images and downloaded and not job.make_link \
+       and job.phash is not None \
+       and not inline_type(os.path.join(newdir, job.imgfilename), profile):
+        dup = find_duplicate(newdir, job)
+        if dup:
+            dup_pathname = os.path.join(newdir, job.imgfilename)
+            print("Image", src, "looks the same as", dup, file=sys.stderr)
+            utils.add_stat(feedname, "duplicate images", 1)
+            try:
+                utils.add_stat(feedname, "duplicate image bytes saved",
+                               os.path.getsize(dup_pathname))
+                os.unlink(dup_pathname)
+            except OSError:
+                pass
+            job.imgfilename = dup
+            job.created = False
+
+    if not job.make_link and not dup:
         try:
-            maxsize = int(utils.g_config.get(feedname, 'max_image_size'))
+            utils.add_stat(feedname, "image bytes after",
+                           os.path.getsize(os.path.join(newdir,
+                                                        job.imgfilename)))
+        except OSError:
+            pass
+
+    storename = None
+    if profile.image_store and not job.make_link:
+        try:
+            storename = store_add(newdir, job.imgfilename)
+        except OSError as e:
+            print("Couldn't add", job.imgfilename, "to the image store:", e,
+                  file=sys.stderr)
+
+    index_set(key, index_entry(job, newdir, storename))
+
+
+def is_tiny(tag, min_size):
+    """Do an img tag's width and height attributes say it's no more than
+       min_size pixels each way? Only plain numbers (or Npx) count:
+       percentages and the like don't say how big the image is.
+    """
+    if not min_size:
+        return False
+    dims = []
+    for attr in ('width', 'height'):
+        val = tag.attrs.get(attr)
+        if val is None:
+            continue
+        val = val.strip().lower()
+        if val.endswith('px'):
+            val = val[:-2]
+        if not val.isdigit():
+            return False
+        dims.append(int(val))
+    return bool(dims) and max(dims) <= min_size
+
+
+def sniff_size(data):
+    """Given the start of an image file, return its (width, height)
+       if PIL can tell from the header, else None.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            return im.size
+    except Exception:
+        return None
+
+
+def sniff_animated(data):
+    """Does the start of an image file say it's an animation?
+       Not all animated GIFs say so up front, but most have a
+       looping extension before the first frame.
+    """
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return b'NETSCAPE2.0' in data
+    if data[:4] == b'RIFF' and data[8:16] == b'WEBPVP8X':
+        return len(data) > 20 and bool(data[20] & 0x02)
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        idat = data.find(b'IDAT')
+        return b'acTL' in (data[:idat] if idat >= 0 else data)
+    return False
+
+
+def read_image(f, job, profile, feedname):
+    """Read an image from an open URL, but stop early if it's bigger
+       than max_image_bytes (setting job.make_link) or its header
+       says it's a tiny tracker or icon (setting job.drop).
+       Returns the image data, or None if we stopped early.
+    """
+    maxbytes = profile.max_image_bytes
+
+    try:
+        length = int(f.headers.get('Content-Length'))
+    except (TypeError, ValueError, AttributeError):
+        length = None
+    if maxbytes and length and length > maxbytes:
+        print("Not fetching", job.src, ": it's", length, "bytes",
+              file=sys.stderr)
+        utils.add_stat(feedname, "oversized images not fetched", 1)
+        job.make_link = True
+        return None
+
+    data = f.read(SNIFF_BYTES)
+    if profile.animated_images == 'link' and sniff_animated(data):
+        print("Not fetching animation", job.src, file=sys.stderr)
+        utils.add_stat(feedname, "animations", 1)
+        job.make_link = True
+        return None
+
+    size = sniff_size(data)
+    if size and profile.min_image_size \
+       and max(size) <= profile.min_image_size:
+        print("Dropping %dx%d image" % size, job.src, file=sys.stderr)
+        utils.add_stat(feedname, "tiny images dropped", 1)
+        job.drop = True
+        return None
+
+    # No Content-Length, or it was wrong: count as we go.
+    chunks = [ data ]
+    total = len(data)
+    while True:
+        chunk = f.read(SNIFF_BYTES * 4)
+        if not chunk:
+            break
+        total += len(chunk)
+        if maxbytes and total > maxbytes:
+            print("Stopped fetching", job.src, "after", total, "bytes",
+                  file=sys.stderr)
+            utils.add_stat(feedname, "oversized images not fetched", 1)
+            job.make_link = True
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+#
+# Resizing and converting images is CPU-bound, so it runs in a pool
+# of processes (image_processes in the DEFAULT section; 0 means
+# in the fetching thread), shared by all feeds for the whole run.
+# A fetching thread waits for its image's transform, but only a few
+# transforms per process can be waiting at once; beyond that,
+# fetching threads wait before they submit, rather than piling up
+# downloaded images faster than they can be converted.
+#
+g_transform_pool = None
+g_transform_slots = None
+g_transform_pool_lock = threading.Lock()
 
-        except Exception as e:
-            print("Exception", e, "checking maxsize")
-            utils.ptraceback()
-            maxsize = 0
 
-        # Does the image need to be changed, because it's too big
-        # in pixel size or file size?
-        if maxsize and imgpathname and os.path.exists(imgpathname):
-            imchanged = False
+class ImageTransform(object):
+    """What transcode_image() did to an image: small enough to send
+       back from a worker process.
+    """
+    def __init__(self, src, imgfilename):
+        self.src = src
+        self.imgfilename = imgfilename
+        self.newsize = None
+        self.make_link = False
+        self.size = None
+        self.transparent = None
+        self.phash = None
+        # Number of frames, if it's an animation
+        self.frames = 1
+
+
+def ignore_interrupts():
+    """Let the main process decide what ^C means, not the workers."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_transform_pool():
+    """Return the process pool for image transforms, starting it
+       if needed, or None if transforms should run in the calling thread.
+    """
+    global g_transform_pool, g_transform_slots
+
+    with g_transform_pool_lock:
+        if g_transform_pool:
+            return g_transform_pool
+        try:
+            nprocs = utils.g_config.getint('DEFAULT', 'image_processes')
+        except ValueError:
+            nprocs = 0
+        if nprocs <= 0:
+            return None
+        # Don't fork a process that's running threads.
+        g_transform_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=nprocs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=ignore_interrupts)
+        g_transform_slots = threading.BoundedSemaphore(nprocs * 2)
+        return g_transform_pool
+
+
+def shutdown_transform_pool():
+    """Stop the image transform processes, at the end of a run."""
+    global g_transform_pool
+
+    with g_transform_pool_lock:
+        if g_transform_pool:
+            g_transform_pool.shutdown()
+            g_transform_pool = None
+
+
+def transform_in_worker(src, newdir, imgfilename, settings):
+    """Run transcode_image() in a worker process.
+       Returns (ImageTransform, CPU seconds, what it printed),
+       since the worker's output wouldn't otherwise reach the log file.
+    """
+    result = ImageTransform(src, imgfilename)
+    output = io.StringIO()
+    t0 = time.process_time()
+    with contextlib.redirect_stderr(output), \
+         contextlib.redirect_stdout(output):
+        transcode_image(result, newdir, imgfilename, settings)
+    return result, time.process_time() - t0, output.getvalue()
+
+
+def run_transform(src, newdir, imgfilename, settings):
+    """Resize or convert an image, in the process pool if there is one.
+       Returns (ImageTransform, CPU seconds, what it printed).
+    """
+    global g_transform_pool
+
+    pool = get_transform_pool()
+    if pool:
+        with g_transform_slots:
             try:
-                im = Image.open(imgpathname)
-
-            except UnidentifiedImageError:
-                # Image might be SVG or some other non-PIL type
-                print("PIL Unknown image type, can't resize",
-                      imgpathname, file=sys.stderr)
-
-                # Allow all SVGs, don't try to resize them
-                if imgpathname.lower().endswith(".svg"):
-                    print("Allowing SVG", imgpathname, file=sys.stderr)
-                    return
-
-                # If it's not a PNG, how big is it?
-                # If it's not too big, keep it.
-                filesize = os.stat(imgpathname).st_size    # size in bytes
-                if filesize < 1024*512:    # XXX hardwired, make configurable
-                    print("PIL can't handle", imgpathname,
-                          "but it's not that big, allowing anyway",
-                          file=sys.stderr)
-                else:
-                    # Make a link to the nonlocal image
-                    print("PIL can't handle", src,
-                          "and it's big: making a link to it",
-                          file=sys.stderr)
-                    replace_img_with_link(tag, src, alt_src)
-                    return
-
-            oldwidth, oldheight = im.size
-            if max(oldwidth, oldheight) > maxsize:
-                if oldwidth >= oldheight:    # landscape
-                    newwidth = maxsize
-                    newheight = oldheight * maxsize // oldwidth
-                else:                        # portrait
-                    newheight = maxsize
-                    newwidth = oldwidth * maxsize // oldheight
-                print("Resizing %dx%d image to %dx%d" % (oldwidth,
-                                                         oldheight,
-                                                         newwidth,
-                                                         newheight),
-                      file=sys.stderr)
-                # This may set image.format to None
-                im = im.resize((newwidth, newheight))
-                imchanged = True
-
-                # Change the tag's width and height attributes, if any
-                if 'width' in tag.attrs:
-                    print("Rewriting tag width from %s (%s) to %s"
-                          % (tag.attrs['width'],
-                             type(tag.attrs['width']),
-                             newwidth), file=sys.stderr)
-                    tag.attrs['width'] = str(newwidth)
-                if 'height' in tag.attrs:
-                    print("Rewriting tag height from %s (%s) to %s"
-                          % (tag.attrs['height'],
-                             type(tag.attrs['height']),
-                             newheight), file=sys.stderr)
-                    tag.attrs['height'] = str(newwidth)
-
-            # LA Daily Post has taken to using PNG for all
-            # their images, making them HUGE so translating to
-            # JPG would also be good.
-            # 3 ways to check for transparency:
-            # https://stackoverflow.com/a/58567453
-            def has_transparency(img):
-                if img.info.get("transparency", None) is not None:
-                    print(imgfilename, "has transparency", file=sys.stderr)
+                return pool.submit(transform_in_worker, src, newdir,
+                                   imgfilename, settings).result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died. Start a new pool next time,
+                # and do this one here.
+                print("Image transform process died", file=sys.stderr)
+                with g_transform_pool_lock:
+                    if g_transform_pool is pool:
+                        g_transform_pool = None
+
+    result = ImageTransform(src, imgfilename)
+    t0 = time.thread_time()
+    transcode_image(result, newdir, imgfilename, settings)
+    return result, time.thread_time() - t0, ''
+
+
+def transcode_image(result, newdir, imgfilename, settings):
+    """Resize or convert a downloaded image if needed,
+       setting the imgfilename, newsize etc. of an ImageTransform.
+       settings is a dict of the feed's IMAGE_SETTINGS.
+    """
+    imgpathname = os.path.join(newdir, imgfilename)
+
+    # Are we resizing large images? Some sites have crazy-big
+    # images, like 5328 x 3996, which make no sense whatsoever
+    # to view on a phone. 0 means don't resize, but images may
+    # still need converting, per the other settings.
+    maxsize = settings['max_image_size']
+
+    imchanged = False
+    try:
+        # This only reads the header: nothing is decoded until
+        # the image is resized, converted or saved, so small images
+        # that don't need changing are never decoded at all.
+        im = Image.open(imgpathname)
+
+    except UnidentifiedImageError:
+        # Image might be SVG or some other non-PIL type
+        print("PIL Unknown image type, can't resize",
+              imgpathname, file=sys.stderr)
+
+        # Allow all SVGs, don't try to resize them
+        if imgpathname.lower().endswith(".svg"):
+            print("Allowing SVG", imgpathname, file=sys.stderr)
+            return
+
+        # If it's not a PNG, how big is it?
+        # If it's not too big, keep it.
+        filesize = os.stat(imgpathname).st_size    # size in bytes
+        if filesize < 1024*512:    # XXX hardwired, make configurable
+            print("PIL can't handle", imgpathname,
+                  "but it's not that big, allowing anyway",
+                  file=sys.stderr)
+        else:
+            # Make a link to the nonlocal image
+            print("PIL can't handle", result.src,
+                  "and it's big: making a link to it",
+                  file=sys.stderr)
+            result.make_link = True
+        return
+
+    # Animations have their own rules.
+    nframes = getattr(im, 'n_frames', 1)
+    if nframes > 1:
+        result.frames = nframes
+        if transcode_animation(result, im, newdir, imgfilename, settings):
+            im.close()
+            return
+        # Otherwise, keep just the first frame, on purpose.
+        print("Keeping the first of %d frames of" % nframes, imgfilename,
+              file=sys.stderr)
+        im.seek(0)
+        im = im.convert('RGBA' if result_transparent(im) else 'RGB')
+        imchanged = True
+
+    oldwidth, oldheight = im.size
+    if maxsize and max(oldwidth, oldheight) > maxsize:
+        newwidth, newheight = fit_size(im.size, maxsize)
+        print("Resizing %dx%d image to %dx%d" % (oldwidth,
+                                                 oldheight,
+                                                 newwidth,
+                                                 newheight),
+              file=sys.stderr)
+        # This may set image.format to None
+        im = downscale(im, (newwidth, newheight))
+        imchanged = True
+        result.newsize = (newwidth, newheight)
+
+    # LA Daily Post has taken to using PNG for all
+    # their images, making them HUGE so translating to
+    # JPG would also be good.
+    # 3 ways to check for transparency:
+    # https://stackoverflow.com/a/58567453
+    def has_transparency(img):
+        if img.info.get("transparency", None) is not None:
+            print(imgfilename, "has transparency", file=sys.stderr)
+            return True
+        if img.mode == "P":
+            transparent = img.info.get("transparency", -1)
+            for _, index in img.getcolors():
+                if index == transparent:
+                    print(imgfilename,
+                          "has a transparent color", file=sys.stderr)
                     return True
-                if img.mode == "P":
-                    transparent = img.info.get("transparency", -1)
-                    for _, index in img.getcolors():
-                        if index == transparent:
-                            print(imgfilename,
-                                  "has a transparent color", file=sys.stderr)
-                            return True
-                elif img.mode == "RGBA":
-                    extrema = img.getextrema()
-                    if extrema[3][0] < 255:
-                        print(imgfilename, "extrama transparency",
-                              file=sys.stderr)
-                        return True
-                print(imgfilename, "is not transparent", file=sys.stderr)
-                return False
-
-            if ((im.format == 'PNG' or imgfilename.lower().endswith('.png'))
-                and (utils.g_config.getboolean(feedname, 'png_to_jpg')
-                     or not has_transparency(im))):
-                # Make sure the image is RGB to convert to JPG
+        elif img.mode == "RGBA":
+            extrema = img.getextrema()
+            if extrema[3][0] < 255:
+                print(imgfilename, "extrama transparency",
+                      file=sys.stderr)
+                return True
+        print(imgfilename, "is not transparent", file=sys.stderr)
+        return False
+
+    if ((im.format == 'PNG' or imgfilename.lower().endswith('.png'))
+        and (settings['png_to_jpg'] or not has_transparency(im))):
+        # Make sure the image is RGB to convert to JPG
+        im = im.convert('RGB')
+        os.unlink(imgpathname)
+        print("rewriting PNG to JPEG", "old filename was",
+              imgpathname, file=sys.stderr)
+        imchanged = True
+    # else:
+    #     print(imgfilename, "isn't png, no need to rewrite",
+    #           file=sys.stderr)
+
+    base, ext = os.path.splitext(imgfilename)
+    # base might still have dots in it, which will confuse PIL
+    # if it's something like ".jpg?w=2000&amp;quality=100&amp;ssl=1"
+    base = base.replace('.', '')
+
+    if not ext or ext.lower() not in KNOWN_EXTENSIONS:
+        print("Image filename", imgfilename, "has unknown extension",
+              ext, ": rewriting")
+        imchanged = True
+    elif not imchanged and settings['image_target_bytes'] \
+         and os.path.getsize(imgpathname) > settings['image_target_bytes']:
+        print(imgfilename, "is bigger than image_target_bytes: rewriting",
+              file=sys.stderr)
+        imchanged = True
+
+    if imchanged:
+        # PIL decides what format to save based on the extension,
+        # and imgpathname might not end with one, so use the
+        # feed's preferred format.
+        fmt, newext, options = output_format(settings['image_formats'])
+        if fmt == 'JPEG' or not result_transparent(im):
+            if im.mode != 'RGB':
                 im = im.convert('RGB')
-                os.unlink(imgpathname)
-                print("rewriting PNG to JPEG", "old filename was",
-                      imgpathname, file=sys.stderr)
-                imchanged = True
-            # else:
-            #     print(imgfilename, "isn't png, no need to rewrite",
-            #           file=sys.stderr)
-
-            base, ext = os.path.splitext(imgfilename)
-            # base might still have dots in it, which will confuse PIL
-            # if it's something like ".jpg?w=2000&amp;quality=100&amp;ssl=1"
-            base = base.replace('.', '')
-            # For now, always save as .jpg
-
-            if imchanged:
-                # imgpathname might not end with an extension, but if not,
-                # PIL will raise ValueError: unknown file extension.
-                # But PIL doesn't seem to have a way to generate an extension
-                # from the image's current format -- sigh.
-
-                # PIL apparently decides what format to save
-                # based on image extension, so convert to jpg.
-                if im.mode != 'RGB':
-                    im = im.convert('RGB')
-                imgfilename = base + '.jpg'
-                imgpathname = os.path.join(newdir, imgfilename)
-                im.save(imgpathname)
-            elif not ext or ext.lower() not in KNOWN_EXTENSIONS:
-                print("Image filename", imgfilename, "has unknown extension",
-                      ext, ": rewriting as .jpg")
-                if im.mode != 'RGB':
-                    im = im.convert('RGB')
-                imgfilename = base + '.jpg'
-                imgpathname = os.path.join(newdir, imgfilename)
-                im.save(imgpathname)
+        elif im.mode != 'RGBA':
+            im = im.convert('RGBA')
+
+        if not settings['strip_image_metadata'] and im.info.get('exif'):
+            options = dict(options, exif=im.info['exif'])
+        # Keep any color profile, though: colors can look wrong without it.
+        if im.info.get('icc_profile'):
+            options = dict(options, icc_profile=im.info['icc_profile'])
+
+        data = encode_image(im, fmt, options, settings['image_quality'],
+                            settings['image_target_bytes'])
+        imgfilename = base + newext
+        with open(os.path.join(newdir, imgfilename), 'wb') as fp:
+            fp.write(data)
+        # Don't leave the original around to be synced too.
+        if imgpathname != os.path.join(newdir, imgfilename) \
+           and os.path.exists(imgpathname):
+            os.unlink(imgpathname)
+
+    result.imgfilename = imgfilename
+    result.size = im.size
+    result.transparent = result_transparent(im)
+    result.phash = perceptual_hash(im)
+    im.close()
+
+
+def perceptual_hash(im):
+    """A 64-bit difference hash of an image: shrink it to 9x8 gray pixels
+       and note whether each pixel is brighter than the one to its right.
+       Recompressed or resized copies of a picture have the same hash,
+       or one that differs in only a few bits.
+    """
+    pixels = list(im.convert('L').resize((9, 8)).getdata())
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            phash <<= 1
+            if pixels[row * 9 + col] > pixels[row * 9 + col + 1]:
+                phash |= 1
+    return phash
+
+
+def find_duplicate(newdir, job):
+    """If an image that looks the same as the job's has already been
+       fetched to newdir for this feed, return its filename.
+       Otherwise remember this one and return None.
+    """
+    width, height = job.size
+    with g_phash_lock:
+        seen = g_phashes.setdefault(newdir, [])
+        for phash, (w, h), imgfilename in seen:
+            # The hash doesn't see the shape, so check that too.
+            if bin(phash ^ job.phash).count('1') <= PHASH_DISTANCE \
+               and abs(w * height - h * width) <= .02 * w * height:
+                return imgfilename
+        seen.append((job.phash, job.size, job.imgfilename))
+    return None
+
+
+def result_transparent(im):
+    """Can an image have transparent parts, from its mode?"""
+    return im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+
+
+def output_format(formats):
+    """Return (PIL format, extension, save options) for the first
+       of a feed's image_formats that this PIL can write.
+    """
+    Image.init()
+    for name in formats:
+        if name in OUTPUT_FORMATS and OUTPUT_FORMATS[name][0] in Image.SAVE:
+            return OUTPUT_FORMATS[name]
+    return OUTPUT_FORMATS['jpeg']
+
+
+def encode_image(im, fmt, options, quality, target_bytes):
+    """Encode an image, returning the bytes.
+       With no target_bytes, use quality (or the encoder's default).
+       Otherwise, use the best quality up to quality (or 90)
+       that fits in target_bytes, going no lower than MIN_TARGET_QUALITY.
+    """
+    def encode(q):
+        buf = io.BytesIO()
+        if q:
+            im.save(buf, fmt, quality=q, **options)
+        else:
+            im.save(buf, fmt, **options)
+        return buf.getvalue()
+
+    if not target_bytes:
+        return encode(quality)
+
+    # Binary search on quality.
+    lo, hi = MIN_TARGET_QUALITY, quality or 90
+    data = encode(hi)
+    if len(data) <= target_bytes:
+        return data
+    best = None
+    while lo < hi:
+        mid = (lo + hi) // 2
+        trial = encode(mid)
+        if len(trial) <= target_bytes:
+            best = trial
+            lo = mid + 1
+        else:
+            hi = mid
+    if best is None:
+        best = encode(MIN_TARGET_QUALITY)
+    return best
+
+
+def fit_size(size, maxsize):
+    """Scale (width, height) to fit in maxsize x maxsize."""
+    oldwidth, oldheight = size
+    if oldwidth >= oldheight:    # landscape
+        return maxsize, oldheight * maxsize // oldwidth
+    else:                        # portrait
+        return oldwidth * maxsize // oldheight, maxsize
+
+
+def transcode_animation(result, im, newdir, imgfilename, settings):
+    """Deal with an animated image according to animated_images:
+         keep: leave it alone, unless it needs resizing
+         link: replace it with a link to the original
+         webp: convert to an animated WebP no bigger than
+               max_animation_bytes, if possible
+         still: keep only the first frame
+       Returns True if it's been dealt with, False if the caller
+       should keep just the first frame.
+    """
+    how = settings['animated_images']
+    maxsize = settings['max_image_size']
+    imgpathname = os.path.join(newdir, imgfilename)
+    oldbytes = os.path.getsize(imgpathname)
+    print("%s: animation, %d frames, %d bytes"
+          % (imgfilename, result.frames, oldbytes), file=sys.stderr)
+
+    if how == 'link':
+        print("Making a link to the animation", result.src, file=sys.stderr)
+        result.make_link = True
+        return True
 
-        # Rewrite the url:
-        ImageCache[src] = imgfilename
-        tag.attrs['src'] = imgfilename
-        print("Image src rewritten to", imgfilename, file=sys.stderr)
+    if how == 'keep' and (not maxsize or max(im.size) <= maxsize):
+        result.size = im.size
+        result.transparent = result_transparent(im)
+        result.phash = perceptual_hash(im)
+        return True
+
+    if how != 'webp' or 'WEBP' not in Image.SAVE:
+        return False
 
+    newsize = None
+    if maxsize and max(im.size) > maxsize:
+        newsize = fit_size(im.size, maxsize)
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(im):
+        durations.append(frame.info.get('duration', 100))
+        frame = frame.convert('RGBA')
+        if newsize:
+            frame = frame.resize(newsize, reducing_gap=REDUCING_GAP)
+        frames.append(frame)
+
+    maxbytes = settings['max_animation_bytes']
+    for quality in (settings['image_quality'] or 75, 50, 30):
+        buf = io.BytesIO()
+        frames[0].save(buf, 'WEBP', save_all=True,
+                       append_images=frames[1:], duration=durations,
+                       loop=im.info.get('loop', 0), quality=quality)
+        data = buf.getvalue()
+        if not maxbytes or len(data) <= maxbytes:
+            break
     else:
-        # Looks like it's probably a nonlocal image, don't download
-        print(req.host, "and", host,
-              "are too different -- not fetching image", src,
+        print("Animated WebP is still %d bytes: keeping a still"
+              % len(data), file=sys.stderr)
+        return False
+
+    base = os.path.splitext(imgfilename)[0].replace('.', '')
+    result.imgfilename = base + '.webp'
+    with open(os.path.join(newdir, result.imgfilename), 'wb') as fp:
+        fp.write(data)
+    if result.imgfilename != imgfilename:
+        os.unlink(imgpathname)
+    print("Animation rewritten as WebP: %d bytes, was %d"
+          % (len(data), oldbytes), file=sys.stderr)
+    result.newsize = newsize
+    result.size = frames[0].size
+    result.transparent = True
+    result.phash = perceptual_hash(frames[0])
+    return True
+
+
+def downscale(im, newsize):
+    """Shrink an image that has been opened but not yet decoded.
+       A 5328x3996 JPEG is about 64M decoded, so rather than decode it
+       at full size and then resize, let the JPEG decoder scale it down
+       by 2, 4 or 8 as it decodes (draft mode), then resize from there.
+       For other formats, resize() does a fast Image.reduce() first.
+       Returns the new image and closes the original.
+    """
+    box = None
+    if im.format == 'JPEG':
+        res = im.draft(None, (int(newsize[0] * REDUCING_GAP),
+                              int(newsize[1] * REDUCING_GAP)))
+        if res:
+            # The part of the reduced image that matches the original:
+            # draft rounds its size up.
+            box = res[1]
+    newim = im.resize(newsize, box=box, reducing_gap=REDUCING_GAP)
+    im.close()
+    return newim
+
+
+#
+# The image store: images that have already been fetched and resized,
+# kept across days and shared between feeds, so the same logo or
+# author photo isn't fetched and resized every day.
+# Day directories get hard links to the files in the store
+# (or copies, if hard links aren't possible).
+#   images/ab/abcdef0123...jpg   an image, named by the hash of its contents
+#   images/index.json            the image index, below
+#
+
+def get_store_dir():
+    return os.path.join(FeedmeCache.get_cache_dir(), 'images')
+
+
+def store_url_key(src, profile):
+    """The index key for the version of src that this feed's
+       image settings will produce.
+    """
+    key = ' '.join([ src ] + [ str(getattr(profile, name))
+                              for name in IMAGE_SETTINGS ])
+    return hashlib.sha1(key.encode('utf-8', 'replace')).hexdigest()
+
+
+def link_or_copy(frompath, topath):
+    """Hard link frompath to topath, or copy it if that's not possible,
+       e.g. because they're on different filesystems.
+       Replaces topath if it already exists.
+    """
+    # rename() between two links to the same file does nothing,
+    # which would leave the temporary file behind.
+    if os.path.exists(topath) and os.path.samefile(frompath, topath):
+        return
+    tmppath = "%s.%d.part" % (topath, threading.get_ident())
+    try:
+        os.link(frompath, tmppath)
+    except OSError:
+        shutil.copyfile(frompath, tmppath)
+    os.replace(tmppath, topath)
+
+
+def store_add(newdir, imgfilename):
+    """Add a newly fetched image in newdir to the image store.
+       Returns its name relative to the store directory.
+    """
+    storedir = get_store_dir()
+    imgpathname = os.path.join(newdir, imgfilename)
+    with open(imgpathname, 'rb') as fp:
+        digest = hashlib.sha1(fp.read()).hexdigest()
+
+    ext = os.path.splitext(imgfilename)[1].lower()
+    if ext not in KNOWN_EXTENSIONS:
+        ext = ''
+    storename = os.path.join(digest[:2], digest + ext)
+    storepath = os.path.join(storedir, storename)
+    os.makedirs(os.path.dirname(storepath), exist_ok=True)
+
+    if os.path.exists(storepath):
+        # The same image from another URL: share the stored copy.
+        link_or_copy(storepath, imgpathname)
+    else:
+        link_or_copy(imgpathname, storepath)
+    return storename
+
+
+#
+# The image index: what we know about every image fetched so far,
+# so an image never has to be fetched, decoded or converted twice,
+# even if its local name changed (e.g. a PNG converted to JPEG).
+# { store_url_key: { "file": local filename, or None,
+#                    "store": name in the image store, or None,
+#                    "link": true if the image should be a link instead,
+#                    "dropped": true if the image should be removed,
+#                    "resized": true if it was scaled down,
+#                    "width": w, "height": h, "transparent": bool,
+#                    "bytes": file size,
+#                    "used": time last used } }
+# It's read the first time it's needed and saved with save_index().
+#
+g_image_index = None
+g_image_index_file = None
+g_image_index_lock = threading.Lock()
+
+
+def load_index():
+    """Return the image index, reading it if it hasn't been read yet.
+       Call with g_image_index_lock held.
+    """
+    global g_image_index, g_image_index_file
+
+    indexfile = os.path.join(get_store_dir(), 'index.json')
+    if g_image_index is not None and g_image_index_file == indexfile:
+        return g_image_index
+
+    g_image_index_file = indexfile
+    try:
+        with open(indexfile) as fp:
+            g_image_index = json.load(fp)
+    except FileNotFoundError:
+        g_image_index = {}
+    except (OSError, ValueError) as e:
+        print("Couldn't read image index %s: %s" % (indexfile, e),
               file=sys.stderr)
+        g_image_index = {}
+    return g_image_index
 
-        replace_img_with_link(tag, src, alt_src)
+
+def save_index():
+    """Save the image index, if it's been used."""
+    with g_image_index_lock:
+        if g_image_index is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(g_image_index_file), exist_ok=True)
+            tmpfile = g_image_index_file + '.part'
+            with open(tmpfile, 'w') as fp:
+                json.dump(g_image_index, fp)
+            os.replace(tmpfile, g_image_index_file)
+        except OSError as e:
+            print("Couldn't save image index %s: %s"
+                  % (g_image_index_file, e), file=sys.stderr)
+
+
+def index_set(key, entry):
+    with g_image_index_lock:
+        load_index()[key] = entry
+
+
+def index_entry(job, newdir, storename):
+    """Make an index entry for a job that's been fetched."""
+    entry = { "file": None, "store": storename,
+              "link": job.make_link, "dropped": job.drop,
+              "resized": bool(job.newsize),
+              "width": None, "height": None,
+              "transparent": job.transparent,
+              "bytes": None,
+              "used": int(time.time()) }
+    if job.size:
+        entry["width"], entry["height"] = job.size
+    if job.imgfilename and not job.make_link:
+        entry["file"] = job.imgfilename
+        try:
+            entry["bytes"] = os.path.getsize(os.path.join(newdir,
+                                                          job.imgfilename))
+        except OSError:
+            pass
+    return entry
+
+
+def use_index_entry(job, key, profile, newdir):
+    """If the image index knows about an image, make it available
+       in newdir (from the image store if needed) and set the job's
+       results from the index. Returns True if the job is done.
+    """
+    with g_image_index_lock:
+        entry = load_index().get(key)
+    if not entry:
+        return False
+
+    if entry.get("dropped"):
+        job.drop = True
+    elif entry["link"]:
+        job.make_link = True
+    else:
+        imgpathname = os.path.join(newdir, entry["file"])
+        storepath = None
+        if entry["store"] and profile.image_store:
+            storepath = os.path.join(get_store_dir(), entry["store"])
+        try:
+            if not os.path.exists(imgpathname):
+                if not storepath:
+                    return False
+                link_or_copy(storepath, imgpathname)
+                job.created = True
+                print("Image", job.src, "from the image store:",
+                      entry["file"], file=sys.stderr)
+            # Mark it as recently used, for clean_up_store().
+            if storepath:
+                os.utime(storepath)
+        except OSError:
+            return False
+
+        job.imgfilename = entry["file"]
+        if entry["width"] is not None:
+            job.size = (entry["width"], entry["height"])
+            if entry["resized"]:
+                job.newsize = job.size
+        job.transparent = entry["transparent"]
+
+    entry["used"] = int(time.time())
+    return True
+
+
+def clean_up_store(days):
+    """Remove images from the store that no day directory links to
+       any more and that haven't been used for days days,
+       and index entries that haven't been used or whose image is gone.
+    """
+    storedir = get_store_dir()
+    if not os.path.isdir(storedir):
+        return
+
+    cutoff = time.time() - days * 24 * 60 * 60
+    removed = 0
+    for subdir in os.listdir(storedir):
+        subdir = os.path.join(storedir, subdir)
+        if not os.path.isdir(subdir):
+            continue
+        for f in os.listdir(subdir):
+            f = os.path.join(subdir, f)
+            try:
+                # The store's own link is the only one left
+                # (or hard links weren't possible and it's been a while).
+                st = os.stat(f)
+                if st.st_nlink <= 1 and st.st_mtime < cutoff:
+                    os.unlink(f)
+                    removed += 1
+            except OSError as e:
+                print("Couldn't clean up", f, ":", e, file=sys.stderr)
+        if not os.listdir(subdir):
+            os.rmdir(subdir)
+
+    # Stored images are kept as long as the store has them;
+    # anything else is forgotten once it hasn't been used for days days.
+    with g_image_index_lock:
+        index = load_index()
+        for key in list(index):
+            entry = index[key]
+            if entry["store"]:
+                if not os.path.exists(os.path.join(storedir, entry["store"])):
+                    del index[key]
+            elif entry["used"] < cutoff:
+                del index[key]
+    save_index()
+
+    print("Removed %d unused images from the image store" % removed,
+          file=sys.stderr)
+
+
+def apply_image_job(job, profile, inlined):
+    """Rewrite all the tags that share an ImageJob, once it's been fetched.
+       Images small enough to inline are added to the set inlined
+       if their local files can be removed once all the tags are done.
+    """
+    for tag in job.tags:
+        if job.drop:
+            tag.decompose()
+            continue
+
+        if job.make_link:
+            replace_img_with_link(tag, job.src, job.alt_src)
+            continue
+
+        if not job.imgfilename:
+            # Couldn't download: point instead to the alternate src,
+            # e.g. the absolute URL, so it will at least work with a
+            # live net connection.
+            tag.attrs['src'] = job.alt_src
+            continue
+
+        # Change the tag's width and height attributes, if any
+        if job.newsize:
+            newwidth, newheight = job.newsize
+            if 'width' in tag.attrs:
+                print("Rewriting tag width from %s (%s) to %s"
+                      % (tag.attrs['width'],
+                         type(tag.attrs['width']),
+                         newwidth), file=sys.stderr)
+                tag.attrs['width'] = str(newwidth)
+            if 'height' in tag.attrs:
+                print("Rewriting tag height from %s (%s) to %s"
+                      % (tag.attrs['height'],
+                         type(tag.attrs['height']),
+                         newheight), file=sys.stderr)
+                tag.attrs['height'] = str(newheight)
+
+        # Rewrite the url:
+        ImageCache[job.src] = job.imgfilename
+        if inline_image(job, profile):
+            tag.attrs['src'] = job.data_uri
+            if job.created:
+                inlined.add(os.path.join(os.path.dirname(job.imgpathname),
+                                         job.imgfilename))
+            continue
+        tag.attrs['src'] = job.imgfilename
+        print("Image src rewritten to", job.imgfilename, file=sys.stderr)
+
+
+# MIME types for images that can be inlined, by extension
+INLINE_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
+    '.png': 'image/png', '.gif': 'image/gif', '.svg': 'image/svg+xml',
+    '.webp': 'image/webp', '.avif': 'image/avif',
+}
+
+
+def inline_image(job, profile):
+    """If a job's image is no bigger than inline_image_bytes,
+       set job.data_uri to the image as a data: URI, so it can go
+       in the HTML instead of being one more file to sync.
+       Returns True if the image should be inlined.
+    """
+    if job.data_uri:
+        return True
+    if job.shared and job.shared.data_uri:
+        # The file may be gone, so use the URI the other job made.
+        job.data_uri = job.shared.data_uri
+        return True
+    imgpathname = os.path.join(os.path.dirname(job.imgpathname),
+                               job.imgfilename)
+    mimetype = inline_type(imgpathname, profile)
+    if not mimetype:
+        return False
+    try:
+        with open(imgpathname, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return False
+
+    job.data_uri = "data:%s;base64,%s" % (
+        mimetype, base64.b64encode(data).decode('ascii'))
+    print("Inlining", job.imgfilename, file=sys.stderr)
+    utils.add_stat(profile.feedname, "images inlined", 1)
+    utils.add_stat(profile.feedname, "inlined image bytes", len(data))
+    return True
+
+
+def inline_type(imgpathname, profile):
+    """If a local image is small enough, and of a type, to be inlined,
+       return its MIME type, else None.
+    """
+    if not profile.inline_image_bytes:
+        return None
+    mimetype = INLINE_TYPES.get(os.path.splitext(imgpathname)[1].lower())
+    if not mimetype:
+        return None
+    try:
+        if os.path.getsize(imgpathname) > profile.inline_image_bytes:
+            return None
+    except OSError:
+        return None
+    return mimetype
+
+
+def remove_files(paths):
+    """Remove local image files that are no longer needed."""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
 
 def replace_img_with_link(tag, src, alt_src):
@@ -465,6 +1674,152 @@ def replace_img_with_link(tag, src, alt_src):
     tag.attrs['src'] = alt_src
 
 
+# Length units in sizes and media queries that are relative to the font
+# size: assume the usual default.
+EM_PX = 16
+
+
+def css_length(length, viewport):
+    """Convert a CSS length, from a sizes attribute or a media query,
+       to CSS pixels. Returns None for anything more complicated,
+       like calc().
+    """
+    m = re.fullmatch(r'\s*(\d+(?:\.\d*)?|\.\d+)(px|vw|em|rem)\s*',
+                     length.lower())
+    if not m:
+        return None
+    num, unit = float(m.group(1)), m.group(2)
+    if unit == 'vw':
+        return num * viewport / 100
+    if unit in ('em', 'rem'):
+        return num * EM_PX
+    return num
+
+
+def media_matches(media, viewport):
+    """Does a media query match a screen viewport pixels wide?
+       Only min-width and max-width (and "and") are understood:
+       anything else doesn't match.
+    """
+    media = media.strip().lower()
+    if media.startswith('only '):
+        media = media[5:]
+    for part in re.split(r'\s+and\s+', media):
+        part = part.strip()
+        if part in ('', 'all', 'screen'):
+            continue
+        m = re.fullmatch(r'\(\s*(min|max)-width\s*:\s*([^)]*)\)', part)
+        if not m:
+            return False
+        width = css_length(m.group(2), viewport)
+        if width is None:
+            return False
+        if m.group(1) == 'min' and viewport < width:
+            return False
+        if m.group(1) == 'max' and viewport > width:
+            return False
+    return True
+
+
+def slot_width(sizes, viewport):
+    """How many CSS pixels wide does a sizes attribute say
+       an image will be displayed? Without one, the whole viewport.
+    """
+    if not sizes:
+        return viewport
+    for size in sizes.split(','):
+        size = size.strip()
+        # "(max-width: 600px) 480px": a media condition, then a length.
+        if size.startswith('(') and not size.endswith(')'):
+            condition, length = size.rsplit(None, 1)
+            if not media_matches(condition, viewport):
+                continue
+        else:
+            length = size
+        return css_length(length, viewport) or viewport
+    return viewport
+
+
+def readable_mime_types():
+    """Image types we can handle in a <picture> <source type=...>."""
+    Image.init()
+    return set(Image.MIME[fmt].lower() for fmt in Image.OPEN
+               if fmt in Image.MIME) | { 'image/svg+xml', 'image/jpg' }
+
+
+def choose_srcset_src(tag, profile):
+    """Choose an image for an img tag from its srcset, or from the
+       <source> elements of the <picture> it's in, for the feed's device:
+       the smallest one at least as many pixels wide as the image
+       will be displayed, or failing that, the biggest.
+       Returns the URL, or None if there's no srcset to choose from.
+    """
+    viewport = profile.viewport_width
+    srcset = None
+    sizes = tag.attrs.get('sizes')
+
+    # The first <source> that matches our screen and is a type we can read.
+    picture = tag.find_parent('picture')
+    if picture:
+        readable = readable_mime_types()
+        for source in picture.find_all('source'):
+            if not media_matches(source.attrs.get('media', ''), viewport):
+                continue
+            mimetype = source.attrs.get('type', '').strip().lower()
+            if mimetype and mimetype not in readable:
+                continue
+            srcset = source.attrs.get('srcset') \
+                or source.attrs.get('data-srcset')
+            if srcset:
+                sizes = source.attrs.get('sizes', sizes)
+                break
+
+    # ladailypost (which I think is wordpress) has a crazy setup
+    # where they set the src to something that isn't an image,
+    # then have data-lazy-src and/or data-lazy-srcset
+    # which presumably get loaded later with JavaScript.
+    if not srcset:
+        srcset = tag.attrs.get('data-lazy-srcset') or tag.attrs.get('srcset')
+    if not srcset:
+        return None
+
+    # Wired sometimes has srcset with just a single url
+    # that's the same as the src=. They also have srcSet="".
+    # And there are all sorts of nutty and random things
+    # sites do with srcset, so skip anything that doesn't make sense.
+    slot = slot_width(sizes, viewport)
+    if profile.max_display_width:
+        slot = min(slot, profile.max_display_width)
+    needed = slot * profile.device_pixel_ratio
+    # No point fetching more than we're going to keep.
+    if profile.max_image_size:
+        needed = min(needed, profile.max_image_size)
+
+    candidates = []
+    for url, descriptor in parse_srcset(srcset):
+        url = url.strip()
+        descriptor = (descriptor or '1x').strip().lower()
+        try:
+            if descriptor.endswith('w'):
+                width = int(descriptor[:-1])
+            else:
+                # A pixel density: a 2x image is twice as wide
+                # as the space it's shown in.
+                width = float(descriptor[:-1]) * slot
+        except ValueError:
+            print("Error parsing srcset: '%s'" % srcset, file=sys.stderr)
+            continue
+        if url:
+            candidates.append((width, url))
+    if not candidates:
+        return None
+
+    big_enough = [ c for c in candidates if c[0] >= needed ]
+    if big_enough:
+        return min(big_enough, key=lambda c: c[0])[1]
+    return max(candidates, key=lambda c: c[0])[1]
+
+
 # The srcset spec is here:
 # http://w3c.github.io/html/semantics-embedded-content.html#element-attrdef-img-srcset
 # https://html.spec.whatwg.org/multipage/images.html#srcset-attribute
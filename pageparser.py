@@ -10,15 +10,20 @@ import os, sys
 import urllib.request, urllib.error, urllib.parse
 import re
 import lxml.html
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment, NavigableString
 from http.cookiejar import CookieJar
 import io
 import gzip
+import hashlib
+import threading
+import concurrent.futures
 
 import utils
 import traceback
 
 import imagecache
+import extractor
+from siteprofile import get_profile
 
 # Use XDG for the config and cache directories if it's available
 try:
@@ -31,7 +36,9 @@ class NoContentError(Exception):
     pass
 
 
-SKIP_NODE_PAT = r'''\s*([a-zA-Z\d]+)\s+(?:([a-zA-Z]+)\s*=\s*['"](.*)['"])?'''
+# How many extra pages of a multi-page story (plus any single-page
+# versions of it) to fetch at once.
+MAX_PAGE_FETCHERS = 4
 
 
 class CookieError(Exception):
@@ -59,6 +66,7 @@ class FeedmeURLDownloader(object):
 
     def __init__(self, feedname, verbose=False):
         self.feedname = feedname
+        self.profile = get_profile(feedname)
         self.user_agent = utils.VersionString
         self.encoding = None
         self.cookiejar = None
@@ -160,7 +168,7 @@ class FeedmeURLDownloader(object):
         # urllib2 doesn't handle that automatically: we have to ask for it.
         # But some other sites, like the LA Monitor, return bad content
         # if you ask for gzip.
-        if utils.g_config.getboolean(self.feedname, 'allow_gzip'):
+        if self.profile.allow_gzip:
             request.add_header('Accept-encoding', 'gzip')
 
         # feed() is going to need to know the host, to rewrite urls.
@@ -249,11 +257,17 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
         self.base_href = None
 
         self.multipages = []
+        self.single_page_urls = []
+        self.body_hash = None
+
+        # For another page of a story: an Event that's set if the page
+        # is no longer wanted, so it shouldn't add any more images.
+        self.cancel = None
 
     def fetch_url(self, url, newdir, newname, title=None, author=None,
                   html=None,
                   footer='', referrer=None, user_agent=None,
-                  sub_page=False):
+                  sub_page=False, follow_pages=True):
         """Read a URL from the web. Parse it, rewriting any links,
            downloading any images and making any other changes needed
            according to the config file and current feed name.
@@ -264,9 +278,12 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
            and download any images into $newdir.
            If sub_page is true, then it will append to an existing file
            rather than replacing it.
+           Unless follow_pages is false, also fetch any single-page version
+           or extra pages of the story: see fetch_other_pages().
            Raises NoContentError if it can't get the page or skipped it.
         """
-        self.verbose = utils.g_config.getboolean(self.feedname, 'verbose')
+        profile = self.profile
+        self.verbose = profile.verbose
         if self.verbose:
             if html:
                 print("Parsing html from index,", len(html),
@@ -305,7 +322,7 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
         self.skipping = None
 
         # Do we need to do any substitution on the URL first?
-        urlsub = utils.g_config.get_multiline(self.feedname, 'url_substitute')
+        urlsub = profile.url_substitute
         if urlsub:
             if self.verbose:
                 print("Multiline: Substituting", urlsub[0],
@@ -315,7 +332,10 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
             if self.verbose:
                 print("Became:   ", url, file=sys.stderr)
 
-        self.encoding = utils.g_config.get(self.feedname, 'encoding')
+        # download_url() will update this if there's a redirect.
+        self.cur_url = url
+
+        self.encoding = profile.encoding
         if not self.encoding:
             self.encoding = "utf-8"
 
@@ -331,11 +351,10 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
             html = '<h1>No article</h1>\n<p>No HTML downloaded!\n'
 
         # Does it contain any of skip_content_pats anywhere? If so, bail.
-        skip_content_pats = utils.g_config.get_multiline(self.feedname,
-                                                 'skip_content_pats')
-        for pat in skip_content_pats:
-            if re.search(pat, html):
-                raise NoContentError("Skipping, skip_content_pats " + pat)
+        for pat in profile.skip_content_pats:
+            if pat.search(html):
+                raise NoContentError("Skipping, skip_content_pats "
+                                     + pat.pattern)
 
         if self.newname:
             outfilename = os.path.join(self.newdir, self.newname)
@@ -349,14 +368,7 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
                 # unless we explicitly encode everything with fallbacks.
                 # So much for python3 being easier to deal with for unicode.
                 self.outfile = open(outfilename, "w", encoding=self.encoding)
-                self.outfile.write("""<html>\n<head>
-<meta http-equiv="Content-Type" content="text/html; charset=%s">
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<link rel="stylesheet" type="text/css" title="Feeds" href="../../feeds.css"/>
-<title>%s</title>
-</head>
-
-""" % (self.encoding, title))
+                self.outfile.write(self.html_header(title))
         else:
             outfilename = None
             self.outfile = io.StringIO()
@@ -375,65 +387,74 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
 
         # Throw out everything before the first page_start re pattern seen,
         # and after the first page_end pattern seen.
-        page_starts = utils.g_config.get_multiline(self.feedname, 'page_start')
-        page_ends = utils.g_config.get_multiline(self.feedname, 'page_end')
-
-        if len(page_starts) > 0:
-            for page_start in page_starts:
+        found_start = False
+        for page_start in profile.page_starts:
+            if self.verbose:
+                print("looking for page_start", page_start.pattern,
+                      file=sys.stderr)
+            match = page_start.search(html)
+            if match:
                 if self.verbose:
-                    print("looking for page_start", page_start, file=sys.stderr)
-                match = re.search(page_start, html)
-                if match:
-                    if self.verbose:
-                        print("Found page_start regexp", page_start,
-                              file=sys.stderr)
-                    html = html[match.end():]
-                    break
+                    print("Found page_start regexp", page_start.pattern,
+                          file=sys.stderr)
+                html = html[match.end():]
+                found_start = True
+                break
 
-        if len(page_ends) > 0:
-            for page_end in page_ends:
+        for page_end in profile.page_ends:
+            if self.verbose:
+                print("looking for page_end", page_end.pattern,
+                      file=sys.stderr)
+            match = page_end.search(html)
+            if match:
                 if self.verbose:
-                    print("looking for page_end", page_end, file=sys.stderr)
-                match = re.search(page_end, html)
-                if match:
-                    if self.verbose:
-                        print("Found page_end regexp", page_end,
-                              file=sys.stderr)
-                    html = html[0:match.start()]
-                    break
+                    print("Found page_end regexp", page_end.pattern,
+                          file=sys.stderr)
+                html = html[0:match.start()]
+                break
+
+        # Cut out scripts, styles and other blocks that would only be
+        # thrown away after parsing, so the parser never has to see them.
+        if profile.prescrub:
+            origlen = len(html)
+            origbytes = len(html.encode('utf-8', 'replace'))
+            html = prescrub_html(html, profile.prescrub)
+            utils.add_stat(self.feedname, "bytes prescrubbed",
+                           origbytes - len(html.encode('utf-8', 'replace')))
+            if self.verbose:
+                print("Prescrubbing removed", origlen - len(html),
+                      "of", origlen, "characters", file=sys.stderr)
 
         # Skip anything matching any of the skip_pats.
         # This is an earlier, regex-based version of skip_nodes.
         # Most sites should use skip_nodes, but there may be some
         # sites where skip_pats works better.
-        skip_pats = utils.g_config.get_multiline(self.feedname, 'skip_pats')
-        for skip in skip_pats:
+        # The patterns were compiled with re.DOTALL in the SiteProfile.
+        for skip in profile.skip_pats:
             if self.verbose:
-                print("Trying to skip '%s'" % skip, file=sys.stderr)
-                #print("in", html.encode('utf-8'), file=sys.stderr)
-                #sys.stderr.flush()
-            # flags=DOTALL doesn't exist in re.sub until 2.7,
-            #html = re.sub(skip, '', html, flags=re.DOTALL)
-            # but does exist in a compiled re expression:
-            try:
-                regexp = re.compile(skip, flags=re.DOTALL)
-            except Exception as e:
-                print("Couldn't compile regexp", skip, file=sys.stderr)
-                print(str(e), file=sys.stderr)
-                continue
-            html = regexp.sub('', html)
+                print("Trying to skip '%s'" % skip.pattern, file=sys.stderr)
+            html = skip.sub('', html)
 
         # print("After all skip_pats, html is:", file=sys.stderr)
         # print(html.encode(self.encoding, 'replace'), file=sys.stderr)
 
-        self.single_page_url = None
+        # Keep only the main content, if the site wants that, or if
+        # page_start was supposed to find it but didn't.
+        if profile.extract_content is True \
+           or (profile.extract_content == 'fallback' and not found_start):
+            content = extractor.extract_content(html, self.verbose)
+            if content:
+                utils.add_stat(self.feedname, "bytes cut by extraction",
+                               len(html) - len(content))
+                html = content
+
+        self.single_page_urls = []
+        self.multipages = None
+        self.body_hash = None
 
         # Keep a record of whether we've seen any content:
         self.wrote_data = False
 
-        # Delete any nodes specified for skipping
-        html = delete_skipped_nodes(html, self.feedname)
-
         # Iterate through the HTML, making any necessary simplifications:
         try:
             self.handle_html(html, title, footer)
@@ -454,6 +475,12 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
                       " because:", e,
                       file=sys.stderr)
 
+        # If we're not writing to a file, save what we would have written.
+        if outfilename:
+            outstring = None
+        else:
+            outstring = self.outfile.getvalue()
+
         # handle_html() should have closed the file, but if it bombed out
         # early it might not have.
         try:
@@ -466,76 +493,168 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
         if not self.wrote_data:
             errstr = "No real content"
             print(errstr, file=sys.stderr)
-            if self.verbose:
-                print("No content, removing", outfilename, file=sys.stderr)
-            os.remove(outfilename)
+            if outfilename:
+                if self.verbose:
+                    print("No content, removing", outfilename,
+                          file=sys.stderr)
+                os.remove(outfilename)
             raise NoContentError(errstr)
 
         # Now we've fetched the normal URL.
+        # Are there single-page versions or extra pages to fetch?
+        if follow_pages and not sub_page \
+           and (self.single_page_urls or self.multipages):
+            single, pages = self.fetch_other_pages(url, newdir, title,
+                                                   author, footer,
+                                                   user_agent)
+            if single:
+                # Replace the original with the single-page version.
+                if outfilename:
+                    with open(outfilename, "w",
+                              encoding=self.encoding) as outfile:
+                        outfile.write(self.html_header(title))
+                        outfile.write(single)
+                else:
+                    outstring = single
+            elif pages:
+                if outfilename:
+                    with open(outfilename, "a",
+                              encoding=self.encoding) as outfile:
+                        for page in pages:
+                            outfile.write(page)
+                else:
+                    outstring += ''.join(pages)
 
-        # Did we see a single-page link? If so, move the fetched
-        # file aside and call ourselves recursively to try to fetch
-        # the single-page.
-        if not self.wrote_data:
-            # Don't look for single page or multipage if there wasn't a story
-            pass
-        elif self.single_page_url and self.single_page_url != url:
-            # Call ourself recursively.
-            # It should only be possible for this to happen once;
-            # when we're called recursively, url will be the single
-            # page url so we won't make another recursive call.
-            singlefile = outfilename + ".single"
-            try:
-                if self.verbose:
-                    print("Trying to fetch single-page url with referrer =", \
-                        response.geturl(), "instead of", url, file=sys.stderr)
-                self.fetch_url(self.single_page_url, newdir, singlefile,
-                               title=title, footer=footer,
-                               referrer=response.geturl())
-
-                # If the fetch succeeded and we have a single-page file,
-                # replace the original file with it
-                # and remove the original.
-                if os.path.exists(singlefile):
-                    #os.rename(outfilename, outfilename + '.1')
-                    os.remove(outfilename)
-                    os.rename(singlefile, outfilename)
+        if not outfilename:
+            return outstring
+
+    def html_header(self, title):
+        """The start of a story file, up to where the body goes."""
+        return """<html>\n<head>
+<meta http-equiv="Content-Type" content="text/html; charset=%s">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<link rel="stylesheet" type="text/css" title="Feeds" href="../../feeds.css"/>
+<title>%s</title>
+</head>
+
+""" % (self.encoding, title)
+
+    def page_fetcher(self, cancel):
+        """A new parser for fetching another page of the current story
+           in another thread, sharing this parser's cookies and base href.
+           cancel is an Event to set if the page is no longer wanted.
+        """
+        fetcher = FeedmeHTMLParser(self.feedname)
+        fetcher.base_href = self.base_href
+        fetcher.cookiejar = self.cookiejar
+        fetcher.cancel = cancel
+        return fetcher
+
+    def fetch_other_pages(self, url, newdir, title, author, footer,
+                          user_agent):
+        """After the first page of a story has been fetched,
+           fetch any single-page versions and any extra pages concurrently.
+           The extra pages are only complete once they've all arrived,
+           so whichever finishes first with content wins.
+           Returns (single, pages): either the body of a single-page
+           version, or a list of bodies of extra pages to append in order,
+           skipping any that duplicate earlier pages.
+           Either or both may be empty if nothing useful was fetched.
+        """
+        referrer = self.cur_url
+        single_urls = [ u for u in self.single_page_urls if u != url ]
+        multipages = [ href for href in (self.multipages or [])
+                       if href != url ]
+
+        if not single_urls and not multipages:
+            return None, []
+
+        if self.verbose:
+            print("Fetching", len(single_urls), "single-page URLs and",
+                  len(multipages), "extra pages", file=sys.stderr)
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PAGE_FETCHERS)
+        # Set once the race is over, so fetchers that lost it
+        # (and may still be running) don't write any more images.
+        cancel = threading.Event()
+
+        # Submit the single-page versions first, so they're in the race
+        # even if there are lots of extra pages.
+        single_futures = {}
+        for single_url in single_urls:
+            future = executor.submit(
+                self.page_fetcher(cancel).fetch_url, single_url, newdir,
+                None,
+                title=title, footer=footer, referrer=referrer,
+                user_agent=user_agent, follow_pages=False)
+            single_futures[future] = single_url
+
+        page_futures = []
+        for href in multipages:
+            page_futures.append(executor.submit(
+                self.page_fetcher(cancel).fetch_url, href, newdir, None,
+                title=title, author=author, footer=footer,
+                referrer=referrer, user_agent=user_agent,
+                sub_page=True, follow_pages=False))
+
+        single = None
+        pending = set(single_futures) | set(page_futures)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                if future not in single_futures:
+                    continue
+                try:
+                    single = future.result()
+                except Exception as e:
+                    print("Couldn't read single-page URL",
+                          single_futures[future], ":", e, file=sys.stderr)
+                    continue
+                if single:
                     if self.verbose:
-                        print("Removing", outfilename, \
-                            "and renaming", singlefile, file=sys.stderr)
-                else:
-                    print("Tried to fetch single-page file "
-                          "but apparently failed", file=sys.stderr)
-            except (IOError, urllib.error.HTTPError) as e:
-                print("Couldn't read single-page URL", \
-                    self.single_page_url, file=sys.stderr)
-                print(e, file=sys.stderr)
-
-        # Are there multiple pages? Try to fetch them.
-        elif self.multipages and not sub_page:  # XXXXXXXXXXXXXX
-            if self.multipages:
+                        print("Using single-page URL",
+                              single_futures[future], file=sys.stderr)
+                    break
+            if single:
+                break
+
+            if page_futures and all(f.done() for f in page_futures):
+                break
+
+        # Don't wait for the losers of the race.
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        if single:
+            return single, []
+
+        # Collect the extra pages in order, skipping any page that's
+        # identical to one we already have.
+        pages = []
+        seen = { self.body_hash }
+        for href, future in zip(multipages, page_futures):
+            if future.cancelled() or not future.done():
+                continue
+            try:
+                page = future.result()
+            except Exception as e:
+                print("Couldn't parse", href, ":", e, file=sys.stderr)
+                continue
+            if not page:
+                continue
+            pagehash = hashlib.sha1(page.encode('utf-8', 'replace')).digest()
+            if pagehash in seen:
                 if self.verbose:
-                    print("Chasing", len(self.multipages), "extra pages",
-                          file=sys.stderr)
-                for href in self.multipages:
-                    try:
-                        # href is the link to this page.
-                        # Fetch the content, append it to the current file
-                        if self.verbose:
-                            print("Recursively fetching next page", href,
-                                  file=sys.stderr)
-                        self.fetch_url(href, newdir, newname,
-                                       title=title, author=author,
-                                       html=None,
-                                       footer=footer, referrer=referrer,
-                                       user_agent=user_agent,
-                                       sub_page=True)
-                    except Exception as e:
-                        print("Couldn't parse", link, ":", e, file=sys.stderr)
-                        continue
-
-        if not outfilename and type(self.outfile) is io.StringIO():
-            return self.outfile.getvalue()
+                    print("Skipping duplicate page", href, file=sys.stderr)
+                utils.add_stat(self.feedname, "duplicate pages skipped", 1)
+                continue
+            seen.add(pagehash)
+            pages.append(page)
+
+        return None, pages
 
     def handle_html(self, uhtml, title=None, footer=''):
         """Parse the given unicode as HTML and make all needed substitutions.
@@ -555,6 +674,13 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
             print("Eek, null soup in handle_html", file=self.outfile)
             return
 
+        # Delete any nodes specified for skipping
+        skipped = remove_skipped_nodes(soup, self.profile.skip_nodes)
+        if skipped:
+            utils.add_stat(self.feedname, "nodes skipped", skipped)
+            if self.verbose:
+                print("Removed %d skip_nodes" % skipped, file=sys.stderr)
+
         # Does the page have an H1 header already? If not, manufacture one.
         if title and not soup.h1:
             h1 = soup.new_tag("h1")
@@ -643,7 +769,7 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
                 t.decompose()
 
         # Remove img if skipping images
-        if utils.g_config.getboolean(self.feedname, 'skip_images'):
+        if self.profile.skip_images:
             for tagname in [ "img", "svg", "figure" ]:
                 for t in soup.find_all(tagname):
                     t.decompose()
@@ -681,40 +807,37 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
                     self.outfile.write('<a href="' + href + '">'
                                        + href + '</a>')
 
-                    # Also set the refresh target as the single_page_url.
+                    # Also try the refresh target as a single-page URL.
                     # Maybe we can actually get it here.
-                    if not self.single_page_url:
-                        self.single_page_url = \
-                            imagecache.make_absolute(href, self.base_href)
+                    refresh_url = imagecache.make_absolute(href,
+                                                           self.base_href)
+                    if refresh_url not in self.single_page_urls:
+                        self.single_page_urls.append(refresh_url)
                         if self.verbose:
-                            print("\nTrying meta refresh as single-page pat:", \
-                                  self.single_page_url.encode('utf-8',
-                                                        'xmlcharrefreplace'),
+                            print("\nTrying meta refresh as single-page pat:",
+                                  refresh_url.encode('utf-8',
+                                                     'xmlcharrefreplace'),
                                   file=sys.stderr)
                 # XXX Note that this won't skip the </meta> tag, unfortunately,
                 # and doesn't distinguish meta refresh from any other meta tags.
 
-        if utils.g_config.getboolean(self.feedname, 'skip_links'):
+        if self.profile.skip_links:
             for t in soup.find_all("a"):
                 t.replace_with_children()
 
-        # Look for a tags matching the single-page pattern,
-        # if we're not already following one.
-        if not self.single_page_url:
-            # print("we're not in the single page already")
-            single_page_pats = utils.g_config.get_multiline(self.feedname,
-                                                            'single_page_pats')
-            for single_page_pat in single_page_pats:
-                singlepage = soup.find("a", href=single_page_pat)
-                if singlepage:
-                    self.single_page_url = imagecache.make_absolute(
-                        singlepage.href)
+        # Look for a tags matching any of the single-page patterns.
+        # They'll all be tried, but continue processing the regular page,
+        # since the single-page ones may fail.
+        for single_page_pat in self.profile.single_page_pats:
+            singlepage = soup.find("a", href=single_page_pat)
+            if singlepage:
+                single_page_url = imagecache.make_absolute(
+                    singlepage.get('href'), self.base_href)
+                if single_page_url not in self.single_page_urls:
+                    self.single_page_urls.append(single_page_url)
                     if self.verbose:
-                        print("\nFound single-page pattern:", \
-                              self.single_page_url, file=sys.stderr)
-                        # But continue fetching the regular pattern,
-                        # since the single-page one may fail
-                        break
+                        print("\nFound single-page pattern:",
+                              single_page_url, file=sys.stderr)
 
 
         # Try to make links absolute.
@@ -732,23 +855,19 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
             if 'color' in style or 'background' in style:
                 del t.attrs["style"]
 
-        # Finally, handle images
-        for tagname in [ "img", "svg" ]:
-            for t in soup.find_all(tagname):
-                try:
-                    imagecache.process_img_tag(t, self.feedname,
-                                               self.base_href, self.newdir)
-                except Exception as e:
-                    print("Error handling image tag", t, ":", e,
-                          file=sys.stderr)
-                    utils.ptraceback()
+        # Finally, handle images. All of the page's images are fetched
+        # together, so they can be downloaded in parallel.
+        imagecache.process_img_tags(soup.find_all([ "img", "svg" ]),
+                                    self.feedname, self.base_href,
+                                    self.newdir, cancel=self.cancel)
 
         # find out if there will be a need to look for subsequent pages
-        multipage_pat = utils.g_config.get(self.feedname, "multipage_pat",
-                                           fallback=None)
+        multipage_pat = self.profile.multipage_pat
         if multipage_pat:
-            links = soup.find_all('a', href=re.compile(multipage_pat))
-            self.multipages = [ a.attrs['href'] for a in links ]
+            links = soup.find_all('a', href=multipage_pat)
+            self.multipages = [ imagecache.make_absolute(a.attrs['href'],
+                                                         self.base_href)
+                                for a in links ]
 
             # Eliminate duplicates
             self.multipages = list(dict.fromkeys(self.multipages))
@@ -760,65 +879,226 @@ class FeedmeHTMLParser(FeedmeURLDownloader):
             self.multipages = None
 
         # Done with processing! Write the soup's body to self.outfile.
-        pretty = soup.body.prettify()
-        if pretty:
+        bodyhtml, saved = serialize_body(soup, self.profile.output_style)
+        if bodyhtml:
             if footer:
-                # pretty already ends with </body>, so find the last
+                # bodyhtml already ends with </body>, so find the last
                 # occurrence of </body> and prepend the footer.
                 # Anything after the last </body> will be lost,
                 # but there shouldn't be anything there.
-                spl = pretty.rsplit('</body>', 1)
-                pretty = spl[0] + footer + '\n</body>\n</html>\n'
-            self.outfile.write(pretty)
+                spl = bodyhtml.rsplit('</body>', 1)
+                bodyhtml = spl[0] + footer + '\n</body>\n</html>\n'
+            self.outfile.write(bodyhtml)
+            # To recognize duplicate pages in multi-page stories:
+            self.body_hash = hashlib.sha1(
+                bodyhtml.encode('utf-8', 'replace')).digest()
             self.wrote_data = True
+            utils.add_stat(self.feedname, "story bytes written",
+                           len(bodyhtml.encode('utf-8', 'replace')))
+            if saved:
+                utils.add_stat(self.feedname, "bytes saved vs. prettify",
+                               saved)
         else:
             print("Empty body! Not writing", file=sys.stderr)
 
 
+# Start of any block prescrub_html() knows how to cut.
+PRESCRUB_START_RE = re.compile(
+    r'<!--|<(script|style|template|noscript)(?=[\s>/])', flags=re.IGNORECASE)
+
+# Where each type of block ends. As in a real HTML parser, the first
+# closing tag ends the block, whatever its contents.
+PRESCRUB_END_RES = {
+    tag: re.compile(r'</%s\s*>' % tag, flags=re.IGNORECASE)
+    for tag in ("script", "style", "template", "noscript")
+}
+PRESCRUB_END_RES["comments"] = re.compile(r'-->')
+
+# Blocks whose contents the parser doesn't look inside, so even when
+# they're kept, anything in them that looks like a block isn't one.
+PRESCRUB_OPAQUE = { "script", "style", "comments" }
+
+
+def prescrub_html(html, cut=("script", "style")):
+    """Remove whole blocks from raw HTML text without parsing it:
+       any of script, style, template or noscript elements,
+       plus HTML comments if cut includes "comments".
+       Pages are often mostly inline scripts, JSON-LD and styles,
+       and this is much faster than having BeautifulSoup build them
+       into a tree only to decompose them.
+       Returns the scrubbed html.
+    """
+    pieces = []
+    pos = 0
+    while True:
+        match = PRESCRUB_START_RE.search(html, pos)
+        if not match:
+            break
+
+        if match.group(1):
+            blocktype = match.group(1).lower()
+        else:
+            blocktype = "comments"
+        if blocktype not in cut and blocktype not in PRESCRUB_OPAQUE:
+            pieces.append(html[pos:match.end()])
+            pos = match.end()
+            continue
+
+        endmatch = PRESCRUB_END_RES[blocktype].search(html, match.end())
+        if not endmatch:
+            # Unterminated block: leave the rest for the real parser.
+            break
+
+        if blocktype not in cut:
+            # Keep the whole block, and go on looking after it.
+            pieces.append(html[pos:endmatch.end()])
+            pos = endmatch.end()
+            continue
+
+        pieces.append(html[pos:match.start()])
+        pos = endmatch.end()
+
+    if not pieces:
+        return html
+    pieces.append(html[pos:])
+    return ''.join(pieces)
+
+
+# Tags inside which whitespace is significant and must be left alone.
+PRESERVE_WHITESPACE_TAGS = { "pre", "textarea" }
+
+# Attributes that mean something even when empty, so minify keeps them:
+# alt, plus HTML's boolean attributes, which are on just by being there.
+KEEP_EMPTY_ATTRS = {
+    "alt",
+    "allowfullscreen", "async", "autofocus", "autoplay", "checked",
+    "controls", "default", "defer", "disabled", "formnovalidate",
+    "hidden", "inert", "ismap", "itemscope", "loop", "multiple", "muted",
+    "nomodule", "novalidate", "open", "playsinline", "readonly",
+    "required", "reversed", "selected",
+}
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def serialize_body(soup, style='compact'):
+    """Serialize the <body> of a soup to a string for writing to a story file.
+       style can be:
+         compact: no added indentation or newlines (the default);
+         minify:  compact, plus collapse runs of whitespace in text
+                  and drop comments and empty attributes;
+         pretty:  BeautifulSoup's prettify(), one node per line.
+                  Much bigger and slower, but sometimes handy for debugging.
+       Returns (html, saved) where saved is roughly how many bytes
+       smaller the output is than prettify() would have made it.
+    """
+    if not soup.body:
+        return None, 0
+
+    if style == 'pretty':
+        return soup.body.prettify(), 0
+
+    if style not in ('compact', 'minify'):
+        print("Unknown output_style '%s', using compact" % style,
+              file=sys.stderr)
+        style = 'compact'
+
+    saved = compact_tree(soup.body, minify=(style == 'minify'))
+    return soup.body.decode(), saved
+
+
+def compact_tree(top, minify=False):
+    """Walk the tree under top, estimating how many bytes prettify()
+       would have added in indentation and newlines.
+       If minify is true, also collapse whitespace in text and remove
+       comments and empty attributes, modifying the tree in place.
+       Returns the estimated number of bytes saved relative to prettify().
+    """
+    saved = 0
+
+    # Each entry is (node, depth, inside a whitespace-preserving tag)
+    stack = [ (top, 0, False) ]
+    while stack:
+        node, depth, preserve = stack.pop()
+
+        # prettify() puts every node on its own line,
+        # indented one space per level.
+        linecost = depth + 1
+
+        if isinstance(node, Comment):
+            if minify:
+                saved += len(node) + len("<!---->") + linecost
+                node.extract()
+            else:
+                saved += linecost
+            continue
+
+        if isinstance(node, NavigableString):
+            if preserve:
+                continue
+            stripped = node.strip()
+            # prettify() strips text and skips whitespace-only strings.
+            prettylen = len(stripped) + linecost if stripped else 0
+            if minify and type(node) is NavigableString:
+                collapsed = WHITESPACE_RE.sub(' ', node)
+                if len(collapsed) != len(node):
+                    node.replace_with(collapsed)
+                saved += prettylen - len(collapsed)
+            else:
+                saved += prettylen - len(node)
+            continue
+
+        # It's a Tag. Opening and closing tags each get their own line,
+        # except for void elements like <br> which only have one.
+        if node.is_empty_element:
+            saved += linecost
+        else:
+            saved += 2 * linecost
+
+        if minify:
+            for attr, val in list(node.attrs.items()):
+                if not val and attr not in KEEP_EMPTY_ATTRS:
+                    del node.attrs[attr]
+                    saved += len(' %s=""' % attr)
+
+        preserve = preserve or node.name in PRESERVE_WHITESPACE_TAGS
+        for child in node.contents:
+            stack.append((child, depth + 1, preserve))
+
+    return saved
+
+
+def remove_skipped_nodes(soup, skip_nodes):
+    """Remove any nodes matching skip_nodes (a siteprofile.SkipNodes)
+       from soup, in one pass over the tree.
+       Returns the number of nodes removed.
+    """
+    if not skip_nodes:
+        return 0
+
+    removed = 0
+    for node in soup.find_all(True):
+        # Nodes inside something already removed have been decomposed too.
+        if node.decomposed:
+            continue
+        if skip_nodes.matches(node):
+            node.decompose()
+            removed += 1
+    return removed
+
+
 def delete_skipped_nodes(html, feedname):
     """If skip_nodes is set for this feed, remove any matching nodes
        from the HTML, returning rewritten HTML.
     """
-    skip_nodespecs = utils.g_config.get_multiline(feedname,
-                                                  'skip_nodes')
-    if not skip_nodespecs:
+    skip_nodes = get_profile(feedname).skip_nodes
+    if not skip_nodes:
         return html
 
     soup = BeautifulSoup(html, "lxml")
-
-    changed = False
-    for nodespec in skip_nodespecs:
-        print("looking for skip_node", nodespec, file=sys.stderr)
-
-        # Syntax is something like: div class="sticky-box"
-        # first word should be node type,
-        # which may be followed by someattr="somename"
-        try:
-            print("nodespec:", nodespec)
-            nodename, attrname, attrval = \
-                re.match(SKIP_NODE_PAT, nodespec).groups()
-            print((f"nodename '{nodename}', "
-                   f"attrname '{attrname}', "
-                   f"attrval='{attrval}'"), file=sys.stderr)
-
-            # attrval is a regexp, which BS won't notice unless
-            # it's already compiled.
-            attrval = re.compile(attrval)
-            for node in soup.find_all(nodename,
-                                      attrs={ attrname: attrval }):
-                print("  Found a node:", node)
-                node.decompose()
-                changed = True
-        except Exception as e:
-            print("Problem finding SKIP_NODE_PAT '%s': %s"
-                  % (nodespec, e), file=sys.stderr)
-            utils.ptraceback()
-            continue
-    if changed:
-        print("Changed nodes in the HTML: rewriting", file=sys.stderr)
+    if remove_skipped_nodes(soup, skip_nodes):
         return str(soup)
-    else:
-        return html
+    return html
 
 
 def simplify_html(inhtml):
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""Per-feed site profiles: every config value the fetching code needs
+   for one feed, looked up, converted and (for patterns) compiled once,
+   rather than going through ConfigParser interpolation and re-splitting
+   multiline strings for every story and every image.
+"""
+
+import re
+import sys
+
+import soupsieve
+
+import utils
+
+
+# The original skip_nodes syntax: tagname attrname="regexp"
+SKIP_NODE_PAT = r'''\s*([a-zA-Z\d]+)\s+(?:([a-zA-Z]+)\s*=\s*['"](.*)['"])?'''
+
+
+class SkipNodes(object):
+    """A feed's skip_nodes, compiled so they can be tested against
+       every tag in a page in a single pass.
+       Each line of skip_nodes can be either the original syntax,
+           div class="advertisement"
+       where the attribute value is a regular expression,
+       or a CSS selector, like
+           div.advertisement, aside[data-ad], figure > .newsletter
+    """
+    __slots__ = ("attr_matchers", "selector")
+
+    def __init__(self, feedname, nodespecs):
+        # Old-style specs: list of (tagname, attrname, compiled regexp)
+        attr_matchers = []
+        selectors = []
+
+        for nodespec in nodespecs:
+            nodespec = nodespec.strip()
+            if not nodespec:
+                continue
+
+            # Anything that's entirely old-style syntax is old-style;
+            # otherwise try it as a CSS selector.
+            match = re.fullmatch(SKIP_NODE_PAT + r'\s*', nodespec)
+            if not match or not match.group(2):
+                try:
+                    soupsieve.compile(nodespec)
+                    selectors.append(nodespec)
+                    continue
+                except Exception as e:
+                    # Old versions allowed junk after the attribute value.
+                    match = re.match(SKIP_NODE_PAT, nodespec)
+                    if not match or not match.group(2):
+                        print("%s: Couldn't parse skip_nodes '%s': %s"
+                              % (feedname, nodespec, e), file=sys.stderr)
+                        continue
+
+            nodename, attrname, attrval = match.groups()
+            try:
+                attr_matchers.append((nodename.lower(), attrname,
+                                      re.compile(attrval)))
+            except re.error as e:
+                print("%s: Couldn't compile skip_nodes regexp '%s': %s"
+                      % (feedname, attrval, e), file=sys.stderr)
+
+        object.__setattr__(self, "attr_matchers", tuple(attr_matchers))
+        if selectors:
+            object.__setattr__(self, "selector",
+                               soupsieve.compile(', '.join(selectors)))
+        else:
+            object.__setattr__(self, "selector", None)
+
+    def __setattr__(self, name, val):
+        raise AttributeError("SkipNodes is read-only")
+
+    def __bool__(self):
+        return bool(self.attr_matchers or self.selector)
+
+    def matches(self, tag):
+        """Does a BeautifulSoup tag match any of the skip_nodes?"""
+        for nodename, attrname, regexp in self.attr_matchers:
+            if tag.name != nodename:
+                continue
+            val = tag.attrs.get(attrname)
+            if val is None:
+                continue
+            # Multi-valued attributes like class are lists.
+            # Like BeautifulSoup's find_all, match either any single value
+            # or the whole space-separated string.
+            if isinstance(val, list):
+                if any(regexp.search(v) for v in val) \
+                   or regexp.search(' '.join(val)):
+                    return True
+            elif regexp.search(val):
+                return True
+
+        return bool(self.selector and self.selector.match(tag))
+
+
+def compile_patterns(feedname, configname, patterns, flags=0):
+    """Compile a list of regexp strings, skipping (with a message)
+       any that won't compile. Returns a tuple of compiled regexps.
+    """
+    compiled = []
+    for pat in patterns:
+        try:
+            compiled.append(re.compile(pat, flags=flags))
+        except re.error as e:
+            print("%s: Couldn't compile %s regexp '%s': %s"
+                  % (feedname, configname, pat, e), file=sys.stderr)
+    return tuple(compiled)
+
+
+class SiteProfile(object):
+    """Config values for a single feed, read once from utils.g_config.
+       Profiles are read-only once created: get one with get_profile().
+    """
+    __slots__ = (
+        "feedname",
+        "verbose", "levels", "formats", "encoding", "ascii", "user_agent",
+        "nocache", "allow_repeats", "allow_dup_titles", "allow_gzip",
+        "continue_on_timeout", "min_width", "rss_entry_size",
+        "simplify_rss", "skip_links", "story_url_rewrite", "url_substitute",
+        "output_style", "prescrub", "extract_content",
+        "page_starts", "page_ends", "skip_pats", "skip_nodes",
+        "single_page_pats", "multipage_pat",
+        "skip_link_pats", "skip_title_pats", "skip_content_pats",
+        "index_skip_content_pats",
+        "skip_images", "nonlocal_images", "block_nonlocal_images",
+        "alt_domains", "max_image_size", "max_srcset_size", "png_to_jpg",
+        "image_fetch_threads", "image_store",
+        "max_image_bytes", "min_image_size",
+        "image_formats", "image_quality", "image_target_bytes",
+        "strip_image_metadata", "dedup_images",
+        "viewport_width", "device_pixel_ratio", "max_display_width",
+        "animated_images", "max_animation_bytes", "inline_image_bytes",
+    )
+
+    def __init__(self, feedname):
+        config = utils.g_config
+
+        def setval(name, val):
+            object.__setattr__(self, name, val)
+
+        def getbool(name):
+            try:
+                return config.getboolean(feedname, name)
+            except ValueError:
+                print("%s: %s isn't a boolean, using false"
+                      % (feedname, name), file=sys.stderr)
+                return False
+
+        def getint(name, default):
+            try:
+                return int(config.get(feedname, name, fallback=None))
+            except (ValueError, TypeError):
+                return default
+
+        def getpats(name, flags=0):
+            return compile_patterns(feedname, name,
+                                    config.get_multiline(feedname, name),
+                                    flags)
+
+        setval("feedname", feedname)
+
+        setval("verbose", getbool('verbose'))
+        setval("levels", float(config.get(feedname, 'levels')))
+        setval("formats", tuple(config.get(feedname, 'formats').split(',')))
+        setval("encoding", config.get(feedname, 'encoding'))
+        setval("ascii", getbool('ascii'))
+        setval("user_agent", config.get(feedname, 'user_agent'))
+        setval("nocache", getbool('nocache'))
+        setval("allow_repeats", getbool('allow_repeats'))
+        setval("allow_dup_titles", getbool('allow_dup_titles'))
+        setval("allow_gzip", getbool('allow_gzip'))
+        setval("continue_on_timeout", getbool('continue_on_timeout'))
+        setval("min_width", getint('min_width', 25))
+        setval("rss_entry_size", getint('rss_entry_size', 0))
+        setval("simplify_rss", getbool('simplify_rss'))
+        setval("skip_links", getbool('skip_links'))
+        setval("story_url_rewrite",
+               tuple(config.get_multiline(feedname, 'story_url_rewrite')))
+        setval("url_substitute",
+               tuple(config.get_multiline(feedname, 'url_substitute')))
+        setval("output_style", config.get(feedname, 'output_style'))
+        setval("prescrub", tuple(config.get(feedname, 'prescrub').split()))
+        extract = config.get(feedname, 'extract_content').lower()
+        if extract != 'fallback':
+            extract = getbool('extract_content')
+        setval("extract_content", extract)
+
+        # Patterns applied to the text of each story
+        setval("page_starts", getpats('page_start'))
+        setval("page_ends", getpats('page_end'))
+        setval("skip_pats", getpats('skip_pats', flags=re.DOTALL))
+        setval("skip_nodes",
+               SkipNodes(feedname,
+                         config.get_multiline(feedname, 'skip_nodes')))
+        setval("single_page_pats", getpats('single_page_pats'))
+        multipage_pat = config.get(feedname, 'multipage_pat', fallback=None)
+        if multipage_pat:
+            multipage_pat = compile_patterns(feedname, 'multipage_pat',
+                                             [ multipage_pat ])
+        setval("multipage_pat", multipage_pat[0] if multipage_pat else None)
+
+        # Patterns for deciding whether to skip a whole story
+        setval("skip_link_pats", getpats('skip_link_pats'))
+        setval("skip_title_pats",
+               getpats('skip_title_pats', flags=re.IGNORECASE))
+        setval("skip_content_pats", getpats('skip_content_pats'))
+        setval("index_skip_content_pats", getpats('index_skip_content_pats'))
+
+        # Images
+        setval("skip_images", getbool('skip_images'))
+        setval("nonlocal_images", getbool('nonlocal_images'))
+        setval("block_nonlocal_images", getbool('block_nonlocal_images'))
+        setval("alt_domains",
+               tuple(config.get_multiline(feedname, 'alt_domains')))
+        setval("max_image_size", getint('max_image_size', 0))
+        setval("max_srcset_size", getint('max_srcset_size', 800))
+        setval("png_to_jpg", getbool('png_to_jpg'))
+        setval("image_fetch_threads", getint('image_fetch_threads', 4))
+        setval("image_store", getbool('image_store'))
+        setval("max_image_bytes", getint('max_image_bytes', 0))
+        setval("min_image_size", getint('min_image_size', 0))
+        setval("image_formats",
+               tuple(config.get(feedname, 'image_formats', fallback='jpeg')
+                     .lower().replace(',', ' ').split()))
+        setval("image_quality", getint('image_quality', 0))
+        setval("image_target_bytes", getint('image_target_bytes', 0))
+        setval("strip_image_metadata", getbool('strip_image_metadata'))
+        setval("dedup_images", getbool('dedup_images'))
+
+        # The device the feed will be read on, for choosing from srcsets.
+        # max_srcset_size is the old name for viewport_width.
+        setval("viewport_width",
+               getint('viewport_width', 0) or self.max_srcset_size)
+        try:
+            setval("device_pixel_ratio",
+                   float(config.get(feedname, 'device_pixel_ratio')))
+        except (ValueError, TypeError):
+            setval("device_pixel_ratio", 1.)
+        setval("max_display_width", getint('max_display_width', 0))
+
+        animated = config.get(feedname, 'animated_images').strip().lower()
+        if animated not in ('keep', 'still', 'webp', 'link'):
+            print("%s: animated_images should be keep, still, webp or link"
+                  % feedname, file=sys.stderr)
+            animated = 'keep'
+        setval("animated_images", animated)
+        setval("max_animation_bytes", getint('max_animation_bytes', 0))
+        setval("inline_image_bytes", getint('inline_image_bytes', 0))
+
+    def __setattr__(self, name, val):
+        raise AttributeError("SiteProfile is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("SiteProfile is read-only")
+
+    def __repr__(self):
+        return "SiteProfile(%s)" % self.feedname
+
+
+# Profiles built so far, and the config object they were built from:
+# if the config is re-read, all the profiles have to be rebuilt.
+g_profiles = {}
+g_profiles_config = None
+
+
+def get_profile(feedname):
+    """Return the SiteProfile for feedname, creating it if needed."""
+    global g_profiles, g_profiles_config
+
+    if g_profiles_config is not utils.g_config:
+        g_profiles = {}
+        g_profiles_config = utils.g_config
+
+    try:
+        return g_profiles[feedname]
+    except KeyError:
+        profile = SiteProfile(feedname)
+        g_profiles[feedname] = profile
+        return profile
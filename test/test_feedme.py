@@ -11,8 +11,13 @@ import subprocess
 import time
 import shutil
 import filecmp
+import json
+import threading
+from contextlib import contextmanager
 import sys, os
 
+from bs4 import BeautifulSoup
+
 import pageparser
 import feedme
 import utils
@@ -147,6 +152,8 @@ page_end = <div id="comment-form-nascar">
         CONFFILE = 'test/config/wired.conf'
         shutil.copyfile('siteconf/wired.conf', CONFFILE)
         utils.read_config_file(confdir='test/config')
+        # The expected output was saved with prettify()
+        utils.g_config.set('Wired', 'output_style', 'pretty')
 
         fmp = pageparser.FeedmeHTMLParser('Wired')
         fmp.fetch_url('file://test/samples/wired-orig.html', TMPDIR, '0.html')
@@ -159,3 +166,1107 @@ page_end = <div id="comment-form-nascar">
         os.unlink(CONFFILE)
 
         self.assertLongStringEqual(expectcontents, fetchedcontents)
+
+    def fetch_wired(self, **settings):
+        """Run the wired sample through fetch_url with the given
+           config settings, returning the contents of the output file.
+        """
+        TMPDIR = "test/tmp"
+        os.makedirs(TMPDIR, exist_ok=True)
+        CONFFILE = 'test/config/wired.conf'
+        shutil.copyfile('siteconf/wired.conf', CONFFILE)
+        utils.read_config_file(confdir='test/config')
+        for key in settings:
+            utils.g_config.set('Wired', key, settings[key])
+
+        fmp = pageparser.FeedmeHTMLParser('Wired')
+        fmp.fetch_url('file://test/samples/wired-orig.html', TMPDIR, '0.html')
+        with open(os.path.join(TMPDIR, '0.html'), encoding='utf-8') as fp:
+            contents = fp.read()
+
+        shutil.rmtree(TMPDIR)
+        os.unlink(CONFFILE)
+        return contents
+
+    @contextmanager
+    def cache_env(self, **settings):
+        """Read the test config, with settings in its DEFAULT section,
+           and use a temporary cache directory (not created yet),
+           which is what this yields.
+        """
+        from cache import FeedmeCache
+
+        utils.read_config_file(confdir='test/config')
+        for key in settings:
+            utils.g_config.set('DEFAULT', key, str(settings[key]))
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             patch.dict(os.environ, { 'XDG_CACHE_HOME': tmpdir }):
+            yield FeedmeCache.get_cache_dir()
+
+    @contextmanager
+    def image_env(self, **settings):
+        """Like cache_env(), but the settings are for Slashdot,
+           which starts out with no image stats. Yields (srcdir, newdir):
+           empty directories for images to fetch as file: URLs
+           and for the day's stories.
+        """
+        import imagecache
+
+        with self.cache_env() as cachedir:
+            for key in settings:
+                utils.g_config.set('Slashdot', key, str(settings[key]))
+            utils.g_feed_stats.pop('Slashdot', None)
+            imagecache.clear()
+            tmpdir = os.path.dirname(cachedir)
+            srcdir = os.path.join(tmpdir, 'src')
+            newdir = os.path.join(tmpdir, 'day1')
+            os.mkdir(srcdir)
+            os.mkdir(newdir)
+            yield srcdir, newdir
+
+    def test_output_styles(self):
+        """compact and minify should be smaller than pretty,
+           but have the same text.
+        """
+        def words(html):
+            return BeautifulSoup(html, 'lxml').get_text(' ').split()
+
+        pretty = self.fetch_wired(output_style='pretty')
+        compact = self.fetch_wired(output_style='compact')
+        minify = self.fetch_wired(output_style='minify')
+
+        self.assertLess(len(compact), len(pretty))
+        self.assertLessEqual(len(minify), len(compact))
+        self.assertEqual(words(pretty), words(compact))
+        self.assertEqual(words(pretty), words(minify))
+
+        soup = BeautifulSoup('<video controls class="" src="v.mp4"></video>'
+                             '<details open title=""><p>x</p></details>',
+                             'lxml')
+        minified, saved = pageparser.serialize_body(soup, 'minify')
+        self.assertIn('<video controls="" src="v.mp4">', minified)
+        self.assertIn('<details open="">', minified)
+        self.assertNotIn('class', minified)
+        self.assertNotIn('title', minified)
+
+    def test_prescrub(self):
+        """Prescrubbing should cut blocks from the raw HTML
+           without changing the output.
+        """
+        html = """<p>One<script type="text/javascript">if (a<b) x = "</p>";
+</SCRIPT ><!-- <p>comment</p> -->Two<style>p { color: red; }</style>
+<noscript><img src="x.jpg"></noscript></p>"""
+        self.assertEqual(pageparser.prescrub_html(html),
+                         """<p>One<!-- <p>comment</p> -->Two
+<noscript><img src="x.jpg"></noscript></p>""")
+        self.assertEqual(pageparser.prescrub_html(
+            html, ("script", "style", "noscript", "comments")),
+                         "<p>OneTwo\n</p>")
+        # An unterminated block is left for the parser:
+        self.assertEqual(pageparser.prescrub_html("<p>a<script>b"),
+                         "<p>a<script>b")
+        # Kept comments and scripts are skipped over whole:
+        self.assertEqual(pageparser.prescrub_html(
+            "<!-- <script> -->Important<script>x</script>"),
+                         "<!-- <script> -->Important")
+        self.assertEqual(pageparser.prescrub_html(
+            '<script>s = "<!--";</script>Important<!-- c -->',
+            ("comments",)),
+                         '<script>s = "<!--";</script>Important')
+
+        # Use the whole page, not just the part between page_start
+        # and page_end, since that's where the scripts are.
+        full_page = { 'page_start': '', 'page_end': '' }
+        self.assertEqual(self.fetch_wired(prescrub='', **full_page),
+                         self.fetch_wired(**full_page))
+        self.assertEqual(
+            self.fetch_wired(prescrub='', output_style='minify', **full_page),
+            self.fetch_wired(prescrub='script style comments',
+                             output_style='minify', **full_page))
+
+    def test_skip_nodes(self):
+        """skip_nodes can mix the old tag attr="regexp" syntax
+           with CSS selectors.
+        """
+        from siteprofile import SkipNodes
+
+        html = """<body><div class="story">
+<div class="sticky-box wide"><p>sticky</p></div>
+<aside data-ad="1"><p>ad</p></aside>
+<p class="newsletter">Sign up</p>
+<figure><p class="newsletter">Sign up here too</p></figure>
+<p>Real content</p>
+</div></body>"""
+        skip_nodes = SkipNodes('test', [ 'div class="sticky-box"',
+                                         'aside[data-ad]',
+                                         'figure > .newsletter',
+                                         '' ])
+        soup = BeautifulSoup(html, 'lxml')
+        self.assertEqual(pageparser.remove_skipped_nodes(soup, skip_nodes),
+                         3)
+        self.assertEqual(soup.get_text(' ').split(),
+                         [ 'Sign', 'up', 'Real', 'content' ])
+
+        self.assertFalse(SkipNodes('test', []))
+
+    def test_multipage(self):
+        """Extra pages are appended in order, skipping duplicates;
+           a single-page version replaces the paged story.
+        """
+        TMPDIR = "test/tmp"
+        os.makedirs(TMPDIR, exist_ok=True)
+        CONFFILE = 'test/config/wired.conf'
+        shutil.copyfile('siteconf/wired.conf', CONFFILE)
+
+        def read_config(**settings):
+            # The site profile is cached, so settings can't be changed
+            # after the first fetch without re-reading the config.
+            utils.read_config_file(confdir='test/config')
+            settings.update(page_start='', page_end='', skip_nodes='',
+                            skip_images='true')
+            for key in settings:
+                utils.g_config.set('Wired', key, settings[key])
+
+        def write_page(name, text, links=''):
+            with open(os.path.join(TMPDIR, name), 'w') as fp:
+                fp.write('<html><body><p>%s</p>%s</body></html>'
+                         % (text, links))
+
+        links = ''.join('<a href="file://test/tmp/%s.html">%s</a>'
+                        % (name, name)
+                        for name in ('page1', 'page2', 'page3', 'page3a'))
+        write_page('page1.html', 'First page', links)
+        write_page('page2.html', 'Second page')
+        write_page('page3.html', 'Third page')
+        write_page('page3a.html', 'Third page')
+        write_page('single.html', 'The whole story')
+
+        def words(filename):
+            with open(os.path.join(TMPDIR, filename)) as fp:
+                soup = BeautifulSoup(fp.read(), 'lxml')
+            return [ w for p in soup.find_all('p')
+                     for w in p.get_text(' ').split()
+                     if w not in ('page1', 'page2', 'page3', 'page3a', 'all') ]
+
+        try:
+            read_config(multipage_pat='page[0-9]')
+            fmp = pageparser.FeedmeHTMLParser('Wired')
+            fmp.fetch_url('file://test/tmp/page1.html', TMPDIR, '0.html')
+            self.assertEqual(words('0.html'),
+                             [ 'First', 'page', 'Second', 'page',
+                               'Third', 'page' ])
+
+            read_config(single_page_pats='single')
+            write_page('page1.html', 'First page',
+                       '<a href="file://test/tmp/single.html">all</a>')
+            fmp = pageparser.FeedmeHTMLParser('Wired')
+            fmp.fetch_url('file://test/tmp/page1.html', TMPDIR, '1.html')
+            self.assertEqual(words('1.html'), [ 'The', 'whole', 'story' ])
+        finally:
+            shutil.rmtree(TMPDIR)
+            os.unlink(CONFFILE)
+
+    def test_extract_content(self):
+        """Content extraction should find the article without page_start."""
+        import extractor
+
+        html = """<html><body>
+<nav><ul><li><a href="/">Home</a></li><li><a href="/news">News</a></li></ul></nav>
+<div class="sidebar"><p><a href="/a">A story you might like, with a long title</a></p></div>
+<div class="story">
+<p>This is the first paragraph of the story, which goes on, and on, and on.</p>
+<p>This is the second paragraph, which has a lot of words too, for a paragraph.</p>
+<p>This is the third paragraph, with still more words, commas, and so forth.</p>
+<p>And finally the fourth paragraph, so there's a reasonable amount of text.</p>
+</div>
+<div class="comments"><p>First comment! This article is great, really great.</p></div>
+</body></html>"""
+        content = extractor.extract_content(html)
+        words = BeautifulSoup(content, 'lxml').get_text(' ').split()
+        self.assertEqual(words[:3], [ 'This', 'is', 'the' ])
+        self.assertEqual(words[-3:], [ 'amount', 'of', 'text.' ])
+
+        # Nothing article-like:
+        self.assertIsNone(extractor.extract_content(
+            "<html><body><p>Hello, world</p></body></html>"))
+
+        # The Wired sample, without page_start or page_end,
+        # should get about the same text as with them.
+        regexp = self.fetch_wired()
+        extracted = self.fetch_wired(page_start='', page_end='',
+                                     extract_content='true')
+        self.assertIn("they say you never get the same shot twice",
+                      extracted)
+        self.assertNotIn("ContentFooterWrapper", extracted)
+        self.assertLess(len(extracted), len(regexp) * 3)
+
+    def test_concurrent_images(self):
+        """A page's images are fetched once per src, resized,
+           and the tags rewritten in order.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_size=1200,
+                            image_fetch_threads=3) as (srcdir, newdir):
+            for name, size in (('big.png', (2000, 1000)),
+                               ('small.jpg', (300, 200))):
+                Image.new('RGB', size, 'blue').save(
+                    os.path.join(srcdir, name))
+
+            base = 'file://' + srcdir + '/'
+            soup = BeautifulSoup("""<body>
+<img src="big.png" width="2000" height="1000">
+<img src="small.jpg">
+<img src="big.png" width="2000" height="1000">
+<img src="missing.jpg">
+<img src="data:image/png;base64,AAAA">
+</body>""", 'lxml')
+
+            imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                        base, newdir)
+            imgs = soup.find_all('img')
+
+            self.assertTrue(imgs[0]['src'].endswith('_big.jpg'))
+            self.assertEqual(imgs[0]['src'], imgs[2]['src'])
+            self.assertEqual((imgs[0]['width'], imgs[0]['height']),
+                             ('1200', '600'))
+            self.assertEqual(Image.open(os.path.join(newdir,
+                                                     imgs[0]['src'])).size,
+                             (1200, 600))
+            # A small JPEG is used as it is, not decoded and re-encoded.
+            self.assertTrue(filecmp.cmp(os.path.join(srcdir, 'small.jpg'),
+                                        os.path.join(newdir, imgs[1]['src']),
+                                        shallow=False))
+            self.assertEqual(imgs[3]['src'], 'file:///nonexistant')
+            self.assertTrue(imgs[4]['src'].startswith('data:'))
+            self.assertEqual(
+                utils.g_feed_stats['Slashdot']['repeated images coalesced'],
+                1)
+            self.assertEqual(sorted(os.listdir(newdir)),
+                             sorted([ imgs[0]['src'], imgs[1]['src'] ]))
+
+            # Two pages of a story fetched at the same time
+            # share one fetch of an image they both use.
+            Image.new('RGB', (2000, 1000), 'red').save(
+                os.path.join(srcdir, 'wide.png'))
+            fetch_one_image = imagecache.fetch_one_image
+            fetched = []
+
+            def slow_fetch(job, feedname):
+                fetched.append(job.src)
+                time.sleep(.2)
+                fetch_one_image(job, feedname)
+
+            pages = [ BeautifulSoup('<img src="wide.png">', 'lxml')
+                      for i in range(2) ]
+            with patch('imagecache.fetch_one_image', slow_fetch):
+                threads = [ threading.Thread(
+                    target=imagecache.process_img_tags,
+                    args=(page.find_all('img'), 'Slashdot', base, newdir))
+                            for page in pages ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(fetched), 1)
+            self.assertTrue(pages[0].img['src'].endswith('_wide.jpg'))
+            self.assertEqual(pages[0].img['src'], pages[1].img['src'])
+            self.assertTrue(os.path.exists(os.path.join(newdir,
+                                                        pages[0].img['src'])))
+
+            # A page that lost the race to a single-page version
+            # writes no images once it's been cancelled.
+            Image.new('RGB', (200, 100), 'green').save(
+                os.path.join(srcdir, 'unwanted.png'))
+            before = sorted(os.listdir(newdir))
+            cancel = threading.Event()
+            cancel.set()
+            page = BeautifulSoup('<img src="unwanted.png">', 'lxml')
+            imagecache.process_img_tags(page.find_all('img'), 'Slashdot',
+                                        base, newdir, cancel=cancel)
+            self.assertEqual(sorted(os.listdir(newdir)), before)
+            self.assertEqual(page.img['src'], 'file:///nonexistant')
+
+    def test_image_process_pool(self):
+        """With image_processes, images are transformed in worker
+           processes, and the results and CPU time come back from them.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_size=1200) as (srcdir, newdir):
+            utils.g_config.set('DEFAULT', 'image_processes', '1')
+            Image.effect_noise((2000, 1000), 64).save(
+                os.path.join(srcdir, 'big.png'))
+
+            soup = BeautifulSoup('<img src="big.png" width="2000">', 'lxml')
+            imagecache.shutdown_transform_pool()
+            try:
+                # Transforming in this process would fail.
+                with patch('imagecache.transcode_image',
+                           side_effect=AssertionError("not in a worker")):
+                    imagecache.process_img_tags(soup.find_all('img'),
+                                                'Slashdot',
+                                                'file://' + srcdir + '/',
+                                                newdir)
+                self.assertIsNotNone(imagecache.g_transform_pool)
+            finally:
+                imagecache.shutdown_transform_pool()
+
+            self.assertTrue(soup.img['src'].endswith('_big.jpg'))
+            self.assertEqual(soup.img['width'], '1200')
+            self.assertEqual(Image.open(os.path.join(newdir,
+                                                     soup.img['src'])).size,
+                             (1200, 600))
+            self.assertGreater(utils.g_feed_stats['Slashdot']
+                               ['image transform CPU seconds'], 0)
+
+    def test_image_store(self):
+        """Images fetched on one day are linked from the store on the next,
+           and removed from the store once no day uses them.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_size=1200) as (srcdir, day1):
+            Image.new('RGB', (2000, 1000), 'red').save(
+                os.path.join(srcdir, 'big.png'))
+            html = '<body><img src="big.png" width="2000"></body>'
+            base = 'file://' + srcdir + '/'
+            day2 = os.path.join(os.path.dirname(day1), 'day2')
+            os.mkdir(day2)
+
+            days = []
+            for newdir in (day1, day2):
+                imagecache.ImageCache.clear()
+                soup = BeautifulSoup(html, 'lxml')
+                imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                            base, newdir)
+                days.append((newdir, soup.img['src'], soup.img['width']))
+                # The second day has to get it from the store.
+                os.unlink(os.path.join(srcdir, 'big.png'))
+                Image.new('RGB', (10, 10), 'red').save(
+                    os.path.join(srcdir, 'big.png'))
+
+            self.assertEqual(days[0][1:], days[1][1:])
+            self.assertEqual(days[1][2], '1200')
+            stats = [ os.stat(os.path.join(newdir, src))
+                      for newdir, src, width in days ]
+            self.assertEqual(stats[0].st_ino, stats[1].st_ino)
+
+            storedir = imagecache.get_store_dir()
+            indexfile = os.path.join(storedir, 'index.json')
+            imagecache.clean_up_store(0)
+            with open(indexfile) as fp:
+                self.assertEqual(len(json.load(fp)), 1)
+
+            for newdir, src, width in days:
+                shutil.rmtree(newdir)
+            imagecache.clean_up_store(0)
+            self.assertEqual(os.listdir(storedir), [ 'index.json' ])
+            with open(indexfile) as fp:
+                self.assertEqual(json.load(fp), {})
+
+    def test_image_sniffing(self):
+        """Tiny images are dropped and huge ones become links,
+           without fetching them in full.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_bytes=20000) as (srcdir, newdir):
+            Image.new('P', (1, 1)).save(os.path.join(srcdir, 'pixel.gif'))
+            Image.radial_gradient('L').resize((2000, 2000)).save(
+                os.path.join(srcdir, 'huge.png'))
+            html = """<body><p>
+<img src="pixel.gif">
+<img src="spacer.gif" width="1" height="1px">
+<img src="huge.png">
+<img src="wide.png" width="100%" height="10">
+</p></body>"""
+            base = 'file://' + srcdir + '/'
+
+            soup = BeautifulSoup(html, 'lxml')
+            imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                        base, newdir)
+            imgs = soup.find_all('img')
+            self.assertEqual(len(imgs), 2)
+            self.assertEqual(imgs[0].a['href'], base + 'huge.png')
+            self.assertEqual(imgs[1]['src'], 'file:///nonexistant')
+            stats = utils.g_feed_stats['Slashdot']
+            self.assertEqual(stats['tiny images dropped'], 2)
+            self.assertEqual(stats['oversized images not fetched'], 1)
+            self.assertEqual(os.listdir(newdir), [])
+
+    def test_image_output_policy(self):
+        """Images are converted to the feed's preferred format,
+           to fit in image_target_bytes, and the sizes are reported,
+           even with max_image_size = 0, which only turns off resizing.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_size=0,
+                            image_formats='foo, webp jpeg',
+                            image_target_bytes=100000) as (srcdir, newdir):
+            gradient = Image.radial_gradient('L').resize((1500, 300))
+            noise = Image.effect_noise((1500, 300), 20)
+            Image.merge('RGB', (gradient, noise, gradient)).save(
+                os.path.join(srcdir, 'noise.png'))
+            html = '<body><img src="noise.png"></body>'
+
+            soup = BeautifulSoup(html, 'lxml')
+            imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                        'file://' + srcdir + '/', newdir)
+            self.assertTrue(soup.img['src'].endswith('.webp'))
+            self.assertEqual(Image.open(os.path.join(newdir,
+                                                     soup.img['src'])).size,
+                             (1500, 300))
+            # The original PNG is gone.
+            self.assertEqual(os.listdir(newdir), [ soup.img['src'] ])
+
+            stats = utils.g_feed_stats['Slashdot']
+            self.assertEqual(stats['image bytes before'],
+                             os.path.getsize(os.path.join(srcdir,
+                                                          'noise.png')))
+            self.assertEqual(stats['image bytes after'],
+                             os.path.getsize(os.path.join(newdir,
+                                                          soup.img['src'])))
+            self.assertTrue(75000 < stats['image bytes after'] <= 100000)
+
+    def test_dedup_images(self):
+        """The same picture under two URLs, at different sizes and
+           qualities, is only kept once, whether or not images are resized.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(dedup_images=True,
+                            max_image_size=0) as (srcdir, newdir):
+            im = Image.radial_gradient('L').resize((800, 600))
+            im = Image.merge('RGB',
+                             (im, im.transpose(Image.Transpose.ROTATE_180),
+                              im))
+            im.save(os.path.join(srcdir, 'photo.jpeg'), quality=90)
+            im.resize((400, 300)).save(
+                os.path.join(srcdir, 'photo-400x300.jpeg'), quality=60)
+            # Same picture, different shape: not a duplicate.
+            im.resize((400, 100)).save(os.path.join(srcdir, 'banner.jpeg'))
+
+            for img in ('photo.jpeg', 'photo-400x300.jpeg', 'banner.jpeg'):
+                # A story at a time, as feedme does it.
+                soup = BeautifulSoup('<img src="%s">' % img, 'lxml')
+                imagecache.process_img_tags(soup.find_all('img'),
+                                            'Slashdot',
+                                            'file://' + srcdir + '/',
+                                            newdir)
+                if img == 'photo.jpeg':
+                    first = soup.img['src']
+                elif img == 'photo-400x300.jpeg':
+                    self.assertEqual(soup.img['src'], first)
+
+            self.assertEqual(len(os.listdir(newdir)), 2)
+            stats = utils.g_feed_stats['Slashdot']
+            self.assertEqual(stats['duplicate images'], 1)
+            self.assertEqual(stats['duplicate image bytes saved'],
+                             os.path.getsize(os.path.join(
+                                 srcdir, 'photo-400x300.jpeg')))
+
+    def test_deferred_images(self):
+        """With deferred images, pages are written pointing at
+           placeholders, then patched once the images are fetched,
+           within the byte budget.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_size=1200) as (srcdir, newdir):
+            Image.new('RGB', (2000, 1000), 'red').save(
+                os.path.join(srcdir, 'first.png'))
+            Image.new('RGB', (200, 100), 'blue').save(
+                os.path.join(srcdir, 'second.png'))
+            html = """<p>Caf\xe9 one</p><img alt="&#8220;Red&#8221;"
+src="first.png" width="2000"><p>two</p><img alt="2 > 1" src="second.png">"""
+
+            imagecache.start_deferring()
+            soup = BeautifulSoup(html, 'lxml')
+            imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                        'file://' + srcdir + '/', newdir)
+            pagefile = os.path.join(newdir, 'page.html')
+            with open(pagefile, 'w', encoding='latin-1',
+                      errors='xmlcharrefreplace') as fp:
+                fp.write(str(soup))
+            # A page left behind by an earlier, interrupted run.
+            stale = '<img src="old.png" %s="0"><img %s="abcd-99">' % (
+                imagecache.DEFERRED_ATTR, imagecache.DEFERRED_ATTR)
+            stalefile = os.path.join(newdir, 'stale.html')
+            with open(stalefile, 'w') as fp:
+                fp.write(stale)
+            # One that can't be read at all.
+            os.mkdir(os.path.join(newdir, 'bad.html'))
+            # Nothing has been fetched yet.
+            self.assertEqual(sorted(os.listdir(newdir)),
+                             [ 'bad.html', 'page.html', 'stale.html' ])
+            self.assertEqual([ img['src'] for img in soup.find_all('img') ],
+                             [ 'file:///nonexistant' ] * 2)
+
+            # The first image uses up the budget.
+            feeds = imagecache.fetch_deferred_images(byte_budget=100,
+                                                     nthreads=1)
+            self.assertEqual(feeds, [ 'Slashdot' ])
+            self.assertEqual(imagecache.g_deferred, None)
+
+            with open(pagefile, encoding='latin-1') as fp:
+                patched = fp.read()
+            self.assertNotIn(imagecache.DEFERRED_ATTR, patched)
+            self.assertIn('Caf\xe9 one', patched)
+            self.assertIn('alt="&#8220;Red&#8221;"', patched)
+            with open(stalefile) as fp:
+                self.assertEqual(fp.read(), stale)
+            soup = BeautifulSoup(patched, 'lxml')
+            first, second = soup.find_all('img')
+            self.assertTrue(os.path.exists(os.path.join(newdir,
+                                                        first['src'])))
+            self.assertEqual(first['width'], '1200')
+            self.assertEqual(second.find_next('a')['href'],
+                             'file://' + srcdir + '/second.png')
+            self.assertEqual(second['alt'], '2 > 1')
+
+    def test_srcset_choice(self):
+        """srcset, sizes and <picture> sources are chosen for the device."""
+        import imagecache
+        from siteprofile import get_profile
+
+        utils.read_config_file(confdir='test/config')
+        utils.g_config.set('Slashdot', 'viewport_width', '400')
+        utils.g_config.set('Slashdot', 'device_pixel_ratio', '2')
+        utils.g_config.set('Slashdot', 'max_display_width', '300')
+        profile = get_profile('Slashdot')
+
+        def choose(html):
+            soup = BeautifulSoup(html, 'lxml')
+            return imagecache.choose_srcset_src(soup.img, profile)
+
+        # Half of a 400px screen at 2x needs 400 pixels.
+        self.assertEqual(choose('<img srcset="a.jpg 300w, b.jpg 600w, '
+                                'c.jpg 1200w" sizes="(max-width: 500px) '
+                                '50vw, 100vw">'), 'b.jpg')
+        # Shown at most 300px wide, at 2x.
+        self.assertEqual(choose('<img srcset="a.jpg, b.jpg 2x, c.jpg 3x">'),
+                         'b.jpg')
+        # Nothing big enough: take the biggest.
+        self.assertEqual(choose('<img srcset="a.jpg 100w, b.jpg 200w">'),
+                         'b.jpg')
+        self.assertEqual(choose('''<picture>
+<source media="(min-width: 1000px)" srcset="big.jpg 2000w">
+<source type="image/x-unknown" srcset="x.unk 700w">
+<source srcset="s1.webp 500w, s2.webp 800w">
+<img src="fallback.jpg">
+</picture>'''), 's2.webp')
+        self.assertEqual(choose('<img src="a.jpg">'), None)
+
+    def test_animated_images(self):
+        """Animations become stills, animated WebP or links, as asked,
+           even with max_image_size = 0.
+        """
+        from PIL import Image
+        import imagecache
+
+        frames = [ Image.new('RGB', (300, 200), (i * 25, 0, 0))
+                   for i in range(10) ]
+        for how in ('still', 'webp', 'link', 'keep'):
+            with self.image_env(animated_images=how,
+                                max_image_size=0) as (srcdir, newdir):
+                frames[0].save(os.path.join(srcdir, 'anim.gif'),
+                               save_all=True, append_images=frames[1:],
+                               duration=100, loop=0)
+                soup = BeautifulSoup('<img src="anim.gif">', 'lxml')
+                imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                            'file://' + srcdir + '/', newdir)
+                stats = utils.g_feed_stats['Slashdot']
+                self.assertEqual(stats['animations'], 1)
+
+                if how == 'link':
+                    self.assertEqual(soup.a['href'],
+                                     'file://' + srcdir + '/anim.gif')
+                    self.assertEqual(os.listdir(newdir), [])
+                    continue
+
+                self.assertEqual(stats['animation frames'], 10)
+                self.assertEqual(os.listdir(newdir), [ soup.img['src'] ])
+                with Image.open(os.path.join(newdir, soup.img['src'])) as im:
+                    if how == 'still':
+                        self.assertEqual(im.format, 'JPEG')
+                    elif how == 'keep':
+                        self.assertEqual((im.format, im.n_frames),
+                                         ('GIF', 10))
+                    else:
+                        self.assertEqual((im.format, im.n_frames),
+                                         ('WEBP', 10))
+
+    def test_downscale(self):
+        """Big JPEGs are scaled down while decoding, to the exact size."""
+        from PIL import Image
+        import imagecache
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            imgfile = os.path.join(tmpdir, 'big.jpg')
+            Image.new('RGB', (5328, 3996), 'blue').save(imgfile)
+            im = imagecache.downscale(Image.open(imgfile), (1200, 900))
+            self.assertEqual(im.size, (1200, 900))
+            r, g, b = im.getpixel((600, 450))
+            self.assertTrue(r < 8 and g < 8 and b > 248)
+
+    def test_image_index(self):
+        """An image that's already been fetched and converted is found
+           through the index, under its converted name,
+           without fetching or decoding it again.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(max_image_size=1200,
+                            image_store=False) as (srcdir, newdir):
+            Image.new('RGB', (2000, 1000), 'red').save(
+                os.path.join(srcdir, 'big.png'))
+            html = '<body><img src="big.png" width="2000"></body>'
+            base = 'file://' + srcdir + '/'
+
+            results = []
+            for i in range(2):
+                imagecache.clear()
+                soup = BeautifulSoup(html, 'lxml')
+                imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                            base, newdir)
+                results.append((soup.img['src'], soup.img['width']))
+                # If the second pass fetched it, it would get this one.
+                Image.new('RGB', (10, 10), 'red').save(
+                    os.path.join(srcdir, 'big.png'))
+
+            self.assertEqual(results[0], results[1])
+            self.assertTrue(results[0][0].endswith('.jpg'))
+            self.assertEqual(results[0][1], '1200')
+            self.assertEqual(
+                utils.g_feed_stats['Slashdot']['images from index'], 1)
+
+            # The index persists.
+            imagecache.save_index()
+            imagecache.g_image_index = None
+            with imagecache.g_image_index_lock:
+                entries = list(imagecache.load_index().values())
+            self.assertEqual(len(entries), 1)
+            self.assertEqual((entries[0]['width'], entries[0]['height']),
+                             (1200, 600))
+            self.assertEqual(entries[0]['file'], results[0][0])
+            self.assertFalse(entries[0]['transparent'])
+
+    def test_inline_images(self):
+        """Small images go in the HTML as data: URLs, without a file;
+           bigger ones are still saved as files.
+        """
+        from PIL import Image
+        import imagecache
+
+        with self.image_env(inline_image_bytes=2000,
+                            dedup_images=True) as (srcdir, newdir):
+            Image.new('RGB', (40, 40), 'red').save(
+                os.path.join(srcdir, 'small.png'))
+            Image.effect_noise((400, 400), 64).save(
+                os.path.join(srcdir, 'big.png'))
+            html = '''<body><img src="small.png"><img src="big.png">
+<img src="small.png"></body>'''
+
+            soup = BeautifulSoup(html, 'lxml')
+            imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                        'file://' + srcdir + '/', newdir)
+
+            srcs = [ img['src'] for img in soup.find_all('img') ]
+            self.assertTrue(srcs[0].startswith('data:image/jpeg;base64,'))
+            self.assertEqual(srcs[2], srcs[0])
+            self.assertFalse(srcs[1].startswith('data:'))
+            self.assertEqual(os.listdir(newdir), [ srcs[1] ])
+            self.assertEqual(
+                utils.g_feed_stats['Slashdot']['images inlined'], 1)
+
+            # A copy of an inlined image, on a later page, isn't
+            # taken for a duplicate of the file that's gone.
+            shutil.copy(os.path.join(srcdir, 'small.png'),
+                        os.path.join(srcdir, 'copy.png'))
+            soup = BeautifulSoup('<img src="copy.png">', 'lxml')
+            imagecache.process_img_tags(soup.find_all('img'), 'Slashdot',
+                                        'file://' + srcdir + '/', newdir)
+            self.assertEqual(soup.img['src'], srcs[0])
+            self.assertEqual(os.listdir(newdir), [ srcs[1] ])
+
+    def test_seen_ids(self):
+        """SeenIDs finds ids by hash, keeps their times through updates
+           and merges, and round-trips through the text cache.
+        """
+        from cache import FeedmeCache, SeenIDs
+
+        ids = SeenIDs([ ('https://example.com/%d' % i, 100 + i, 200 + i)
+                        for i in range(50) ])
+        self.assertEqual(len(ids), 50)
+        self.assertEqual(list(ids.hashes), sorted(ids.hashes))
+        self.assertTrue('https://example.com/7' in ids)
+        self.assertFalse('https://example.com/50' in ids)
+        self.assertEqual(ids.times('https://example.com/7'), (107, 207))
+        self.assertEqual(ids.times('https://example.com/50'), None)
+
+        ids.update([ 'https://example.com/7', 'https://example.com/50' ],
+                   300, cutoff=220)
+        self.assertEqual(len(ids), 32)
+        self.assertEqual(ids.times('https://example.com/7'), (107, 300))
+        self.assertEqual(ids.times('https://example.com/50'), (300, 300))
+        self.assertFalse('https://example.com/8' in ids)
+
+        other = SeenIDs([ ('https://example.com/7', 50, 250),
+                          ('https://example.com/99', 400, 400) ])
+        ids.merge(other)
+        self.assertEqual(len(ids), 33)
+        self.assertEqual(ids.times('https://example.com/7'), (50, 300))
+        self.assertEqual(ids.times('https://example.com/99'), (400, 400))
+
+        with self.cache_env():
+            cache = FeedmeCache.newcache()
+            urls = [ 'https://example.com/a', 'https://example.com/b' ]
+            cache.add_items('https://example.com/rss', urls)
+            cache.save_to_file()
+
+            cache = FeedmeCache.newcache()
+            seen = cache['https://example.com/rss']
+            self.assertTrue(isinstance(seen, SeenIDs))
+            self.assertEqual(len(seen), 2)
+            for url in urls:
+                self.assertTrue(url in seen)
+            self.assertFalse('https://example.com/c' in seen)
+
+    def test_sqlite_cache(self):
+        """The sqlite cache imports an existing text cache,
+           and saves and reloads new items.
+        """
+        from cache import FeedmeCache
+
+        with self.cache_env() as cachedir:
+            os.makedirs(cachedir)
+            lastfed = int(time.time()) - 60
+            with open(os.path.join(cachedir, 'feedme.dat'), 'w') as fp:
+                fp.write("FeedMe v. 1.1\n"
+                         "https://example.com/rss|%d|"
+                         "https://example.com/1 https://example.com/2\n"
+                         % lastfed)
+
+            utils.g_config.set('DEFAULT', 'cache_format', 'sqlite')
+            cache = FeedmeCache.newcache()
+            self.assertEqual(len(cache['https://example.com/rss']), 2)
+            self.assertTrue('https://example.com/1'
+                            in cache['https://example.com/rss'])
+            self.assertEqual(cache.last_fed_site('https://example.com/rss'),
+                             lastfed)
+            mode = cache.db.execute("PRAGMA journal_mode").fetchone()[0]
+            self.assertEqual(mode, 'wal')
+
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/2',
+                              'https://example.com/3' ])
+            cache.add_items('https://other.org/feed',
+                            [ 'https://other.org/a' ])
+            cache.save_to_file()
+            del cache['https://other.org/feed']
+            cache.close()
+
+            cache = FeedmeCache.newcache()
+            self.assertEqual(cache.keys(), [ 'https://example.com/rss' ])
+            self.assertEqual(len(cache['https://example.com/rss']), 3)
+            self.assertTrue('https://example.com/3'
+                            in cache['https://example.com/rss'])
+            self.assertEqual(cache.item_times('https://example.com/rss',
+                                              'https://example.com/1'),
+                             (lastfed, lastfed))
+            self.assertTrue(cache.last_time)
+            cache.close()
+            # It was backed up when it was opened the second time.
+            self.assertTrue([ f for f in os.listdir(cachedir)
+                              if f.startswith('feedme-')
+                              and f.endswith('.sqlite') ])
+
+    def test_cache_retention(self):
+        """Cached ids carry the times they were seen, and ones that
+           have dropped out of the feed for save_days are forgotten.
+        """
+        from cache import FeedmeCache
+
+        with self.cache_env() as cachedir:
+            os.makedirs(cachedir)
+            day = 24 * 60 * 60
+            old = int(time.time()) - 10 * day
+            with open(os.path.join(cachedir, 'feedme.dat'), 'w') as fp:
+                fp.write("FeedMe v. 1.1\n"
+                         "https://example.com/rss|%d|"
+                         "https://example.com/1 https://example.com/2\n"
+                         % old)
+
+            cache = FeedmeCache.newcache()
+            self.assertEqual(cache.item_times('https://example.com/rss',
+                                              'https://example.com/1'),
+                             (old, old))
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/2',
+                              'https://example.com/3' ])
+            cache.save_to_file()
+
+            cache = FeedmeCache.newcache()
+            urls = cache['https://example.com/rss']
+            self.assertEqual(len(urls), 2)
+            self.assertFalse('https://example.com/1' in urls)
+            self.assertTrue('https://example.com/3' in urls)
+            with open(os.path.join(cachedir, 'feedme.dat')) as fp:
+                self.assertEqual(fp.read().splitlines()[1].split('|')[2].split()[::3],
+                                 [ 'https://example.com/2',
+                                   'https://example.com/3' ])
+            first, last = cache.item_times('https://example.com/rss',
+                                           'https://example.com/2')
+            self.assertEqual(first, old)
+            self.assertTrue(last > time.time() - day)
+
+    def test_journal_cache(self):
+        """The journal cache appends a record per feed, replays it,
+           survives a cut-off record, and compacts into feedme.dat.
+        """
+        from cache import FeedmeCache
+
+        with self.cache_env(cache_format='journal') as cachedir:
+            journal = os.path.join(cachedir, 'feedme.journal')
+            datfile = os.path.join(cachedir, 'feedme.dat')
+
+            cache = FeedmeCache.newcache()
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/1' ])
+            cache.save_to_file()
+            cache.add_items('https://other.org/feed',
+                            [ 'https://other.org/a' ])
+            cache.save_to_file()
+            self.assertFalse(os.path.exists(datfile))
+            with open(journal) as fp:
+                self.assertEqual(len(fp.readlines()), 2)
+
+            # A crash in the middle of writing a record:
+            with open(journal, 'a') as fp:
+                fp.write('https://example.com/rss|12345|https://exa')
+
+            cache = FeedmeCache.newcache()
+            self.assertEqual(sorted(cache.keys()),
+                             [ 'https://example.com/rss',
+                               'https://other.org/feed' ])
+            self.assertFalse('https://exa' in cache['https://example.com/rss'])
+            with open(journal) as fp:
+                self.assertTrue(fp.read().endswith('/a\n'))
+
+            utils.g_config.set('DEFAULT', 'cache_journal_bytes', '10')
+            cache = FeedmeCache.newcache()
+            self.assertFalse(os.path.exists(journal))
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/2' ])
+            del cache['https://other.org/feed']
+            cache.save_to_file()
+            self.assertFalse(os.path.exists(journal))
+            with open(datfile) as fp:
+                lines = fp.read().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[1].split('|')[2].split()[::3],
+                             [ 'https://example.com/1',
+                               'https://example.com/2' ])
+
+    def test_concurrent_cache(self):
+        """Two feedmes sharing a cache don't lose each other's updates,
+           and only one can hold the full-run lock.
+        """
+        from cache import FeedmeCache, lock_file
+
+        with self.cache_env() as cachedir:
+            first = FeedmeCache.newcache()
+            first.add_items('https://example.com/rss',
+                            [ 'https://example.com/1' ])
+            first.save_to_file()
+
+            # Both start from the same cache ...
+            one = FeedmeCache.newcache()
+            two = FeedmeCache.newcache()
+            one.add_items('https://example.com/rss',
+                          [ 'https://example.com/1',
+                            'https://example.com/2' ])
+            one.save_to_file()
+            two.add_items('https://example.com/rss',
+                          [ 'https://example.com/3' ])
+            two.add_items('https://other.org/feed',
+                          [ 'https://other.org/a' ])
+            two.save_to_file()
+
+            # ... and both sets of changes are there afterward.
+            cache = FeedmeCache.newcache()
+            self.assertEqual(sorted(cache.keys()),
+                             [ 'https://example.com/rss',
+                               'https://other.org/feed' ])
+            for i in range(1, 4):
+                self.assertTrue('https://example.com/%d' % i
+                                in cache['https://example.com/rss'])
+            self.assertEqual([ f for f in os.listdir(cachedir)
+                               if f.endswith('.tmp') ], [])
+
+            lockpath = os.path.join(cachedir, 'feedme.running')
+            held = lock_file(lockpath, block=False)
+            self.assertTrue(held)
+            self.assertEqual(lock_file(lockpath, block=False), None)
+            held.close()
+            lock_file(lockpath, block=False).close()
+
+    def test_cache_backups(self):
+        """The cache is backed up once per change, by hard link,
+           and old backups are pruned using the manifest.
+        """
+        from cache import FeedmeCache
+
+        with self.cache_env() as cachedir:
+            datfile = os.path.join(cachedir, 'feedme.dat')
+            manifest_file = os.path.join(cachedir, 'backups.json')
+
+            cache = FeedmeCache.newcache()
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/1' ])
+            cache.save_to_file()
+
+            cache = FeedmeCache.newcache()
+            with open(manifest_file) as fp:
+                manifest = json.load(fp)
+            self.assertEqual(len(manifest['backups']), 1)
+            backup = os.path.join(cachedir, manifest['backups'][0]['file'])
+            self.assertTrue(os.path.samefile(backup, datfile))
+
+            # Nothing has changed, so no new backup.
+            cache = FeedmeCache.newcache()
+            with open(manifest_file) as fp:
+                self.assertEqual(len(json.load(fp)['backups']), 1)
+
+            # Saving replaces feedme.dat, leaving the backup alone.
+            with open(backup) as fp:
+                before = fp.read()
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/2' ])
+            cache.save_to_file()
+            self.assertFalse(os.path.samefile(backup, datfile))
+            with open(backup) as fp:
+                self.assertEqual(fp.read(), before)
+
+            # Backups older than save_days go when it's time to prune.
+            manifest['backups'][0]['time'] -= 30 * 24 * 60 * 60
+            manifest['pruned'] = 0
+            with open(manifest_file, 'w') as fp:
+                json.dump(manifest, fp)
+            cache = FeedmeCache.newcache()
+            self.assertFalse(os.path.exists(backup))
+            with open(manifest_file) as fp:
+                manifest = json.load(fp)
+            self.assertEqual(len(manifest['backups']), 1)
+            self.assertTrue(os.path.samefile(
+                os.path.join(cachedir, manifest['backups'][0]['file']),
+                datfile))
+
+        # A journal cache is backed up, .dat and .dat.journal,
+        # only when it has changed.
+        with self.cache_env(cache_format='journal') as cachedir:
+            cache = FeedmeCache.newcache()
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/1' ])
+            cache.save_to_file()
+
+            def backups():
+                return sorted(f for f in os.listdir(cachedir)
+                              if f.startswith('feedme-'))
+
+            FeedmeCache.newcache()
+            self.assertEqual(len(backups()), 2)
+            FeedmeCache.newcache()
+            self.assertEqual(len(backups()), 2)
+
+            cache.add_items('https://example.com/rss',
+                            [ 'https://example.com/2' ])
+            cache.save_to_file()
+            FeedmeCache.newcache()
+            self.assertEqual(len(backups()), 4)
+
+    def test_partial_cache(self):
+        """A cache loaded for some feeds leaves the others on disk,
+           reading them only if they're used, and saving keeps them.
+        """
+        from cache import FeedmeCache
+
+        with self.cache_env():
+            cache = FeedmeCache.newcache()
+            cache.add_items('https://one.example.com/rss',
+                            [ 'https://one.example.com/1' ])
+            cache.add_items('https://two.example.com/rss',
+                            [ 'https://two.example.com/1' ])
+            cache.save_to_file()
+            with open(cache.filename) as fp:
+                twoline = [ line for line in fp
+                            if line.startswith('https://two') ][0]
+
+            cache = FeedmeCache.newcache([ 'https://one.example.com/rss' ])
+            self.assertEqual(cache.keys(), [ 'https://one.example.com/rss' ])
+            cache.add_items('https://one.example.com/rss',
+                            [ 'https://one.example.com/2' ])
+            cache.save_to_file()
+            with open(cache.filename) as fp:
+                self.assertTrue(twoline in fp.read())
+
+            # Using another feed loads it.
+            self.assertTrue('https://two.example.com/1'
+                            in cache['https://two.example.com/rss'])
+
+            cache = FeedmeCache.newcache()
+            self.assertEqual(len(cache['https://one.example.com/rss']), 2)
+            self.assertEqual(len(cache['https://two.example.com/rss']), 1)
+
+    def test_partial_journal_cache(self):
+        """A journal cache loaded for some feeds never reads the whole
+           cache, even to back it up.
+        """
+        from cache import FeedmeCache, FeedmeJournalCache
+
+        with self.cache_env(cache_format='journal') as cachedir:
+            cache = FeedmeCache.newcache()
+            for i in range(3):
+                cache.add_items('http://feed%d/rss' % i,
+                                [ 'http://feed%d/story' % i ])
+            cache.save_to_file()
+            cache.compact()
+            cache.add_items('http://feed1/rss', [ 'http://feed1/more' ])
+            cache.save_to_file()
+
+            read_from_file = FeedmeJournalCache.read_from_file
+            scopes = []
+
+            def record_scope(self, sitekeys=None):
+                scopes.append(sitekeys)
+                return read_from_file(self, sitekeys)
+
+            with patch.object(FeedmeJournalCache, 'read_from_file',
+                              record_scope):
+                cache = FeedmeCache.newcache([ 'http://feed2/rss' ])
+            self.assertEqual(scopes, [ [ 'http://feed2/rss' ] ])
+            self.assertEqual(cache.keys(), [ 'http://feed2/rss' ])
+
+            # The backup is feedme.dat plus a copy of the journal.
+            with open(os.path.join(cachedir, 'backups.json')) as fp:
+                backup = json.load(fp)['backups'][-1]
+            self.assertTrue(os.path.samefile(
+                os.path.join(cachedir, backup['file']),
+                os.path.join(cachedir, 'feedme.dat')))
+            self.assertTrue(filecmp.cmp(
+                os.path.join(cachedir, backup['journal']),
+                os.path.join(cachedir, 'feedme.journal'), shallow=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
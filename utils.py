@@ -8,6 +8,7 @@ from configparser import ConfigParser
 import time
 import sys, os
 import traceback
+import threading
 
 
 VersionString = "FeedMe 1.1b8"
@@ -120,11 +121,32 @@ def read_config_file(confdir=None):
         'allow_repeats': 'false',
         'logfile' : '',
         'save_days' : '7',
+        'cache_format' : 'text',  # or sqlite or journal
+        'cache_journal_bytes' : '1000000',  # compact the journal past this
         'skip_images' : 'true',
         'nonlocal_images' : 'false',
         'block_nonlocal_images' : 'true',
         'max_image_size' : '1200',
         'png_to_jpg' : 'true',    # Convert png to jpg, transparent or not
+        'image_fetch_threads' : '4',  # images fetched at once for each page
+        'image_processes' : '2',  # processes for resizing images; 0 for none
+        'defer_images' : 'false', # fetch images after all feeds' text
+        'image_time_budget' : '0',    # seconds for deferred images; 0: no limit
+        'image_byte_budget' : '0',    # bytes for deferred images; 0: no limit
+        'image_store' : 'true',   # keep images across days, in the cache dir
+        'max_image_bytes' : '0',  # link to bigger images; 0 means no limit
+        'min_image_size' : '16',  # drop images this small (trackers, icons)
+        'image_formats' : 'jpeg', # formats to convert images to, by preference
+        'image_quality' : '0',    # 0 means the encoder's default
+        'image_target_bytes' : '0',   # 0 means no target
+        'strip_image_metadata' : 'true',
+        'dedup_images' : 'false', # one copy of pictures that look the same
+        'viewport_width' : '0',   # device screen width; 0: max_srcset_size
+        'device_pixel_ratio' : '1',
+        'max_display_width' : '0',    # widest an image is shown; 0: viewport
+        'animated_images' : 'keep',   # or still, webp, link
+        'max_animation_bytes' : '1000000',    # for animated_images = webp
+        'inline_image_bytes' : '0',   # put smaller images in the HTML
         'skip_links' : 'false',
         'when' : '',  # Day, like tue, or month-day, like 14
         'min_width' : '25', # min # chars in an item link
@@ -133,6 +155,17 @@ def read_config_file(confdir=None):
         'ascii' : 'false',
         'allow_gzip' : 'true',
         'allow_dup_titles' : 'false',
+
+        # How to serialize story HTML: compact, minify or pretty
+        'output_style' : 'compact',
+
+        # Blocks to cut from the raw HTML before parsing it:
+        # any of script, style, template, noscript, comments
+        'prescrub' : 'script style',
+
+        # Find the main content of each story automatically:
+        # true, false, or fallback (only if no page_start matches)
+        'extract_content' : 'false',
     } )
 
     g_config.read(conffile)
@@ -161,6 +194,39 @@ def expanduser(name):
     return name
 
 
+#
+# Per-feed statistics, like bytes saved, to show in the run summary.
+# { feedname: { statname: amount, ... } }
+# Several threads may be adding to these at once, hence the lock.
+#
+g_feed_stats = {}
+g_feed_stats_lock = threading.Lock()
+
+
+def add_stat(feedname, statname, amount):
+    """Add amount to the named statistic for feedname."""
+    with g_feed_stats_lock:
+        stats = g_feed_stats.setdefault(feedname, {})
+        stats[statname] = stats.get(statname, 0) + amount
+
+
+def feed_stats_summary(feedname):
+    """Return a one-line summary of the statistics collected for a feed,
+       or None if there aren't any.
+    """
+    with g_feed_stats_lock:
+        stats = g_feed_stats.get(feedname)
+        if not stats:
+            return None
+        parts = []
+        for statname, amount in stats.items():
+            if type(amount) is float:
+                parts.append("%s %.2f" % (statname, amount))
+            else:
+                parts.append("%s %d" % (statname, amount))
+    return ', '.join(parts)
+
+
 def last_time_this_feed(cache, feedname):
     '''Return the last time we fetched a given feed.
        This is most useful for feeds that randomly show old entries.